@@ -0,0 +1,475 @@
+#!/usr/bin/python3
+"""Benchmark of sourcing activate
+
+Compiles activate for a matrix of configs and sources it in
+non-interactive bash and zsh (every source in a new shell), timing:
+
+    activate     `source activate`, the ssh-agent is already running
+    deactivate   `deactivate` after an untimed `source activate`
+
+Vault env vars are read from a local stand-in Vault server through a
+`vault` shim, so nothing leaves the host. A shell which is not installed is
+skipped. Results are appended to the results file and compared with the
+previous record made with the same arguments.
+
+    ./benchmarks/activate_bench.py --iterations 50
+"""
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from argparse import ArgumentParser, SUPPRESS
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+from install_bench import REPO_DIR, _git_commit, load_previous
+
+DEFAULT_RESULTS = REPO_DIR / 'benchmarks' / 'results' / 'activate_bench.jsonl'
+SHELLS = ('bash', 'zsh')
+
+BINARIES = ('terraform', 'terragrunt', 'k9s', 'kubectl', 'helm', 'argocd', 'gcloud')
+SECRETS = {
+    'secret/app': {'user': 'app', 'password': "p@ss w'rd"},
+    'secret/db': {'host': 'db.local', 'password': 'db-secret'},
+}
+
+# config name -> features, see make_config()
+CONFIGS = {
+    'minimal': (),
+    'binaries': ('binaries',),
+    'ssh': ('binaries', 'ssh'),
+    'vault-env': ('binaries', 'vault_env'),
+    'vault-env-nocache': ('binaries', 'vault_env', 'vault_env_nocache'),
+    'env-files': ('binaries', 'env_files'),
+    'all': ('binaries', 'ssh', 'vault_env', 'env_files', 'python', 'ansible'),
+    'all-lazy': ('binaries', 'ssh', 'vault_env', 'env_files', 'python', 'ansible', 'lazy'),
+}
+
+# $1 - activate, $2 - activate|deactivate, $3 - file for "start end" times
+DRIVER = """
+if [ -n "${ZSH_VERSION-}" ]; then
+    zmodload zsh/datetime
+fi
+if [ -z "${EPOCHREALTIME-}" ]; then
+    echo "EPOCHREALTIME is not supported by the shell" >&2
+    exit 2
+fi
+if [ "$2" = activate ]; then
+    t0=$EPOCHREALTIME
+    source "$1"
+    t1=$EPOCHREALTIME
+else
+    source "$1"
+    t0=$EPOCHREALTIME
+    deactivate
+    t1=$EPOCHREALTIME
+fi
+echo "$t0 $t1" >> "$3"
+"""
+
+VAULT_SHIM = """#!{python}
+# vault CLI stand-in: kv get, token lookup and token renew against VAULT_ADDR
+import json, os, sys, urllib.request
+
+args = [a for a in sys.argv[1:] if not a.startswith('-')]
+if args[:2] == ['kv', 'get']:
+    mount, _, path = args[2].partition('/')
+    url = '/v1/{{}}/data/{{}}'.format(mount, path)
+elif args[:2] in (['token', 'lookup'], ['token', 'renew']):
+    url = '/v1/auth/token/lookup-self'
+else:
+    sys.exit("vault shim: unsupported command " + ' '.join(sys.argv[1:]))
+request = urllib.request.Request(
+    os.environ['VAULT_ADDR'] + url,
+    headers={{'X-Vault-Token': os.environ.get('VAULT_TOKEN', '')}},
+)
+try:
+    with urllib.request.urlopen(request) as response:
+        print(response.read().decode())
+except urllib.error.HTTPError as exc:
+    sys.exit("vault shim: {{}}".format(exc))
+"""
+
+
+class VaultHandler(BaseHTTPRequestHandler):
+    """KV v2 reads and token lookup of a stand-in Vault"""
+
+    def do_GET(self):
+        time.sleep(self.server.latency)
+        self.server.count()
+        if self.path == '/v1/auth/token/lookup-self':
+            self._send(200, {'data': {'ttl': 0, 'renewable': False}})
+            return
+        mount, _, path = self.path[len('/v1/'):].partition('/data/')
+        secret = SECRETS.get('{}/{}'.format(mount, path))
+        if secret is None:
+            self._send(404, {'errors': []})
+            return
+        self._send(200, {'data': {'data': secret, 'metadata': {'version': 1}}})
+
+    def _send(self, status: int, body: dict):
+        content = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class VaultServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, latency: float):
+        super().__init__(('127.0.0.1', 0), VaultHandler)
+        self.latency = latency
+        self.requests = 0
+        self._lock = threading.Lock()
+
+    @property
+    def url(self) -> str:
+        return 'http://127.0.0.1:{}'.format(self.server_address[1])
+
+    def count(self):
+        with self._lock:
+            self.requests += 1
+
+    def take_requests(self) -> int:
+        with self._lock:
+            requests, self.requests = self.requests, 0
+        return requests
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+
+def make_config(path: Path, features: tuple, vault_url: str, ansible_repo: Path):
+    config: dict = {
+        'vault': {'enabled': False},
+        'ssh': {'enabled': False},
+        'ansible': {'enabled': False},
+        'python': {'enabled': False},
+        'gron': {'enabled': False},
+        'cache': {'enabled': False},
+    }
+    for tool in BINARIES:
+        config[tool] = {'enabled': 'binaries' in features, 'version': '1.0.0'}
+    if 'binaries' in features:
+        config['vault'] = {'enabled': True, 'addr': vault_url, 'version': '1.0.0'}
+    if 'vault_env' in features:
+        config['vault']['load_env_vars'] = {
+            'APP_USER': 'secret/app;;user',
+            'APP_PASSWORD': 'secret/app;;password',
+            'DB_HOST': 'secret/db;;host',
+            'DB_PASSWORD': 'secret/db;;password',
+        }
+        config['vault']['load_env_vars_ttl'] = 0 if 'vault_env_nocache' in features else 3600
+    if 'ssh' in features:
+        config['ssh'] = {'enabled': True, 'enable_autocomplete_from_ansible': True}
+    if 'python' in features:
+        config['python'] = {'enabled': True, 'packages': []}
+    if 'ansible' in features:
+        config['ansible'] = {'enabled': True, 'repo_url': '', 'repo_path': str(ansible_repo)}
+    if 'lazy' in features:
+        config['activate'] = {'lazy': True}
+    path.write_text(json.dumps(config, indent=1))
+
+
+def render(config_path: str, workdir_path: str):
+    """Writes activate of the config, runs in its own process"""
+    sys.path.insert(0, str(REPO_DIR))
+    import install
+    from common.config import Config
+    from common.logger import setup_logger
+    from common.workdir import Workdir
+    from installers.ssh import SSH
+    from installers.vault import Vault
+
+    setup_logger(debug=False)
+    workdir = Workdir(root_dir=workdir_path)
+    workdir.prepare()
+    config = Config(
+        toolbox_name='bench',
+        toolbox_repo_dir=REPO_DIR,
+        workdir=workdir,
+        config_path=config_path,
+    )
+    installers = install.make_installers(config)
+    activate = install.render_activate(installers, config)
+    if not activate.is_valid():
+        sys.exit(1)
+    activate.write_template()
+    # Only the files activate reads, binaries are not needed
+    for installer in installers:
+        if isinstance(installer, SSH) and installer.enabled:
+            installer.install()
+        if isinstance(installer, Vault) and installer.generate_env_load():
+            installer._setup_env_loader()
+
+
+def prepare_workdir(tmp: Path, name: str, features: tuple, vault_url: str, args) -> Path:
+    run_dir = tmp / name
+    run_dir.mkdir()
+    config_path = run_dir / 'config.json'
+    make_config(config_path, features, vault_url, tmp / 'ansible')
+    workdir = run_dir / 'workdir'
+    p = subprocess.run(
+        [sys.executable, __file__, '--render', str(config_path), str(workdir)],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        text=True,
+    )
+    if p.returncode != 0:
+        print(p.stdout[-4000:])
+        print("Can't render activate for {}".format(name))
+        sys.exit(1)
+
+    # Valid token which never expires, so activate doesn't ask to login
+    (workdir / 'vault_token').write_text('bench-token')
+    (workdir / 'vault_token.meta').write_text('0 0 false\n')
+    if 'ssh' in features:
+        hosts = ['host-{}.bench.local'.format(i) for i in range(args.hosts)]
+        (workdir / 'ssh' / 'hosts.index').write_text('\n'.join(hosts) + '\n')
+        (workdir / 'ssh' / 'hosts.index.sources').write_text('')
+    if 'env_files' in features:
+        env_dir = workdir / 'env'
+        env_dir.mkdir()
+        for i in range(args.env_files):
+            (env_dir / 'env{}.sh'.format(i)).write_text(
+                'export BENCH_ENV_{}="value {}"\n'.format(i, i)
+            )
+    return workdir
+
+
+def make_env(tmp: Path, shim_dir: Path) -> dict:
+    env = {
+        'HOME': str(tmp / 'home'),
+        'PATH': '{}:{}'.format(shim_dir, os.environ.get('PATH', '/usr/bin:/bin')),
+        'LC_ALL': 'C',
+        'TERM': 'dumb',
+    }
+    Path(env['HOME']).mkdir(exist_ok=True)
+    return env
+
+
+def time_source(shell: str, workdir: Path, mode: str, iterations: int, env: dict) -> list:
+    times_path = workdir.parent / '{}-{}.times'.format(shell, mode)
+    times_path.unlink(missing_ok=True)
+    activate = workdir / 'activate'
+    for _ in range(iterations):
+        p = subprocess.run(
+            [shell, '-c', DRIVER, 'driver', str(activate), mode, str(times_path)],
+            env=env,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+            text=True,
+        )
+        if p.returncode != 0:
+            print(p.stderr[-2000:])
+            print("{} failed to source {} (exit code {})".format(shell, activate, p.returncode))
+            sys.exit(1)
+    times = []
+    with open(times_path, 'r') as f:
+        for line in f:
+            start, end = line.split()
+            times.append((float(end) - float(start)) * 1000)
+    return times
+
+
+def stop_agent(shell: str, workdir: Path, env: dict):
+    """`deactivate` stops the ssh-agent started by the activations"""
+    subprocess.run(
+        [shell, '-c', 'source "$1"; deactivate', 'stop', str(workdir / 'activate')],
+        env=env,
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+
+
+def percentiles(times: list) -> dict:
+    if len(times) < 2:
+        return {'p50': round(times[0], 2), 'p95': round(times[0], 2)}
+    return {
+        'p50': round(statistics.median(times), 2),
+        'p95': round(statistics.quantiles(times, n=20)[18], 2),
+    }
+
+
+def run_matrix(args, shells: list, tmp: Path, vault: VaultServer, env: dict) -> dict:
+    results: dict = {}
+    (tmp / 'ansible').mkdir()
+    for name in args.configs:
+        workdir = prepare_workdir(tmp, name, CONFIGS[name], vault.url, args)
+        for shell in shells:
+            # Warm up: starts the ssh-agent and fills the vault env cache
+            time_source(shell, workdir, 'activate', 1, env)
+            vault.take_requests()
+            activate = time_source(shell, workdir, 'activate', args.iterations, env)
+            requests = vault.take_requests()
+            deactivate = time_source(shell, workdir, 'deactivate', args.iterations, env)
+            stop_agent(shell, workdir, env)
+            results['{}/{}'.format(name, shell)] = {
+                'activate': percentiles(activate),
+                'deactivate': percentiles(deactivate),
+                'vault_requests': requests,
+            }
+            print("  {:<18} {:<4}  activate p50 {:6.2f}ms  deactivate p50 {:6.2f}ms".format(
+                name, shell,
+                results['{}/{}'.format(name, shell)]['activate']['p50'],
+                results['{}/{}'.format(name, shell)]['deactivate']['p50'],
+            ))
+    return results
+
+
+def print_summary(results: dict, previous):
+    print("\n{:<24} {:>9} {:>9} {:>9} {:>9} {:>9} {:>8}".format(
+        'config/shell', 'act p50', 'act p95', 'deact p50', 'deact p95', 'previous', 'change'))
+    for key, current in results.items():
+        prev_p50 = ""
+        change = ""
+        if previous and key in previous['results']:
+            prev = previous['results'][key]['activate']['p50']
+            prev_p50 = "{:.2f}ms".format(prev)
+            if prev:
+                change = "{:+.1f}%".format((current['activate']['p50'] - prev) / prev * 100)
+        print("{:<24} {:>7.2f}ms {:>7.2f}ms {:>7.2f}ms {:>7.2f}ms {:>9} {:>8}".format(
+            key,
+            current['activate']['p50'], current['activate']['p95'],
+            current['deactivate']['p50'], current['deactivate']['p95'],
+            prev_p50, change,
+        ))
+    if previous:
+        print("\nPrevious: {} ({})".format(previous['commit'], previous['date']))
+
+
+def main():
+    parser = ArgumentParser(description="Benchmark of sourcing activate")
+    parser.add_argument(
+        "--iterations",
+        type=int,
+        help="How many times activate and deactivate are timed (default: 30)",
+        default=30,
+    )
+    parser.add_argument(
+        "--configs",
+        nargs='+',
+        choices=list(CONFIGS),
+        help="Configs to run (default: all)",
+        default=list(CONFIGS),
+    )
+    parser.add_argument(
+        "--shells",
+        nargs='+',
+        choices=SHELLS,
+        help="Shells to run, missing shells are skipped (default: bash zsh)",
+        default=list(SHELLS),
+    )
+    parser.add_argument(
+        "--hosts",
+        type=int,
+        help="Hosts in the ssh completion index (default: 2000)",
+        default=2000,
+    )
+    parser.add_argument(
+        "--env-files",
+        type=int,
+        help="Files in <workdir>/env (default: 20)",
+        default=20,
+    )
+    parser.add_argument(
+        "--vault-latency-ms",
+        type=int,
+        help="Response delay of the stand-in Vault (default: 20)",
+        default=20,
+    )
+    parser.add_argument(
+        "--results",
+        help="JSONL file with results (default: {})".format(
+            DEFAULT_RESULTS.relative_to(REPO_DIR)),
+        default=str(DEFAULT_RESULTS),
+    )
+    parser.add_argument(
+        "--keep",
+        action='store_true',
+        help="Keep the temporary dir with workdirs",
+        default=False,
+    )
+    parser.add_argument("--render", nargs=2, help=SUPPRESS)
+    args = parser.parse_args()
+
+    if args.render:
+        render(*args.render)
+        return
+
+    shells = []
+    for shell in args.shells:
+        if shutil.which(shell):
+            shells.append(shell)
+        else:
+            print("No '{}' in PATH, skip it".format(shell))
+    if not shells:
+        sys.exit(1)
+    if not shutil.which('jq'):
+        print("No 'jq' in PATH, it is needed for vault env vars")
+        sys.exit(1)
+
+    tmp = Path(tempfile.mkdtemp(prefix='activate-bench-'))
+    vault = VaultServer(args.vault_latency_ms / 1000)
+    try:
+        shim_dir = tmp / 'shims'
+        shim_dir.mkdir()
+        shim = shim_dir / 'vault'
+        shim.write_text(VAULT_SHIM.format(python=sys.executable))
+        shim.chmod(0o755)
+        vault.start()
+        print("Stand-in vault: {}".format(vault.url))
+        results = run_matrix(args, shells, tmp, vault, make_env(tmp, shim_dir))
+    finally:
+        vault.shutdown()
+        if args.keep:
+            print("Kept {}".format(tmp))
+        else:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    params = {
+        'iterations': args.iterations,
+        'hosts': args.hosts,
+        'env_files': args.env_files,
+        'vault_latency_ms': args.vault_latency_ms,
+    }
+    results_path = Path(args.results)
+    previous = load_previous(results_path, params)
+    record = {
+        'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'commit': _git_commit(),
+        'host': platform.node(),
+        'shells': {
+            shell: subprocess.run(
+                [shell, '-c', 'echo ${BASH_VERSION-}${ZSH_VERSION-}'],
+                stdout=subprocess.PIPE,
+                text=True,
+            ).stdout.strip()
+            for shell in shells
+        },
+        'params': params,
+        'results': results,
+    }
+    print_summary(results, previous)
+    results_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(results_path, 'a') as f:
+        f.write(json.dumps(record) + '\n')
+    print("Results saved to {}".format(results_path))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,522 @@
+#!/usr/bin/python3
+"""Offline benchmark of install.py
+
+Starts a local artifact server with synthetic Terraform, Vault, Terragrunt,
+K9S, Helm, Kubectl, ArgoCD and gcloud releases, creates local git repos for
+Ansible and Gron and times full install.py runs:
+
+    cold   empty workdir, empty artifact cache
+    warm   empty workdir, artifact cache from the cold run
+    noop   install.py again on the warm workdir
+    bump   new terraform version in the config
+
+Every run appends a record to the results file and prints the difference
+with the previous record made with the same arguments.
+
+    ./benchmarks/install_bench.py --repeat 3
+"""
+import email.utils
+import io
+import json
+import os
+import platform
+import re
+import shutil
+import statistics
+import subprocess
+import sys
+import tarfile
+import tempfile
+import threading
+import time
+import zipfile
+from argparse import ArgumentParser
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+REPO_DIR = Path(os.path.realpath(__file__)).parents[1]
+DEFAULT_RESULTS = REPO_DIR / 'benchmarks' / 'results' / 'install_bench.jsonl'
+SCENARIOS = ('cold', 'warm', 'noop', 'bump')
+
+# tool -> (version, bump version, artifact type, version output of the binary)
+TOOLS = {
+    'terraform': ('1.3.7', '1.3.9', 'zip', 'echo "Terraform v{ver}"'),
+    'vault': ('1.12.2', '1.12.2', 'zip', 'echo "Vault v{ver} (abcdef)"'),
+    'terragrunt': ('0.42.8', '0.42.8', 'bin', 'echo "terragrunt version v{ver}"'),
+    'k9s': ('0.26.7', '0.26.7', 'tar', 'echo " Version:    v{ver}"'),
+    'helm': ('3.10.3', '3.10.3', 'tar',
+             'echo \'version.BuildInfo{{Version:"v{ver}", GitCommit:"abc"}}\''),
+    'kubectl': ('1.26.0', '1.26.0', 'bin',
+                'echo \'{{"clientVersion": {{"gitVersion": "v{ver}"}}}}\''),
+    'argocd': ('2.5.6', '2.5.6', 'bin', 'echo "argocd: v{ver}+abc"'),
+    'gcloud': ('412.0.0', '412.0.0', 'sdk', 'echo "Google Cloud SDK {ver}"'),
+}
+
+# Same path shapes as the real download urls in default.json
+URLS = {
+    'terraform': '/terraform/{ver}/terraform_{ver}_{os}_{arch}.zip',
+    'vault': '/vault/{ver}/vault_{ver}_{os}_{arch}.zip',
+    'terragrunt': '/terragrunt/{ver}/terragrunt_{os}_{arch}',
+    'k9s': '/k9s/{ver}/k9s_{os}_{arch}.tar.gz',
+    'helm': '/helm/{ver}/helm-v{ver}-{os}-{arch}.tar.gz',
+    'kubectl': '/kubectl/{ver}/bin/{os}/{arch}/kubectl',
+    'argocd': '/argocd/{ver}/argocd-{os}-{arch}',
+    'gcloud': '/gcloud/{ver}/google-cloud-cli-{ver}-{os}-{arch}.tar.gz',
+}
+
+
+class ArtifactHandler(SimpleHTTPRequestHandler):
+    """/<tool>/<version>/<anything> -> <root>/<tool>/<version>/artifact
+
+    Supports HEAD, single Range requests, If-Range, ETag and
+    If-None-Match like the real release servers.
+    """
+
+    def do_HEAD(self):
+        self._serve(head=True)
+
+    def do_GET(self):
+        self._serve(head=False)
+
+    def _serve(self, head: bool):
+        parts = self.path.split('?', 1)[0].strip('/').split('/')
+        path = Path(self.server.root, *parts[:2], 'artifact') if len(parts) > 2 else None
+        if not path or not path.is_file():
+            self.send_error(404)
+            return
+        st = path.stat()
+        size = st.st_size
+        etag = '"{:x}-{:x}"'.format(size, st.st_mtime_ns)
+        headers = {
+            'ETag': etag,
+            'Last-Modified': email.utils.formatdate(st.st_mtime, usegmt=True),
+            'Accept-Ranges': 'bytes',
+        }
+        if self.headers.get('If-None-Match') == etag:
+            self._send(304, headers)
+            return
+        start, end = 0, size - 1
+        status = 200
+        range_header = self.headers.get('Range')
+        if_range = self.headers.get('If-Range')
+        match = re.match(r'bytes=(\d+)-(\d*)$', range_header or '')
+        if match and (not if_range or if_range == etag):
+            start = int(match.group(1))
+            if match.group(2):
+                end = min(int(match.group(2)), size - 1)
+            if start >= size:
+                headers['Content-Range'] = 'bytes */{}'.format(size)
+                self._send(416, headers)
+                return
+            status = 206
+            headers['Content-Range'] = 'bytes {}-{}/{}'.format(start, end, size)
+        headers['Content-Length'] = str(end - start + 1)
+        headers['Content-Type'] = 'application/octet-stream'
+        self._send(status, headers)
+        if head:
+            return
+        with open(path, 'rb') as f:
+            f.seek(start)
+            left = end - start + 1
+            while left:
+                chunk = f.read(min(left, 1 << 20))
+                if not chunk:
+                    break
+                self.wfile.write(chunk)
+                left -= len(chunk)
+                self.server.count(len(chunk))
+
+    def _send(self, status: int, headers: dict):
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.server.count(0)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ArtifactServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, root: Path):
+        super().__init__(('127.0.0.1', 0), ArtifactHandler)
+        self.root = root
+        self.bytes_sent = 0
+        self.requests = 0
+        self._lock = threading.Lock()
+
+    @property
+    def url(self) -> str:
+        return 'http://127.0.0.1:{}'.format(self.server_address[1])
+
+    def count(self, size: int):
+        with self._lock:
+            if size:
+                self.bytes_sent += size
+            else:
+                self.requests += 1
+
+    def take_counters(self) -> tuple:
+        with self._lock:
+            counters = (self.bytes_sent, self.requests)
+            self.bytes_sent, self.requests = 0, 0
+        return counters
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+
+def _binary(tool: str, ver: str, size: int) -> bytes:
+    # Version output like the real binary, random tail like a real executable
+    script = '#!/bin/sh\n{}\nexit 0\n'.format(TOOLS[tool][3].format(ver=ver)).encode()
+    return script + b'#' + os.urandom(max(size - len(script) - 1, 0))
+
+
+def _tar_add(tf: tarfile.TarFile, name: str, data: bytes, mode: int = 0o755):
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    info.mode = mode
+    info.mtime = int(time.time())
+    tf.addfile(info, io.BytesIO(data))
+
+
+def make_artifact(root: Path, tool: str, ver: str, size: int, sdk_files: int):
+    dest = root / tool / ver / 'artifact'
+    dest.parent.mkdir(parents=True, exist_ok=True)
+    kind = TOOLS[tool][2]
+    data = _binary(tool, ver, size)
+    if kind == 'bin':
+        dest.write_bytes(data)
+    elif kind == 'zip':
+        with zipfile.ZipFile(dest, 'w', zipfile.ZIP_DEFLATED) as zf:
+            info = zipfile.ZipInfo(tool)
+            info.external_attr = 0o755 << 16
+            zf.writestr(info, data)
+    elif kind == 'tar':
+        with tarfile.open(dest, 'w:gz') as tf:
+            # helm keeps the binary in <os>-<arch>/, k9s in the root
+            _tar_add(tf, 'linux-amd64/helm' if tool == 'helm' else tool, data)
+            _tar_add(tf, 'LICENSE', b'license\n' * 100, 0o644)
+    else:
+        # gcloud: a lot of small python files and a small launcher
+        with tarfile.open(dest, 'w:gz') as tf:
+            _tar_add(tf, 'google-cloud-sdk/bin/gcloud', data[:4096])
+            _tar_add(tf, 'google-cloud-sdk/VERSION', (ver + '\n').encode(), 0o644)
+            for i in range(sdk_files):
+                content = 'def f{}():\n    return {!r}\n'.format(i, os.urandom(1024).hex())
+                _tar_add(
+                    tf,
+                    'google-cloud-sdk/lib/googlecloudsdk/m{:03d}/f{}.py'.format(i % 100, i),
+                    content.encode(),
+                    0o644,
+                )
+
+
+def make_git_repo(path: Path, files: dict):
+    path.mkdir(parents=True)
+    for name, content in files.items():
+        (path / name).parent.mkdir(parents=True, exist_ok=True)
+        (path / name).write_text(content)
+    git = ['git', '-c', 'user.name=bench', '-c', 'user.email=bench@localhost']
+    for cmd in (['init', '-q'], ['add', '-A'], ['commit', '-q', '-m', 'init']):
+        subprocess.run(git + cmd, cwd=path, check=True, stdout=subprocess.DEVNULL)
+
+
+def make_repos(root: Path, ansible_roles: int) -> dict:
+    # No ansible.cfg: the repo doesn't exist yet when the config is read on the
+    # first install, so the toolbox ansible.cfg would be used once and then
+    # replaced with an interactive prompt on the next run
+    ansible_files = {
+        'requirements.txt': '# ansible is installed from the config\n',
+    }
+    for i in range(ansible_roles):
+        ansible_files['roles/role{}/tasks/main.yml'.format(i)] = (
+            '- name: task {}\n  debug:\n    msg: "{}"\n'.format(i, 'x' * 200)
+        )
+    make_git_repo(root / 'ansible.git', ansible_files)
+    make_git_repo(root / 'gron.git', {
+        'requirements.txt': '# no requirements\n',
+        'src/main.py': 'print("gron")\n',
+    })
+    return {
+        'ansible': 'file://{}'.format(root / 'ansible.git'),
+        'gron': 'file://{}'.format(root / 'gron.git'),
+    }
+
+
+def make_config(path: Path, server_url: str, repos: dict, run_dir: Path, bump: bool):
+    config = {
+        'python': {'enabled': True, 'packages': []},
+        'ssh': {'enabled': True},
+        'ansible': {
+            'enabled': True,
+            'repo_url': repos['ansible'],
+            'repo_path': str(run_dir / 'ansible-repo'),
+            'use_ssh_agent': True,
+            'use_venv_for_localhost_delegation': True,
+        },
+        'gron': {'enabled': True, 'repo_url': repos['gron']},
+        'cache': {'enabled': True, 'path': str(run_dir.parent / 'cache')},
+    }
+    for tool, (ver, bump_ver, _, _) in TOOLS.items():
+        config[tool] = {
+            'enabled': True,
+            'version': bump_ver if bump else ver,
+            'download_url': server_url + URLS[tool],
+        }
+    config['vault']['addr'] = 'http://127.0.0.1:8200'
+    path.write_text(json.dumps(config, indent=1))
+
+
+def run_install(config_path: Path, workdir: Path, jobs: int) -> float:
+    env = dict(os.environ)
+    # Offline: pip must not go to the index, proxies must not be used
+    env['PIP_NO_INDEX'] = '1'
+    for name in ('http_proxy', 'https_proxy', 'HTTP_PROXY', 'HTTPS_PROXY'):
+        env.pop(name, None)
+    started = time.monotonic()
+    p = subprocess.run(
+        [
+            sys.executable, str(REPO_DIR / 'install.py'),
+            '-c', str(config_path),
+            '-w', str(workdir),
+            '-n', 'bench',
+            '-j', str(jobs),
+        ],
+        env=env,
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        text=True,
+    )
+    elapsed = time.monotonic() - started
+    if p.returncode != 0:
+        print(p.stdout[-4000:])
+        print("install.py failed (exit code {})".format(p.returncode))
+        sys.exit(1)
+    return elapsed
+
+
+def _phases(workdir: Path) -> dict:
+    """Sum of phase durations by phase name from .report.json"""
+    report_path = workdir / '.report.json'
+    if not report_path.exists():
+        return {}
+    with open(report_path, 'r') as f:
+        report = json.load(f)
+    phases: dict = {}
+    for record in report.get('phases', []):
+        if record['phase'] == 'install':
+            continue
+        phases[record['phase']] = round(phases.get(record['phase'], 0) + record['duration'], 3)
+    return phases
+
+
+def run_scenarios(args, server: ArtifactServer, repos: dict, tmp: Path) -> dict:
+    runs: dict = {name: [] for name in SCENARIOS}
+    for i in range(args.repeat):
+        run_root = tmp / 'run{}'.format(i)
+        # cold and warm use their own workdirs, the cache is shared by them
+        cold_dir, warm_dir = run_root / 'cold', run_root / 'warm'
+        cold_dir.mkdir(parents=True)
+        warm_dir.mkdir(parents=True)
+        steps = (
+            ('cold', cold_dir, False),
+            ('warm', warm_dir, False),
+            ('noop', warm_dir, False),
+            ('bump', warm_dir, True),
+        )
+        for name, run_dir, bump in steps:
+            config_path = run_dir / 'config.json'
+            make_config(config_path, server.url, repos, run_dir, bump)
+            server.take_counters()
+            elapsed = run_install(config_path, run_dir / 'workdir', args.jobs)
+            bytes_sent, requests = server.take_counters()
+            result = {
+                'wall': round(elapsed, 3),
+                'bytes': bytes_sent,
+                'requests': requests,
+                'phases': _phases(run_dir / 'workdir'),
+            }
+            runs[name].append(result)
+            print("  {} #{}: {:.2f}s, {} requests, {:.1f}MB".format(
+                name, i + 1, elapsed, requests, bytes_sent / 1024 / 1024,
+            ))
+    return runs
+
+
+def summarize(runs: dict) -> dict:
+    summary = {}
+    for name, results in runs.items():
+        phases: dict = {}
+        for result in results:
+            for phase, duration in result['phases'].items():
+                phases.setdefault(phase, []).append(duration)
+        summary[name] = {
+            'wall': round(statistics.median(r['wall'] for r in results), 3),
+            'wall_min': min(r['wall'] for r in results),
+            'bytes': results[-1]['bytes'],
+            'requests': results[-1]['requests'],
+            'phases': {
+                phase: round(statistics.median(values), 3)
+                for phase, values in sorted(phases.items())
+            },
+            'runs': [r['wall'] for r in results],
+        }
+    return summary
+
+
+def _git_commit() -> str:
+    try:
+        p = subprocess.run(
+            ['git', 'describe', '--always', '--dirty'],
+            cwd=REPO_DIR,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            text=True,
+        )
+        return p.stdout.strip()
+    except OSError:
+        return ""
+
+
+def load_previous(results_path: Path, params: dict):
+    if not results_path.exists():
+        return None
+    previous = None
+    with open(results_path, 'r') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.decoder.JSONDecodeError:
+                continue
+            if record.get('params') == params:
+                previous = record
+    return previous
+
+
+def print_summary(summary: dict, previous):
+    print("\n{:<6} {:>9} {:>9} {:>9} {:>8} {:>10}".format(
+        'run', 'median', 'min', 'previous', 'change', 'download'))
+    for name in SCENARIOS:
+        current = summary[name]
+        prev_wall = ""
+        change = ""
+        if previous and name in previous['scenarios']:
+            prev = previous['scenarios'][name]['wall']
+            prev_wall = "{:.2f}s".format(prev)
+            if prev:
+                change = "{:+.1f}%".format((current['wall'] - prev) / prev * 100)
+        print("{:<6} {:>8.2f}s {:>8.2f}s {:>9} {:>8} {:>8.1f}MB".format(
+            name, current['wall'], current['wall_min'], prev_wall, change,
+            current['bytes'] / 1024 / 1024,
+        ))
+        phases = ', '.join(
+            "{} {:.2f}s".format(phase, duration)
+            for phase, duration in current['phases'].items()
+        )
+        if phases:
+            print("       {}".format(phases))
+    if previous:
+        print("\nPrevious: {} ({})".format(previous['commit'], previous['date']))
+
+
+def main():
+    parser = ArgumentParser(description="Offline benchmark of install.py")
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        help="How many times every scenario runs (default: 3)",
+        default=3,
+    )
+    parser.add_argument(
+        "--size-mb",
+        type=int,
+        help="Size of every synthetic binary (default: 16)",
+        default=16,
+    )
+    parser.add_argument(
+        "--sdk-files",
+        type=int,
+        help="Files in the synthetic gcloud SDK (default: 2000)",
+        default=2000,
+    )
+    parser.add_argument(
+        "--ansible-roles",
+        type=int,
+        help="Roles in the synthetic ansible repo (default: 200)",
+        default=200,
+    )
+    parser.add_argument(
+        "-j", "--jobs",
+        type=int,
+        help="install.py --jobs (default: 4)",
+        default=4,
+    )
+    parser.add_argument(
+        "--results",
+        help="JSONL file with results (default: {})".format(
+            DEFAULT_RESULTS.relative_to(REPO_DIR)),
+        default=str(DEFAULT_RESULTS),
+    )
+    parser.add_argument(
+        "--keep",
+        action='store_true',
+        help="Keep the temporary dir with workdirs and artifacts",
+        default=False,
+    )
+    args = parser.parse_args()
+    for dependency in ('git', 'virtualenv'):
+        if not shutil.which(dependency):
+            print("No '{}' in PATH".format(dependency))
+            sys.exit(1)
+
+    tmp = Path(tempfile.mkdtemp(prefix='install-bench-'))
+    try:
+        print("Prepare artifacts in {}".format(tmp))
+        artifacts = tmp / 'artifacts'
+        for tool, (ver, bump_ver, _, _) in TOOLS.items():
+            for version in {ver, bump_ver}:
+                make_artifact(
+                    artifacts, tool, version, args.size_mb * 1024 * 1024, args.sdk_files,
+                )
+        repos = make_repos(tmp / 'repos', args.ansible_roles)
+        server = ArtifactServer(artifacts)
+        server.start()
+        print("Artifact server: {}".format(server.url))
+        runs = run_scenarios(args, server, repos, tmp)
+        server.shutdown()
+    finally:
+        if args.keep:
+            print("Kept {}".format(tmp))
+        else:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    params = {
+        'repeat': args.repeat,
+        'size_mb': args.size_mb,
+        'sdk_files': args.sdk_files,
+        'ansible_roles': args.ansible_roles,
+        'jobs': args.jobs,
+    }
+    results_path = Path(args.results)
+    previous = load_previous(results_path, params)
+    record = {
+        'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'commit': _git_commit(),
+        'python': platform.python_version(),
+        'host': platform.node(),
+        'params': params,
+        'scenarios': summarize(runs),
+    }
+    print_summary(record['scenarios'], previous)
+    results_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(results_path, 'a') as f:
+        f.write(json.dumps(record) + '\n')
+    print("Results saved to {}".format(results_path))
+
+
+if __name__ == "__main__":
+    main()
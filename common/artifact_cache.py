@@ -0,0 +1,305 @@
+import fcntl
+import hashlib
+import http.client
+import json
+import os
+import shutil
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Optional
+from common.logger import logger
+from common.download_file import (
+    Downloader,
+    DownloadError,
+    download_file,
+    format_size,
+    get_downloader,
+)
+
+
+class ArtifactCache:
+    """Persistent download cache, shared by all toolboxes of the user.
+
+    Layout:
+        index.json         url -> {sha256, size, etag, last_modified, checked, accessed}
+        blobs/<sha256>     downloaded content, stored once per sha256
+        tmp/               in-progress downloads
+
+    Entries older than `revalidate_after` seconds are revalidated with a
+    conditional request (ETag / Last-Modified). When the cache grows over
+    `max_size` bytes the least recently used blobs are removed, except the
+    ones fetch() returned in this process and not release()d yet, or which
+    other install.py processes accessed in the last IN_USE_SECONDS: their
+    callers may not have opened them yet.
+    """
+
+    IN_USE_SECONDS = 600
+
+    def __init__(
+            self,
+            root: Path,
+            max_size: int,
+            revalidate_after: int,
+            downloader: Optional[Downloader] = None,
+        ):
+        self.root = Path(root)
+        self.blobs = self.root / 'blobs'
+        self.tmp = self.root / 'tmp'
+        self.index_path = self.root / 'index.json'
+        self.lock_path = self.root / '.lock'
+        self.max_size = max_size
+        self.revalidate_after = revalidate_after
+        self.downloader = downloader or get_downloader()
+        self._url_locks: dict[str, threading.Lock] = {}
+        self._url_locks_lock = threading.Lock()
+        self._index_lock = threading.Lock()
+        # sha256 of the blobs fetch() returned -> number of callers using them
+        self._in_use: dict[str, int] = {}
+        self.blobs.mkdir(parents=True, exist_ok=True)
+        self.tmp.mkdir(exist_ok=True)
+
+    def fetch(
+            self,
+            url: str,
+            proxies: Optional[dict] = None,
+            stats: Optional[dict] = None,
+        ) -> Path:
+        """Returns path to cached content of url, downloads it if needed.
+
+        The returned file is shared, it must not be modified. evict() keeps
+        it until the caller opened or copied it and called release(). `stats`
+        gets 'bytes' (downloaded) and 'cached' (served from the cache).
+        """
+        if stats is None:
+            stats = {}
+        stats['bytes'] = 0
+        stats['cached'] = True
+        held = []
+        try:
+            with self._url_lock(url):
+                blob = self._fetch(url, proxies, stats, held)
+        except BaseException:
+            for sha256 in held:
+                self.release(self.blobs / sha256)
+            raise
+        # One hold is for the caller
+        held.remove(blob.name)
+        for sha256 in held:
+            self.release(self.blobs / sha256)
+        return blob
+
+    def _fetch(self, url: str, proxies: Optional[dict], stats: dict, held: list) -> Path:
+        entry = self._get_entry(url)
+        blob = self.blobs / entry['sha256'] if entry else None
+        if blob:
+            # Before the check, so evict() can't remove it after it
+            self._hold(blob.name, held)
+        if blob and not blob.exists():
+            entry, blob = None, None
+
+        if entry and blob and time.time() - entry.get('checked', 0) < self.revalidate_after:
+            logger.debug("Cache hit {}".format(url))
+            self._touch(url)
+            return blob
+
+        headers = {}
+        if entry:
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified'):
+                headers['If-Modified-Since'] = entry['last_modified']
+
+        # Stable name, so an interrupted download is resumed next time
+        tmp_path = self.tmp / "{}-{}".format(
+            self._url_key(url), url.rsplit('/', 1)[-1],
+        )
+        try:
+            result = self.downloader.fetch(url, tmp_path, proxies, headers)
+        except Exception:
+            if tmp_path.exists():
+                os.remove(tmp_path)
+            if blob:
+                logger.warning("Can't revalidate {}, use cached copy".format(url))
+                self._touch(url)
+                return blob
+            raise
+
+        if result.not_modified and blob:
+            logger.debug("Cache revalidated {}".format(url))
+            self._update_entry(url, checked=time.time())
+            return blob
+
+        stats['bytes'] = result.size
+        stats['cached'] = False
+        blob = self.blobs / result.sha256
+        self._hold(result.sha256, held)
+        if blob.exists():
+            os.remove(tmp_path)
+        else:
+            os.chmod(tmp_path, 0o444)
+            os.replace(tmp_path, blob)
+        now = time.time()
+        self._set_entry(url, {
+            'sha256': result.sha256,
+            'size': result.size,
+            'etag': result.etag,
+            'last_modified': result.last_modified,
+            'checked': now,
+            'accessed': now,
+        })
+        self.evict()
+        return blob
+
+    def copy_to(
+            self,
+            url: str,
+            save_to,
+            proxies: Optional[dict] = None,
+            stats: Optional[dict] = None,
+        ) -> Path:
+        blob = self.fetch(url, proxies, stats)
+        try:
+            save_to = Path(save_to)
+            tmp_path = save_to.with_name(save_to.name + '.tmp')
+            shutil.copyfile(blob, tmp_path)
+            os.replace(tmp_path, save_to)
+        finally:
+            self.release(blob)
+        return save_to
+
+    def release(self, blob: Path):
+        """The caller of fetch() doesn't need the blob any more"""
+        with self._index_lock:
+            count = self._in_use.get(blob.name, 0) - 1
+            if count > 0:
+                self._in_use[blob.name] = count
+            else:
+                self._in_use.pop(blob.name, None)
+
+    def _hold(self, sha256: str, held: list):
+        with self._index_lock:
+            self._in_use[sha256] = self._in_use.get(sha256, 0) + 1
+        held.append(sha256)
+
+    def evict(self):
+        """Remove least recently used blobs until the cache fits max_size"""
+        with self._locked_index() as index:
+            blobs = {}
+            for url, entry in index.items():
+                sha = entry['sha256']
+                accessed = max(entry.get('accessed', 0), blobs.get(sha, (0, 0))[0])
+                blobs[sha] = (accessed, entry.get('size', 0))
+            total = sum(size for _, size in blobs.values())
+            if total <= self.max_size:
+                return
+            evicted = set()
+            in_use_after = time.time() - self.IN_USE_SECONDS
+            for sha, (accessed, size) in sorted(blobs.items(), key=lambda x: x[1][0]):
+                if total <= self.max_size:
+                    break
+                if sha in self._in_use or accessed > in_use_after:
+                    continue
+                blob = self.blobs / sha
+                if blob.exists():
+                    os.remove(blob)
+                evicted.add(sha)
+                total -= size
+                logger.debug("Cache evict {} ({})".format(sha, format_size(size)))
+            for url in [u for u, e in index.items() if e['sha256'] in evicted]:
+                del index[url]
+
+    def _url_key(self, url: str) -> str:
+        return hashlib.sha256(url.encode()).hexdigest()[:16]
+
+    @contextmanager
+    def _url_lock(self, url: str):
+        # One download of url at a time, in this and in other processes
+        with self._url_locks_lock:
+            thread_lock = self._url_locks.setdefault(url, threading.Lock())
+        with thread_lock, open(self.tmp / "{}.lock".format(self._url_key(url)), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    @contextmanager
+    def _locked_index(self):
+        # Thread lock for this process, flock for other install.py processes
+        with self._index_lock, open(self.lock_path, 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                index = self._read_index()
+                yield index
+                tmp_index = self.index_path.with_suffix('.tmp')
+                with open(tmp_index, 'w') as f:
+                    json.dump(index, f, indent=1)
+                os.replace(tmp_index, self.index_path)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _read_index(self) -> dict:
+        if not self.index_path.exists():
+            return {}
+        try:
+            with open(self.index_path, 'r') as f:
+                return json.load(f)
+        except json.decoder.JSONDecodeError:
+            logger.warning("Artifact cache index is broken, reset {}".format(self.index_path))
+            return {}
+
+    def _get_entry(self, url: str) -> Optional[dict]:
+        with self._index_lock:
+            return self._read_index().get(url)
+
+    def _set_entry(self, url: str, entry: dict):
+        with self._locked_index() as index:
+            index[url] = entry
+
+    def _update_entry(self, url: str, **fields):
+        with self._locked_index() as index:
+            if url in index:
+                index[url].update(fields)
+                index[url]['accessed'] = time.time()
+
+    def _touch(self, url: str):
+        self._update_entry(url)
+
+
+_caches: dict[Path, ArtifactCache] = {}
+_caches_lock = threading.Lock()
+
+
+def get_artifact_cache(config) -> Optional[ArtifactCache]:
+    """One ArtifactCache per cache dir; None if the cache is disabled"""
+    if not config.cache_enabled:
+        return None
+    root = Path(config.cache_path) / 'artifacts'
+    with _caches_lock:
+        if root not in _caches:
+            _caches[root] = ArtifactCache(
+                root,
+                max_size=int(config.cache_max_size_mb) * 1024 * 1024,
+                revalidate_after=int(config.cache_revalidate_after_hours) * 3600,
+            )
+        return _caches[root]
+
+
+def download_artifact(url, save_to, config) -> bool:
+    """Like download_file(), but looks into the artifact cache first"""
+    cache = get_artifact_cache(config)
+    with config.workdir.report.phase("download") as record:
+        if not cache:
+            ok = download_file(url, save_to, config.proxies)
+            if ok:
+                record['bytes'] = os.path.getsize(save_to)
+            return ok
+        try:
+            cache.copy_to(url, save_to, config.proxies, record)
+            return True
+        except (DownloadError, OSError, http.client.HTTPException) as exc:
+            logger.error("Error while download {}".format(url))
+            logger.error(exc)
+            return False
@@ -0,0 +1,302 @@
+import fnmatch
+import io
+import json
+import os
+import platform
+import shutil
+import sys
+import tarfile
+import tempfile
+import time
+from pathlib import Path
+from common import git
+from common.logger import logger
+from common.manifest import InstallManifest, file_sha256
+
+
+BUNDLE_FORMAT = 1
+BUNDLE_MANIFEST = 'bundle.json'
+# Workdir root in the paths and files of the bundle
+ROOT_PLACEHOLDER = '@@ADMIN_TOOLBOX_ROOT@@'
+
+# Not portable or secret: temp files, caches, tokens, credentials, state of
+# running processes. Patterns are relative to the workdir root
+EXCLUDE = (
+    'tmp',
+    'pip-cache',
+    '.report.json',
+    '.profile.pstats',
+    '.info',
+    'vault_token',
+    'vault_token.meta',
+    'vault/env-*.sh',
+    'ssh/agent.pid',
+    'ssh/hosts.index*',
+    'kube/*',
+    'argocd.cfg',
+    'gcloud/cfg/*.db',
+    'gcloud/cfg/legacy_credentials',
+    'gcloud/cfg/logs',
+    'gcloud/cfg/credentials*',
+    'gcloud/cfg/access_tokens*',
+)
+
+
+class BundleError(Exception):
+    pass
+
+
+def export_bundle(root: Path, bundle_path: Path, toolbox_name: str):
+    """Packs the installed workdir into a tar.gz bundle.
+
+    Text files with the workdir path (activate, configs, venv scripts,
+    pyvenv.cfg, ...) and symlinks into the workdir get ROOT_PLACEHOLDER
+    instead of it, they are listed in bundle.json as `rewrite`. The workdir
+    itself is not changed.
+    """
+    root = Path(root)
+    root_bytes = str(root).encode()
+    bundle_path = Path(bundle_path).expanduser().resolve()
+    with tempfile.TemporaryDirectory(prefix='.bundle-', dir=bundle_path.parent) as staging:
+        paths = _bundle_paths(root, _dissociated_git_dirs(root, Path(staging)))
+        rewrite = sorted(
+            name for path, name in paths
+            if not path.is_symlink() and path.is_file() and _has_root_path(path, root_bytes)
+        )
+        manifest = {
+            'format': BUNDLE_FORMAT,
+            'toolbox_name': toolbox_name,
+            'root': str(root),
+            'created': int(time.time()),
+            'platform': sys.platform,
+            'machine': platform.machine(),
+            'rewrite': rewrite,
+        }
+        rewrite = set(rewrite)
+        tmp_path = bundle_path.with_name(bundle_path.name + '.tmp')
+        with tarfile.open(tmp_path, 'w:gz', format=tarfile.PAX_FORMAT) as tf:
+            _add_bytes(tf, BUNDLE_MANIFEST, json.dumps(manifest, indent=1).encode(), 0o644)
+            for path, name in paths:
+                arcname = 'root/{}'.format(name)
+                info = tf.gettarinfo(str(path), arcname)
+                if name in rewrite:
+                    # Text files, one of them at a time is in memory
+                    with open(path, 'rb') as f:
+                        data = f.read().replace(root_bytes, ROOT_PLACEHOLDER.encode())
+                    # Not a hardlink to a file added before, it has the content
+                    info.type = tarfile.REGTYPE
+                    info.linkname = ''
+                    info.size = len(data)
+                    tf.addfile(info, io.BytesIO(data))
+                    continue
+                if info.issym() and info.linkname.startswith(str(root)):
+                    info.linkname = ROOT_PLACEHOLDER + info.linkname[len(str(root)):]
+                if info.isreg():
+                    with open(path, 'rb') as f:
+                        tf.addfile(info, f)
+                else:
+                    tf.addfile(info)
+        os.replace(tmp_path, bundle_path)
+    logger.info("Bundle saved to {} ({} files, {} rewritten)".format(
+        bundle_path, len(paths), len(rewrite),
+    ))
+
+
+def import_bundle(bundle_path: Path, root: Path) -> dict:
+    """Unpacks the bundle to the workdir root, which must not exist or be
+    empty, and puts the root path in place of ROOT_PLACEHOLDER. Returns
+    bundle.json"""
+    root = Path(root)
+    if root.exists() and any(root.iterdir()):
+        raise BundleError("{} is not empty".format(root))
+    staging = root.with_name(root.name + '.import')
+    if staging.exists():
+        shutil.rmtree(staging)
+    staging.mkdir(parents=True)
+    root_bytes = str(root).encode()
+    with tarfile.open(Path(bundle_path).expanduser(), 'r:gz') as tf:
+        first = tf.next()
+        if first is None or first.name != BUNDLE_MANIFEST:
+            raise BundleError("{} is not a toolbox bundle".format(bundle_path))
+        manifest = json.load(tf.extractfile(first))
+        _check_manifest(manifest)
+        rewrite = set(manifest['rewrite'])
+        for info in tf:
+            if not info.name.startswith('root/'):
+                continue
+            name = info.name[len('root/'):]
+            if os.path.isabs(name) or '..' in Path(name).parts:
+                raise BundleError("Bad path in bundle: {}".format(info.name))
+            info.name = name
+            if info.islnk():
+                info.linkname = info.linkname[len('root/'):]
+            if info.issym() and info.linkname.startswith(ROOT_PLACEHOLDER):
+                info.linkname = str(root) + info.linkname[len(ROOT_PLACEHOLDER):]
+            if name in rewrite:
+                data = tf.extractfile(info).read()
+                data = data.replace(ROOT_PLACEHOLDER.encode(), root_bytes)
+                _extract_bytes(info, data, staging)
+                continue
+            if not hasattr(tarfile, 'data_filter'):
+                tf.extract(info, staging)
+                continue
+            # Venv symlinks point to the system python, the data filter
+            # doesn't allow absolute symlinks
+            if not info.issym():
+                info = tarfile.data_filter(info, str(staging))
+            tf.extract(info, staging, filter='fully_trusted')
+    if root.exists():
+        root.rmdir()
+    os.rename(staging, root)
+    _fix_manifest(root)
+    _fix_gcloud_files(root)
+    _check_venvs(root)
+    return manifest
+
+
+def _dissociated_git_dirs(root: Path, staging: Path) -> dict:
+    """Objects of `--reference` clones are not in the workdir. Returns
+    {.git dir of such a clone: its copy in staging with all the objects}"""
+    copies = {}
+    for dirpath, dirnames, _ in os.walk(root):
+        if '.git' not in dirnames:
+            continue
+        dirnames.remove('.git')
+        git_dir = Path(dirpath) / '.git'
+        if not (git_dir / 'objects/info/alternates').exists():
+            continue
+        logger.info("Copy borrowed git objects of {}".format(dirpath))
+        copy = staging / str(len(copies))
+        shutil.copytree(git_dir, copy, symlinks=True)
+        git.git(['--git-dir', copy, 'repack', '-a', '-d', '-q'])
+        os.remove(copy / 'objects/info/alternates')
+        copies[git_dir] = copy
+    return copies
+
+
+def _bundle_paths(root: Path, git_copies: dict) -> list:
+    """[(path to read, name in the bundle)], .git dirs of git_copies are
+    read from the copies"""
+    paths = []
+    for path in _walk(root):
+        if any(path == git_dir or git_dir in path.parents for git_dir in git_copies):
+            continue
+        paths.append((path, str(path.relative_to(root))))
+    for git_dir, copy in git_copies.items():
+        name = str(git_dir.relative_to(root))
+        paths.append((copy, name))
+        for path in _walk(copy):
+            paths.append((path, os.path.join(name, str(path.relative_to(copy)))))
+    return paths
+
+
+def _has_root_path(path: Path, root_bytes: bytes) -> bool:
+    """Text file with the workdir path; binary files (bytecode, ...) are left
+    as is. Read in chunks, binaries are usually told by their first chunk"""
+    found = False
+    tail = b''
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            if b'\0' in chunk:
+                return False
+            found = found or root_bytes in tail + chunk
+            tail = chunk[-len(root_bytes):]
+    return found
+
+
+def _walk(root: Path):
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirpath = Path(dirpath)
+        kept = []
+        for name in sorted(dirnames):
+            if _excluded(root, dirpath / name):
+                continue
+            kept.append(name)
+            yield dirpath / name
+        # Symlinks to dirs are added as symlinks, os.walk doesn't follow them
+        dirnames[:] = [name for name in kept if not (dirpath / name).is_symlink()]
+        for name in sorted(filenames):
+            path = dirpath / name
+            if _excluded(root, path):
+                continue
+            # Sockets, fifos
+            if not path.is_symlink() and not path.is_file():
+                continue
+            yield path
+
+
+def _excluded(root: Path, path: Path) -> bool:
+    name = str(path.relative_to(root))
+    return any(fnmatch.fnmatch(name, pattern) for pattern in EXCLUDE)
+
+
+def _add_bytes(tf: tarfile.TarFile, name: str, data: bytes, mode: int):
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    info.mode = mode
+    info.mtime = int(time.time())
+    tf.addfile(info, io.BytesIO(data))
+
+
+def _extract_bytes(info: tarfile.TarInfo, data: bytes, dest_dir: Path):
+    target = dest_dir / info.name
+    target.parent.mkdir(parents=True, exist_ok=True)
+    with open(target, 'wb') as f:
+        f.write(data)
+    os.chmod(target, info.mode & 0o777)
+    os.utime(target, (info.mtime, info.mtime))
+
+
+def _check_manifest(manifest: dict):
+    if manifest.get('format') != BUNDLE_FORMAT:
+        raise BundleError("Unknown bundle format {}".format(manifest.get('format')))
+    here = (sys.platform, platform.machine())
+    built = (manifest.get('platform'), manifest.get('machine'))
+    if here != built:
+        raise BundleError("Bundle is built for {}/{}, this host is {}/{}".format(*built, *here))
+
+
+def _fix_manifest(root: Path):
+    """Tar keeps mtime with less precision, binaries would look changed"""
+    manifest = InstallManifest(root / '.manifest.json', root)
+    for name, entry in list(manifest.entries.items()):
+        path = Path(entry['path'])
+        if not path.is_absolute():
+            path = root / path
+        if path.exists() and file_sha256(path) == entry['sha256']:
+            manifest.record(name, entry['version'], path)
+
+
+def _fix_gcloud_files(root: Path):
+    for files_path in (root / 'gcloud').glob('sdk-*.files.json'):
+        tree = files_path.with_name(files_path.name[:-len('.files.json')])
+        with open(files_path, 'r') as f:
+            files = json.load(f)
+        for name, entry in files.items():
+            try:
+                stat = os.lstat(tree / name)
+            except FileNotFoundError:
+                continue
+            if stat.st_size == entry['size']:
+                entry['mtime'] = stat.st_mtime_ns
+        tmp_path = files_path.with_name(files_path.name + '.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(files, f)
+        os.replace(tmp_path, files_path)
+
+
+def _check_venvs(root: Path):
+    """Venvs are kept if python3 of this host is the interpreter they were made with"""
+    from installers.python_venv import base_interpreter, same_interpreter, venv_interpreter
+    base = base_interpreter()
+    for fingerprint_path in root.glob('**/.fingerprint.json'):
+        venv_path = fingerprint_path.parent
+        venv = venv_interpreter(venv_path)
+        if not same_interpreter(venv, base):
+            logger.warning(
+                "Venv {} is made with python {} {}, python3 here is {} {}. "
+                "install.py will create it again".format(
+                    venv_path, venv['executable'], venv['version'],
+                    base.get('executable'), base.get('version'),
+                )
+            )
@@ -4,12 +4,13 @@ import os
 import json
 import platform
 from pathlib import Path
-from common.singleton import Singleton
+from common.git import CLONE_MODES
 from typing import Optional
 from common.logger import logger
 
 
-class Config(metaclass=Singleton):
+class Config:
+    """Settings of one toolbox: config file, workdir and name"""
 
     def  __init__(
             self,
@@ -22,9 +23,6 @@ class Config(metaclass=Singleton):
         self.toolbox_name = toolbox_name
         self.config_path = Path(config_path).expanduser().resolve()
 
-        if not toolbox_repo_dir:
-            return
-
         self.home = os.environ.get('HOME')
         self.workdir = workdir
 
@@ -46,6 +44,10 @@ class Config(metaclass=Singleton):
         self.vault_addr = ""
         self.vault_ver = ""
         self.vault_url = ""
+        self.vault_download_url = ""
+        self.vault_login_method = "userpass"
+        self.vault_load_env_vars = {}
+        self.vault_load_env_vars_ttl = 3600
 
         self.terraform_enabled = False
         self.terraform_ver = ""
@@ -68,9 +70,16 @@ class Config(metaclass=Singleton):
         self.gcloud_enabled = False
         self.gcloud_ver = ""
         self.gcloud_url = ""
+        self.gcloud_components = ['gke-gcloud-auth-plugin']
 
         self.proxies = {'http': '', 'https': ''}
 
+        # Download cache, shared between toolboxes
+        self.cache_enabled = True
+        self.cache_path = Path('~/.cache/admin-toolbox').expanduser()
+        self.cache_max_size_mb = 2048
+        self.cache_revalidate_after_hours = 24
+
         self.ansible_enabled = False
         self.ansible_repo_url = ""
         self.ansible_repo_path: Path = Path()
@@ -80,8 +89,20 @@ class Config(metaclass=Singleton):
         self.ansible_cfg_path = ""
         self.ansible_use_ssh_agent = False
         self.ansible_use_venv_for_localhost_delegation = False
+        self.ansible_repo_branch = ""
+        self.ansible_repo_update = True
+        self.ansible_clone_mode = "full"
+        self.ansible_clone_depth = 1
+        self.ansible_clone_sparse_paths = []
+        self.ansible_clone_reference = ""
+
+        self.helm_enabled = False
+        self.helm_ver = ""
+        self.helm_url = ""
 
         self.argocd_enabled = False
+        self.argocd_ver = ""
+        self.argocd_url = ""
 
         self.gron_enabled = False
         self.gron_repo_url = ""
@@ -91,6 +112,10 @@ class Config(metaclass=Singleton):
         self.ssh_load_keys_from_host = ""
         self.ssh_enable_autocomplete_from_ansible = False
 
+        # Lazy activate: only exports and aliases, vault env vars and
+        # ssh-agent are set up by shims on the first call in a session
+        self.activate_lazy = False
+
         self._parse_config()
 
         self.ansible_repo_cfg_path = ""
@@ -99,6 +124,7 @@ class Config(metaclass=Singleton):
             ansible_repo_cfg_path = Path(self.ansible_repo_path) / "ansible.cfg"
             if ansible_repo_cfg_path.exists():
                 self.ansible_repo_cfg_path = ansible_repo_cfg_path
+        _configs.append(self)
 
 
     def configure_python(self, config: dict):
@@ -129,6 +155,10 @@ class Config(metaclass=Singleton):
         self.vault_addr = section_cfg.get('addr', "")
         self.vault_login_method = section_cfg.get('login_method', "userpass")
         self.vault_load_env_vars = section_cfg.get('load_env_vars', {})
+        self.vault_load_env_vars_ttl = int(section_cfg.get(
+            'load_env_vars_ttl',
+            self.vault_load_env_vars_ttl,
+        ))
 
     def configure_terraform(self, config: dict):
         section_name = "terraform"
@@ -171,6 +201,7 @@ class Config(metaclass=Singleton):
         self.gcloud_enabled = True
         self.gcloud_ver = section_cfg.get("version", "")
         self.gcloud_url = section_cfg.get("download_url", "")
+        self.gcloud_components = section_cfg.get("components", self.gcloud_components)
 
     def configure_k9s(self, config: dict):
         section_name = "k9s"
@@ -257,6 +288,21 @@ class Config(metaclass=Singleton):
         ansible_repo_path = section_cfg.get("repo_path", "")
         if ansible_repo_path:
             self.ansible_repo_path = Path(ansible_repo_path).expanduser().resolve()
+        self.ansible_repo_branch = section_cfg.get("repo_branch", self.ansible_repo_branch)
+        self.ansible_repo_update = section_cfg.get("repo_update", self.ansible_repo_update)
+        self.ansible_clone_mode = section_cfg.get("clone_mode", self.ansible_clone_mode)
+        if self.ansible_clone_mode not in CLONE_MODES:
+            logger.error("ansible.clone_mode must be one of: {}".format(', '.join(CLONE_MODES)))
+            sys.exit(1)
+        self.ansible_clone_depth = int(section_cfg.get("clone_depth", self.ansible_clone_depth))
+        self.ansible_clone_sparse_paths = section_cfg.get(
+            "clone_sparse_paths",
+            self.ansible_clone_sparse_paths,
+        )
+        self.ansible_clone_reference = section_cfg.get(
+            "clone_reference",
+            self.ansible_clone_reference,
+        )
 
 
     def configure_proxy(self, config: dict):
@@ -271,6 +317,22 @@ class Config(metaclass=Singleton):
         self.proxies['http'] = section_cfg.get('http_addr', '')
         self.proxies['https'] = section_cfg.get('https_addr', '')
 
+    def configure_cache(self, config: dict):
+        section_name = "cache"
+        section_cfg = config.get(section_name, {})
+        if not section_cfg:
+            logger.debug("No {n} in config or {n} is empty, use defaults".format(n=section_name))
+            return
+        self.cache_enabled = section_cfg.get("enabled", self.cache_enabled)
+        cache_path = section_cfg.get("path", "")
+        if cache_path:
+            self.cache_path = Path(cache_path).expanduser().resolve()
+        self.cache_max_size_mb = section_cfg.get("max_size_mb", self.cache_max_size_mb)
+        self.cache_revalidate_after_hours = section_cfg.get(
+            "revalidate_after_hours",
+            self.cache_revalidate_after_hours,
+        )
+
     def configure_ssh(self, config: dict):
         section_name = "ssh"
         section_cfg = config.get(section_name, {})
@@ -287,6 +349,14 @@ class Config(metaclass=Singleton):
 
 
 
+    def configure_activate(self, config: dict):
+        section_name = "activate"
+        section_cfg = config.get(section_name, {})
+        if not section_cfg:
+            logger.debug("No {n} in config or {n} is empty, use defaults".format(n=section_name))
+            return
+        self.activate_lazy = section_cfg.get("lazy", self.activate_lazy)
+
     def _parse_config(self):
         config: dict = self._load_from_file()
         self.configure_python(config)
@@ -301,7 +371,9 @@ class Config(metaclass=Singleton):
         self.configure_argocd(config)
         self.configure_ansible(config)
         self.configure_proxy(config)
+        self.configure_cache(config)
         self.configure_ssh(config)
+        self.configure_activate(config)
 
 
     def _load_from_file(self) -> dict:
@@ -330,5 +402,14 @@ class Config(metaclass=Singleton):
             f.write(str(self.ansible_repo_path))
 
 
-def get_config():
-    return Config(None, None, None)
+_configs: list[Config] = []
+
+
+def get_config() -> Config:
+    """Config of the only toolbox of the process. Installers of several
+    toolboxes (--fleet) get their Config as an argument"""
+    if len(_configs) != 1:
+        raise RuntimeError(
+            "{} toolbox configs in the process, pass config explicitly".format(len(_configs))
+        )
+    return _configs[0]
@@ -1,25 +1,534 @@
-import subprocess
+import base64
+import hashlib
+import http.client
+import json
+import os
+import socket
+import ssl
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Optional
+from urllib.parse import urlsplit, urljoin, unquote
 from common.logger import logger
 
+
+USER_AGENT = "admin-toolbox"
+REDIRECT_CODES = (301, 302, 303, 307, 308)
+
+
+class DownloadError(Exception):
+    pass
+
+
+def _pick_proxy(proxies: Optional[dict]) -> str:
+    # Same order as `curl -x` used before: https proxy wins over http proxy
+    if not proxies:
+        return ""
+    proxy = proxies.get('https') or proxies.get('http') or ""
+    if proxy and '://' not in proxy:
+        proxy = "http://{}".format(proxy)
+    return proxy
+
+
+def format_size(size: float) -> str:
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if size < 1024 or unit == 'GB':
+            return "{:.1f} {}".format(size, unit)
+        size /= 1024
+    return str(size)
+
+
+class ConnectionPool:
+    """Keep-alive HTTP(S) connections, kept per (scheme, host, port, proxy)."""
+
+    def __init__(self, max_idle_per_host: int = 4, timeout: int = 60):
+        self.max_idle_per_host = max_idle_per_host
+        self.timeout = timeout
+        self._idle: dict[tuple, list] = {}
+        self._lock = threading.Lock()
+        self._ssl_context = ssl.create_default_context()
+
+    def get(self, key: tuple):
+        with self._lock:
+            conns = self._idle.get(key)
+            if conns:
+                return conns.pop(), True
+        return self.connect(key), False
+
+    def put(self, key: tuple, conn):
+        with self._lock:
+            conns = self._idle.setdefault(key, [])
+            if len(conns) < self.max_idle_per_host:
+                conns.append(conn)
+                return
+        conn.close()
+
+    def close(self):
+        with self._lock:
+            for conns in self._idle.values():
+                for conn in conns:
+                    conn.close()
+            self._idle = {}
+
+    def connect(self, key: tuple):
+        scheme, host, port, proxy = key
+        if not proxy:
+            if scheme == 'https':
+                return http.client.HTTPSConnection(
+                    host, port, timeout=self.timeout, context=self._ssl_context,
+                )
+            return http.client.HTTPConnection(host, port, timeout=self.timeout)
+
+        proxy_url = urlsplit(proxy)
+        proxy_headers = {}
+        if proxy_url.username:
+            creds = "{}:{}".format(
+                unquote(proxy_url.username), unquote(proxy_url.password or ""),
+            )
+            proxy_headers['Proxy-Authorization'] = "Basic {}".format(
+                base64.b64encode(creds.encode()).decode()
+            )
+        if scheme == 'https':
+            # CONNECT tunnel through the proxy, TLS to the target host
+            conn = http.client.HTTPSConnection(
+                proxy_url.hostname, proxy_url.port or 80,
+                timeout=self.timeout, context=self._ssl_context,
+            )
+            conn.set_tunnel(host, port, headers=proxy_headers)
+            return conn
+        conn = http.client.HTTPConnection(
+            proxy_url.hostname, proxy_url.port or 80, timeout=self.timeout,
+        )
+        conn.proxy_headers = proxy_headers
+        return conn
+
+
+class DownloadResult:
+    def __init__(
+            self,
+            url: str,
+            path: Path,
+            size: int,
+            elapsed: float,
+            status: int = 200,
+            sha256: str = "",
+            etag: str = "",
+            last_modified: str = "",
+        ):
+        self.url = url
+        self.path = path
+        self.size = size
+        self.elapsed = elapsed
+        self.status = status
+        self.sha256 = sha256
+        self.etag = etag
+        self.last_modified = last_modified
+
+    @property
+    def not_modified(self) -> bool:
+        return self.status == 304
+
+    @property
+    def speed(self) -> float:
+        """bytes/sec"""
+        if self.elapsed <= 0:
+            return 0.0
+        return self.size / self.elapsed
+
+
+class _TransientError(Exception):
+    pass
+
+
+TRANSIENT_ERRORS = (
+    _TransientError,
+    ConnectionError,
+    TimeoutError,
+    socket.timeout,
+    http.client.IncompleteRead,
+    http.client.RemoteDisconnected,
+)
+
+
+class Downloader:
+    """Downloads files in-process through a shared keep-alive connection pool.
+
+    Data goes to `<save_to>.part` and is renamed into place when complete.
+    An interrupted download is resumed with a Range request (guarded by
+    If-Range). Big files from servers with range support are split into
+    segments fetched in parallel.
+
+    fetch() is thread-safe. Artifacts are fetched concurrently by the tasks of
+    the install Scheduler (`-j`, and the toolboxes of `--fleet`), which share
+    get_downloader() and so its pooled connections.
+    """
+
+    def __init__(self, pool: Optional[ConnectionPool] = None, chunk_size: int = 1 << 16):
+        self.pool = pool or ConnectionPool()
+        self.chunk_size = chunk_size
+        self.max_redirects = 10
+        self.progress_interval = 5
+        self.retries = 5
+        self.segments = 4
+        self.segment_min_size = 32 * 1024 * 1024
+        # Progress of segments is saved after every this many bytes
+        self.state_save_interval = 4 * 1024 * 1024
+
+    def open(
+            self,
+            url: str,
+            proxies: Optional[dict] = None,
+            headers: Optional[dict] = None,
+            method: str = 'GET',
+        ):
+        """Send request (following redirects), returns (key, conn, response, final_url).
+
+        Caller must read the response to the end and give the connection
+        back with `release()`, or close it.
+        """
+        proxy = _pick_proxy(proxies)
+        for _ in range(self.max_redirects + 1):
+            key, conn, resp = self._request(method, url, proxy, headers or {})
+            if resp.status not in REDIRECT_CODES:
+                return key, conn, resp, url
+            location = resp.getheader('Location')
+            resp.read()
+            self.release(key, conn, resp)
+            if not location:
+                raise DownloadError("Redirect without Location from {}".format(url))
+            url = urljoin(url, location)
+            logger.debug("Redirect -> {}".format(url))
+        raise DownloadError("Too many redirects for {}".format(url))
+
+    def release(self, key: tuple, conn, resp):
+        if resp.will_close:
+            conn.close()
+        else:
+            self.pool.put(key, conn)
+
+    def fetch(
+            self,
+            url: str,
+            save_to,
+            proxies: Optional[dict] = None,
+            headers: Optional[dict] = None,
+        ) -> DownloadResult:
+        """Download url to save_to.
+
+        With conditional `headers` (If-None-Match, If-Modified-Since) the
+        server may answer 304, then nothing is written and the result has
+        `not_modified` set.
+        """
+        save_to = Path(save_to)
+        part = save_to.with_name(save_to.name + '.part')
+        started = time.monotonic()
+        for attempt in range(self.retries + 1):
+            try:
+                status, etag, last_modified = self._fetch_part(url, part, proxies, headers)
+                break
+            except TRANSIENT_ERRORS as exc:
+                if attempt == self.retries:
+                    raise DownloadError("Download {} failed: {}".format(url, exc))
+                delay = min(2 ** attempt, 30)
+                logger.warning("Download {} interrupted ({}), resume in {}s".format(
+                    url, exc or exc.__class__.__name__, delay,
+                ))
+                time.sleep(delay)
+        if status == 304:
+            return DownloadResult(url, save_to, 0, time.monotonic() - started, status=304)
+
+        sha256 = hashlib.sha256()
+        with open(part, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                sha256.update(chunk)
+        size = part.stat().st_size
+        os.replace(part, save_to)
+        self._state_path(part).unlink(missing_ok=True)
+        result = DownloadResult(
+            url, save_to, size, time.monotonic() - started,
+            sha256=sha256.hexdigest(),
+            etag=etag,
+            last_modified=last_modified,
+        )
+        logger.info("Downloaded {} ({} in {:.1f}s, {}/s)".format(
+            url, format_size(result.size), result.elapsed, format_size(result.speed),
+        ))
+        return result
+
+    def _fetch_part(self, url: str, part: Path, proxies, headers) -> tuple[int, str, str]:
+        """Fill `part` with the content of url, returns (status, etag, last_modified)"""
+        state = self._load_state(part, url)
+        if state.get('segments'):
+            self._fetch_segments(part, state, proxies)
+            return 200, state['etag'], state['last_modified']
+
+        req_headers = dict(headers or {})
+        offset = 0
+        if state.get('validator') and part.exists():
+            offset = part.stat().st_size
+            req_headers['Range'] = 'bytes={}-'.format(offset)
+            req_headers['If-Range'] = state['validator']
+
+        key, conn, resp, final_url = self.open(url, proxies, req_headers)
+        try:
+            if resp.status == 304 and headers:
+                resp.read()
+                self.release(key, conn, resp)
+                return 304, "", ""
+            if resp.status == 206 and offset:
+                logger.info("Resume {} from {}".format(url, format_size(offset)))
+                mode = 'ab'
+            elif resp.status == 200:
+                offset = 0
+                mode = 'wb'
+                # Headers of this response tell if the file is worth splitting,
+                # the response itself is the first segment
+                segments_state = self._segments_state(url, final_url, resp)
+                if segments_state:
+                    self._save_state(part, segments_state)
+                    self._fetch_segments(part, segments_state, proxies, (key, conn, resp))
+                    return 200, segments_state['etag'], segments_state['last_modified']
+            elif resp.status == 416 and offset:
+                self._reset(part)
+                raise _TransientError("can't resume from {} bytes".format(offset))
+            else:
+                raise DownloadError("HTTP {} {} for {}".format(resp.status, resp.reason, url))
+            etag = resp.getheader('ETag') or ""
+            last_modified = resp.getheader('Last-Modified') or ""
+            self._save_state(part, {
+                'url': url,
+                'validator': _validator(etag, last_modified),
+                'etag': etag,
+                'last_modified': last_modified,
+            })
+            length = resp.getheader('Content-Length')
+            total = offset + int(length) if length is not None else None
+            with open(part, mode) as f:
+                written = self._copy(resp, f, url, offset, total)
+            if total is not None and written != total:
+                raise _TransientError("got {} of {} bytes".format(written, total))
+        except BaseException:
+            conn.close()
+            raise
+        self.release(key, conn, resp)
+        return 200, etag, last_modified
+
+    def _segments_state(self, url: str, final_url: str, resp) -> dict:
+        """Segments state if the file of the response is worth splitting"""
+        if self.segments < 2:
+            return {}
+        length = resp.getheader('Content-Length')
+        etag = resp.getheader('ETag') or ""
+        last_modified = resp.getheader('Last-Modified') or ""
+        validator = _validator(etag, last_modified)
+        if (not length or not validator
+                or resp.getheader('Accept-Ranges', '').lower() != 'bytes'
+                or int(length) < self.segment_min_size):
+            return {}
+        size = int(length)
+        step = -(-size // self.segments)
+        return {
+            'url': url,
+            'final_url': final_url,
+            'validator': validator,
+            'etag': etag,
+            'last_modified': last_modified,
+            'size': size,
+            # [start, end (inclusive), bytes done]
+            'segments': [
+                [start, min(start + step, size) - 1, 0]
+                for start in range(0, size, step)
+            ],
+        }
+
+    def _fetch_segments(self, part: Path, state: dict, proxies, first=None):
+        """Fills the segments of part; `first` is (key, conn, response) of a
+        request from the start of the file, it is used for the first segment"""
+        size = state['size']
+        logger.info("Download {} in {} segments ({})".format(
+            state['url'], len(state['segments']), format_size(size),
+        ))
+        if not part.exists() or part.stat().st_size != size:
+            with open(part, 'wb') as f:
+                f.truncate(size)
+        lock = threading.Lock()
+        saved = [sum(segment[2] for segment in state['segments'])]
+
+        def progress():
+            # Called with the lock, so a killed download resumes from here
+            done = sum(segment[2] for segment in state['segments'])
+            if done - saved[0] >= self.state_save_interval:
+                self._save_state(part, state)
+                saved[0] = done
+
+        fd = os.open(part, os.O_WRONLY)
+        try:
+            with ThreadPoolExecutor(max_workers=len(state['segments'])) as pool:
+                futures = [
+                    pool.submit(
+                        self._fetch_segment, fd, segment, state, proxies, lock, progress,
+                        first if number == 0 else None,
+                    )
+                    for number, segment in enumerate(state['segments'])
+                    if segment[0] + segment[2] <= segment[1]
+                ]
+                errors = [f.exception() for f in futures if f.exception()]
+        finally:
+            os.close(fd)
+            if state['segments']:
+                self._save_state(part, state)
+            else:
+                self._reset(part)
+        if errors:
+            raise errors[0]
+
+    def _fetch_segment(self, fd: int, segment: list, state: dict, proxies, lock, progress, opened=None):
+        start, end, done = segment
+        url = state.get('final_url') or state['url']
+        if opened:
+            key, conn, resp = opened
+        else:
+            key, conn, resp, _ = self.open(url, proxies, {
+                'Range': 'bytes={}-{}'.format(start + done, end),
+                'If-Range': state['validator'],
+            })
+        try:
+            if resp.status != 206 and not opened:
+                # Changed on the server or range ignored, start from scratch
+                resp.close()
+                with lock:
+                    state['segments'] = []
+                raise _TransientError(
+                    "Range request for {} not satisfied (HTTP {})".format(url, resp.status)
+                )
+            while start + segment[2] <= end:
+                chunk = resp.read(min(self.chunk_size, end + 1 - start - segment[2]))
+                if not chunk:
+                    break
+                os.pwrite(fd, chunk, start + segment[2])
+                with lock:
+                    segment[2] += len(chunk)
+                    if state['segments']:
+                        progress()
+        except BaseException:
+            conn.close()
+            raise
+        if opened:
+            # The rest of the file is not read, the connection can't be reused
+            conn.close()
+        else:
+            self.release(key, conn, resp)
+        if start + segment[2] <= end:
+            raise _TransientError("segment {}-{} is incomplete".format(start, end))
+
+    def _request(self, method: str, url: str, proxy: str, headers: dict):
+        parts = urlsplit(url)
+        if parts.scheme not in ('http', 'https'):
+            raise DownloadError("Unsupported url {}".format(url))
+        port = parts.port or (443 if parts.scheme == 'https' else 80)
+        key = (parts.scheme, parts.hostname, port, proxy)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        req_headers = {
+            'User-Agent': USER_AGENT,
+            'Accept-Encoding': 'identity',
+        }
+        req_headers.update(headers)
+        if proxy and parts.scheme == 'http':
+            # Plain http through the proxy uses absolute url
+            path = url
+        conn, reused = self.pool.get(key)
+        try:
+            if proxy and parts.scheme == 'http':
+                req_headers.update(conn.proxy_headers)
+            conn.request(method, path, headers=req_headers)
+            return key, conn, conn.getresponse()
+        except (http.client.RemoteDisconnected, ConnectionError, BrokenPipeError):
+            conn.close()
+            if not reused:
+                raise
+        # Idle keep-alive connection was closed by the server, retry on a new one
+        conn = self.pool.connect(key)
+        if proxy and parts.scheme == 'http':
+            req_headers.update(conn.proxy_headers)
+        conn.request(method, path, headers=req_headers)
+        return key, conn, conn.getresponse()
+
+    def _copy(self, resp, f, url: str, offset: int, total: Optional[int]) -> int:
+        size = offset
+        started = last_report = time.monotonic()
+        while True:
+            chunk = resp.read(self.chunk_size)
+            if not chunk:
+                break
+            f.write(chunk)
+            size += len(chunk)
+            now = time.monotonic()
+            if now - last_report >= self.progress_interval:
+                last_report = now
+                logger.info("\t{}: {}{} ({}/s)".format(
+                    url.rsplit('/', 1)[-1],
+                    format_size(size),
+                    " of {}".format(format_size(total)) if total else "",
+                    format_size((size - offset) / (now - started)),
+                ))
+        return size
+
+    def _reset(self, part: Path):
+        part.unlink(missing_ok=True)
+        self._state_path(part).unlink(missing_ok=True)
+
+    def _state_path(self, part: Path) -> Path:
+        return part.with_name(part.name + '.json')
+
+    def _load_state(self, part: Path, url: str) -> dict:
+        state_path = self._state_path(part)
+        if not state_path.exists() or not part.exists():
+            return {}
+        try:
+            with open(state_path, 'r') as f:
+                state = json.load(f)
+        except (OSError, json.decoder.JSONDecodeError):
+            return {}
+        if state.get('url') != url:
+            return {}
+        return state
+
+    def _save_state(self, part: Path, state: dict):
+        state_path = self._state_path(part)
+        tmp_path = state_path.with_name(state_path.name + '.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp_path, state_path)
+
+
+def _validator(etag: str, last_modified: str) -> str:
+    # Weak ETags can't be used in If-Range
+    if etag and not etag.startswith('W/'):
+        return etag
+    return last_modified
+
+
+_downloader: Optional[Downloader] = None
+_downloader_lock = threading.Lock()
+
+
+def get_downloader() -> Downloader:
+    global _downloader
+    with _downloader_lock:
+        if _downloader is None:
+            _downloader = Downloader()
+        return _downloader
+
+
 def download_file(url, save_to, proxies = None):
-    cmd = ['curl', '-q', '-o', str(save_to), '--fail', '-L']
-    if proxies:
-        if proxies['https']:
-            cmd += ['-x', proxies['https']]
-        elif proxies['http']:
-            cmd += ['-x', proxies['http']]
-    cmd.append(url)
     try:
-        subprocess.run(
-            cmd,
-            check=True,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT,
-            text=True,
-        )
+        get_downloader().fetch(url, save_to, proxies)
         return True
-    except subprocess.CalledProcessError as exc:
+    except (DownloadError, OSError, http.client.HTTPException) as exc:
         logger.error("Error while download {}".format(url))
-        logger.error(exc.stdout)
+        logger.error(exc)
         return False
-
@@ -0,0 +1,256 @@
+import hashlib
+import http.client
+import os
+import shutil
+import sys
+import tarfile
+import tempfile
+import threading
+import zipfile
+from pathlib import Path
+from common.logger import logger
+from common.artifact_cache import get_artifact_cache
+from common.download_file import DownloadError, download_file, get_downloader
+
+
+# Bigger tree members are hashed through a temp file, not in memory
+SPOOL_MAX_SIZE = 8 * 1024 * 1024
+
+
+class ExtractError(Exception):
+    pass
+
+
+# Members extracted by this process, (url, member, mode) -> dest. Toolboxes
+# installed by one process (install.py --fleet) hardlink them instead of
+# extracting them again. Trees are not shared: gcloud changes its SDK files
+_extracted: dict = {}
+_url_locks: dict = {}
+_lock = threading.Lock()
+
+
+def _url_lock(url: str) -> threading.Lock:
+    with _lock:
+        return _url_locks.setdefault(url, threading.Lock())
+
+
+def _link_extracted(url: str, members: dict, mode: int) -> dict:
+    """Hardlinks members extracted before, returns the ones left to extract"""
+    left = {}
+    for name, dest in members.items():
+        src = _extracted.get((url, name, mode))
+        if not src:
+            left[name] = dest
+            continue
+        tmp_path = Path(dest).with_name(Path(dest).name + '.tmp')
+        try:
+            if os.path.lexists(tmp_path):
+                os.remove(tmp_path)
+            os.link(src, tmp_path)
+            os.replace(tmp_path, dest)
+        except OSError:
+            # f.e. the workdirs are on different filesystems
+            left[name] = dest
+    return left
+
+
+def _is_zip(url: str) -> bool:
+    return url.split('?', 1)[0].endswith('.zip')
+
+
+def _write_atomic(src, dest: Path, mode: int):
+    dest = Path(dest)
+    tmp_path = dest.with_name(dest.name + '.tmp')
+    with open(tmp_path, 'wb') as f:
+        shutil.copyfileobj(src, f, 1 << 20)
+    os.chmod(tmp_path, mode)
+    os.replace(tmp_path, dest)
+
+
+def _extract_zip_members(archive, members: dict, mode: int):
+    with zipfile.ZipFile(archive) as zf:
+        for name, dest in members.items():
+            try:
+                src = zf.open(name)
+            except KeyError:
+                raise ExtractError("No {} in archive".format(name))
+            with src:
+                _write_atomic(src, dest, mode)
+
+
+def _extract_tar_members(fileobj, members: dict, mode: int):
+    left = dict(members)
+    # Stream mode: the archive is read once, front to back
+    with tarfile.open(fileobj=fileobj, mode='r|*') as tf:
+        for info in tf:
+            name = info.name[2:] if info.name.startswith('./') else info.name
+            if name not in left or not info.isfile():
+                continue
+            src = tf.extractfile(info)
+            _write_atomic(src, left.pop(name), mode)
+            if not left:
+                break
+    if left:
+        raise ExtractError("No {} in archive".format(', '.join(left)))
+
+
+def _extract_tar_all(fileobj, dest_dir: Path):
+    with tarfile.open(fileobj=fileobj, mode='r|*') as tf:
+        if hasattr(tarfile, 'data_filter'):
+            tf.extractall(dest_dir, filter='data')
+        else:
+            tf.extractall(dest_dir)
+
+
+def _extract_tar_linked(fileobj, dest_dir: Path, previous: dict) -> tuple:
+    """Like _extract_tar_all, but a file with the same sha256 and mode as a
+    file in `previous` ({sha256: path}) is hardlinked to it, not written.
+    Returns ({name: {sha256, size, mode, mtime}}, number of linked files)"""
+    files = {}
+    linked = 0
+    with tarfile.open(fileobj=fileobj, mode='r|*') as tf:
+        for info in tf:
+            if hasattr(tarfile, 'data_filter'):
+                info = tarfile.data_filter(info, str(dest_dir))
+            name = info.name[2:] if info.name.startswith('./') else info.name
+            target = Path(dest_dir) / name
+            if info.isdir():
+                target.mkdir(parents=True, exist_ok=True)
+                continue
+            if not info.isfile():
+                tf.extract(info, dest_dir, set_attrs=False)
+                continue
+            target.parent.mkdir(parents=True, exist_ok=True)
+            # The member is hashed before anything is written: a file equal
+            # to a previous one is only linked. Small files are kept in
+            # memory, bigger ones are spooled to a temp file
+            src = tf.extractfile(info)
+            digest = hashlib.sha256()
+            with tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE, dir=dest_dir) as spool:
+                while True:
+                    chunk = src.read(1 << 20)
+                    if not chunk:
+                        break
+                    digest.update(chunk)
+                    spool.write(chunk)
+                sha256 = digest.hexdigest()
+                mode = info.mode & 0o777
+                previous_path = previous.get(sha256)
+                if previous_path and os.stat(previous_path).st_mode & 0o777 == mode:
+                    os.link(previous_path, target)
+                    linked += 1
+                else:
+                    spool.seek(0)
+                    with open(target, 'wb') as f:
+                        shutil.copyfileobj(spool, f, 1 << 20)
+                    os.chmod(target, mode)
+                    os.utime(target, (info.mtime, info.mtime))
+            stat = os.stat(target)
+            files[name] = {
+                'sha256': sha256,
+                'size': stat.st_size,
+                'mode': mode,
+                'mtime': stat.st_mtime_ns,
+            }
+    return files, linked
+
+
+def _open_archive(url: str, config, tmp_name: str):
+    """File object with archive content.
+
+    Cached artifacts are read from the cache, without the cache tar archives
+    are read directly from the http response (so the download time is a part
+    of the "extract" phase). Zip needs random access, so without the cache it
+    is downloaded to Workdir.tmp first.
+    """
+    cache = get_artifact_cache(config)
+    if cache:
+        with config.workdir.report.phase("download") as record:
+            blob = cache.fetch(url, config.proxies, record)
+        try:
+            # Open file stays readable if the blob is evicted
+            return open(blob, 'rb'), None
+        finally:
+            cache.release(blob)
+    if _is_zip(url):
+        tmp_path = config.workdir.tmp / tmp_name
+        with config.workdir.report.phase("download") as record:
+            if not download_file(url, tmp_path, config.proxies):
+                sys.exit(1)
+            record['bytes'] = os.path.getsize(tmp_path)
+        return open(tmp_path, 'rb'), None
+    downloader = get_downloader()
+    key, conn, resp, _ = downloader.open(url, config.proxies)
+    if resp.status != 200:
+        conn.close()
+        raise DownloadError("HTTP {} {} for {}".format(resp.status, resp.reason, url))
+    return resp, conn
+
+
+def download_and_extract(url: str, members: dict, config, mode: int = 0o755):
+    """Download archive and write only `members` ({member: dest path}) in place"""
+    with _url_lock(url):
+        left = _link_extracted(url, members, mode)
+        if not left:
+            logger.debug('{} are linked, extracted from {} before'.format(', '.join(members), url))
+            return
+        logger.debug('Download {} and extract {}'.format(url, ', '.join(left)))
+        try:
+            src, conn = _open_archive(url, config, url.rsplit('/', 1)[-1])
+            try:
+                with config.workdir.report.phase("extract"):
+                    if _is_zip(url):
+                        _extract_zip_members(src, left, mode)
+                    else:
+                        _extract_tar_members(src, left, mode)
+            finally:
+                src.close()
+                if conn:
+                    conn.close()
+        except (DownloadError, ExtractError, OSError, http.client.HTTPException,
+                zipfile.BadZipFile, tarfile.TarError) as exc:
+            logger.error("Error while download and extract {}".format(url))
+            logger.error(exc)
+            sys.exit(1)
+        for name, dest in left.items():
+            _extracted[(url, name, mode)] = Path(dest)
+
+
+def download_and_extract_all(url: str, dest_dir: Path, config):
+    """Download tar archive and unpack it to dest_dir"""
+    logger.debug('Download {} and extract to {}'.format(url, dest_dir))
+    Path(dest_dir).mkdir(parents=True, exist_ok=True)
+    try:
+        src, conn = _open_archive(url, config, url.rsplit('/', 1)[-1])
+        try:
+            with config.workdir.report.phase("extract"):
+                _extract_tar_all(src, dest_dir)
+        finally:
+            src.close()
+            if conn:
+                conn.close()
+    except (DownloadError, OSError, http.client.HTTPException, tarfile.TarError) as exc:
+        logger.error("Error while download and extract {}".format(url))
+        logger.error(exc)
+        sys.exit(1)
+
+
+def download_and_extract_tree(url: str, dest_dir: Path, config, previous: dict) -> dict:
+    """Download tar archive and unpack it to dest_dir, files which are in
+    `previous` ({sha256: path}) are hardlinked. Returns the files manifest"""
+    logger.debug('Download {} and extract to {}'.format(url, dest_dir))
+    Path(dest_dir).mkdir(parents=True, exist_ok=True)
+    try:
+        src, conn = _open_archive(url, config, url.rsplit('/', 1)[-1])
+        try:
+            with config.workdir.report.phase("extract") as record:
+                files, record['linked'] = _extract_tar_linked(src, dest_dir, previous)
+        finally:
+            src.close()
+            if conn:
+                conn.close()
+    except (DownloadError, OSError, http.client.HTTPException, tarfile.TarError) as exc:
+        logger.error("Error while download and extract {}".format(url))
+        logger.error(exc)
+        sys.exit(1)
+    return files
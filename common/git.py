@@ -0,0 +1,106 @@
+import fcntl
+import hashlib
+import os
+import shutil
+import subprocess
+from pathlib import Path
+from typing import Optional
+from common.logger import logger
+
+
+# full - whole history, shallow - last `depth` commits, blobless - whole
+# history, file contents are fetched on checkout, sparse - blobless and
+# only `sparse_paths` are checked out
+CLONE_MODES = ('full', 'shallow', 'blobless', 'sparse')
+
+
+class GitError(Exception):
+    pass
+
+
+def git(args: list, cwd: Optional[Path] = None) -> str:
+    """Runs git, returns its output or raises GitError"""
+    cmd = ['git'] + [str(arg) for arg in args]
+    p = subprocess.run(
+        cmd,
+        cwd=cwd,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+    )
+    output = p.stdout.decode('utf-8', errors='replace')
+    if p.returncode != 0:
+        raise GitError("{}: {}".format(' '.join(cmd), output.strip()))
+    return output
+
+
+def clone(
+        url: str,
+        dest: Path,
+        mode: str = 'full',
+        branch: str = "",
+        depth: int = 1,
+        sparse_paths: Optional[list] = None,
+        reference: Optional[Path] = None,
+    ):
+    args = ['clone', '--quiet']
+    if branch:
+        args += ['--branch', branch]
+    if mode == 'shallow':
+        args += ['--depth', depth]
+    elif mode in ('blobless', 'sparse'):
+        args += ['--filter=blob:none']
+    if mode == 'sparse':
+        args += ['--sparse']
+    if reference:
+        args += ['--reference', reference]
+    git(args + [url, dest])
+    if mode == 'sparse' and sparse_paths:
+        git(['sparse-checkout', 'set'] + list(sparse_paths), cwd=dest)
+
+
+def update(repo: Path) -> bool:
+    """Fetches the upstream of the current branch and fast-forwards to it.
+    Returns True if HEAD moved. A shallow clone gets only the new commits,
+    its history is not cut again"""
+    before = git(['rev-parse', 'HEAD'], cwd=repo).strip()
+    git(['fetch', '--quiet', 'origin'], cwd=repo)
+    git(['merge', '--ff-only', '--quiet', '@{upstream}'], cwd=repo)
+    return git(['rev-parse', 'HEAD'], cwd=repo).strip() != before
+
+
+def origin_url(repo: Path) -> str:
+    try:
+        return git(['config', '--get', 'remote.origin.url'], cwd=repo).strip()
+    except GitError:
+        return ""
+
+
+def reference_mirror(url: str, root: Path) -> Path:
+    """Bare mirror of url under root, shared by the clones of all toolboxes
+    as `--reference`. The clones borrow its objects, so it is never removed
+    and never drops objects: no gc, no prune, fetch without --prune"""
+    root.mkdir(parents=True, exist_ok=True)
+    mirror = root / "{}.git".format(hashlib.sha256(url.encode()).hexdigest()[:16])
+    with open(mirror.with_suffix('.lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            if not mirror.exists():
+                logger.debug("Create git mirror {} of {}".format(mirror, url))
+                tmp_mirror = mirror.with_suffix('.tmp')
+                if tmp_mirror.exists():
+                    shutil.rmtree(tmp_mirror)
+                git(['clone', '--quiet', '--mirror', url, tmp_mirror])
+                _keep_objects(tmp_mirror)
+                os.replace(tmp_mirror, mirror)
+            else:
+                # Mirrors made before gc was turned off
+                _keep_objects(mirror)
+                git(['fetch', '--quiet', 'origin'], cwd=mirror)
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+    return mirror
+
+
+def _keep_objects(mirror: Path):
+    git(['config', 'gc.auto', '0'], cwd=mirror)
+    git(['config', 'gc.pruneExpire', 'never'], cwd=mirror)
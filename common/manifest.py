@@ -0,0 +1,100 @@
+import hashlib
+import json
+import os
+import threading
+from pathlib import Path
+from typing import Optional
+from common.logger import logger
+
+
+def file_sha256(path) -> str:
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+class InstallManifest:
+    """State of installed binaries, stored in <workdir>/.manifest.json
+
+    name -> {version, path (relative to workdir root), size, mtime_ns, sha256}
+
+    A recorded version is trusted while size and mtime of the file are the
+    same, so the binary doesn't have to be run to get its version. With
+    `deep_verify` the sha256 of the file is checked too.
+    """
+
+    def __init__(self, path: Path, root: Path):
+        self.path = Path(path)
+        self.root = Path(root)
+        self.deep_verify = False
+        self._lock = threading.Lock()
+        self._entries: Optional[dict] = None
+
+    @property
+    def entries(self) -> dict:
+        if self._entries is None:
+            self._entries = self._load()
+        return self._entries
+
+    def get_version(self, name: str, bin_path) -> Optional[str]:
+        with self._lock:
+            entry = self.entries.get(name)
+        if not entry:
+            return None
+        bin_path = Path(bin_path)
+        if entry['path'] != self._relative(bin_path):
+            return None
+        try:
+            st = os.stat(bin_path)
+        except OSError:
+            return None
+        if st.st_size != entry['size'] or st.st_mtime_ns != entry['mtime_ns']:
+            logger.debug("Manifest: {} changed on disk".format(name))
+            return None
+        if self.deep_verify and file_sha256(bin_path) != entry['sha256']:
+            logger.warning("Manifest: {} sha256 mismatch".format(bin_path))
+            return None
+        return entry['version']
+
+    def record(self, name: str, version: str, bin_path):
+        bin_path = Path(bin_path)
+        st = os.stat(bin_path)
+        entry = {
+            'version': version,
+            'path': self._relative(bin_path),
+            'size': st.st_size,
+            'mtime_ns': st.st_mtime_ns,
+            'sha256': file_sha256(bin_path),
+        }
+        with self._lock:
+            self.entries[name] = entry
+            self._save()
+
+    def forget(self, name: str):
+        with self._lock:
+            if self.entries.pop(name, None) is not None:
+                self._save()
+
+    def _relative(self, path: Path) -> str:
+        try:
+            return str(path.relative_to(self.root))
+        except ValueError:
+            return str(path)
+
+    def _load(self) -> dict:
+        if not self.path.exists():
+            return {}
+        try:
+            with open(self.path, 'r') as f:
+                return json.load(f)
+        except (OSError, json.decoder.JSONDecodeError):
+            logger.warning("Install manifest is broken, ignore {}".format(self.path))
+            return {}
+
+    def _save(self):
+        tmp_path = self.path.with_name(self.path.name + '.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(self._entries, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.path)
@@ -0,0 +1,139 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Optional
+
+
+class InstallReport:
+    """Timings of install phases, written to <workdir>/.report.json
+
+    Phases are recorded with `phase()`; the installer name is taken from
+    `installer()` context of the current thread unless given explicitly.
+    """
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.toolbox = ""
+        self.started_at = time.time()
+        self._started = time.monotonic()
+        self.duration = 0.0
+        self.ok = True
+        self.phases: list = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    @contextmanager
+    def installer(self, name: str):
+        prev = getattr(self._local, 'installer', "")
+        self._local.installer = name
+        try:
+            with self.phase("install"):
+                yield
+        finally:
+            self._local.installer = prev
+
+    @contextmanager
+    def phase(self, name: str, installer: Optional[str] = None):
+        """Time a phase. Yields dict for extra values (bytes, ...)"""
+        record = {
+            'installer': installer or getattr(self._local, 'installer', ""),
+            'phase': name,
+            'start': round(time.monotonic() - self._started, 3),
+        }
+        started = time.monotonic()
+        ok = False
+        try:
+            yield record
+            ok = True
+        finally:
+            record['duration'] = round(time.monotonic() - started, 3)
+            record['ok'] = ok
+            if record.get('bytes') and record['duration'] > 0:
+                record['bytes_per_sec'] = round(record['bytes'] / record['duration'])
+            with self._lock:
+                self.phases.append(record)
+
+    def finish(self, ok: bool):
+        self.ok = ok
+        self.duration = round(time.monotonic() - self._started, 3)
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            phases = sorted(self.phases, key=lambda x: x['start'])
+        installers = {}
+        for record in phases:
+            if record['phase'] == 'install':
+                installers[record['installer']] = record['duration']
+        return {
+            'toolbox': self.toolbox,
+            'started_at': self.started_at,
+            'duration': self.duration,
+            'ok': self.ok,
+            'installers': installers,
+            'phases': phases,
+        }
+
+    def write(self):
+        _write_atomic(self.path, json.dumps(self.to_dict(), indent=1) + '\n')
+
+    def write_prometheus(self, path: Path):
+        """Textfile for node_exporter textfile collector"""
+        report = self.to_dict()
+        toolbox = _label(report['toolbox'])
+        lines = [
+            '# HELP admin_toolbox_install_duration_seconds Duration of the last install.py run',
+            '# TYPE admin_toolbox_install_duration_seconds gauge',
+            'admin_toolbox_install_duration_seconds{{toolbox="{}"}} {}'.format(
+                toolbox, report['duration']),
+            '# HELP admin_toolbox_install_success 1 if the last install.py run succeeded',
+            '# TYPE admin_toolbox_install_success gauge',
+            'admin_toolbox_install_success{{toolbox="{}"}} {}'.format(
+                toolbox, int(report['ok'])),
+            '# HELP admin_toolbox_install_last_run_timestamp_seconds Start of the last install.py run',
+            '# TYPE admin_toolbox_install_last_run_timestamp_seconds gauge',
+            'admin_toolbox_install_last_run_timestamp_seconds{{toolbox="{}"}} {}'.format(
+                toolbox, round(report['started_at'])),
+            '# HELP admin_toolbox_install_phase_duration_seconds Duration of install phases',
+            '# TYPE admin_toolbox_install_phase_duration_seconds gauge',
+        ]
+        durations: dict = {}
+        downloaded: dict = {}
+        for record in report['phases']:
+            key = (record['installer'], record['phase'])
+            durations[key] = durations.get(key, 0) + record['duration']
+            if record.get('bytes'):
+                downloaded[record['installer']] = (
+                    downloaded.get(record['installer'], 0) + record['bytes']
+                )
+        for (installer, phase), duration in sorted(durations.items()):
+            lines.append(
+                'admin_toolbox_install_phase_duration_seconds'
+                '{{toolbox="{}",installer="{}",phase="{}"}} {}'.format(
+                    toolbox, _label(installer), _label(phase), round(duration, 3),
+                )
+            )
+        lines += [
+            '# HELP admin_toolbox_install_download_bytes Bytes downloaded by installer',
+            '# TYPE admin_toolbox_install_download_bytes gauge',
+        ]
+        for installer, size in sorted(downloaded.items()):
+            lines.append(
+                'admin_toolbox_install_download_bytes{{toolbox="{}",installer="{}"}} {}'.format(
+                    toolbox, _label(installer), size,
+                )
+            )
+        _write_atomic(Path(path), '\n'.join(lines) + '\n')
+
+
+def _label(value: str) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _write_atomic(path: Path, content: str):
+    tmp_path = path.with_name(path.name + '.tmp')
+    with open(tmp_path, 'w') as f:
+        f.write(content)
+    os.replace(tmp_path, path)
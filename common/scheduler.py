@@ -0,0 +1,72 @@
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from typing import Callable
+from common.logger import logger
+
+
+class Scheduler:
+    """Runs named tasks on a bounded thread pool, respecting dependencies.
+
+    A task starts only after every task it depends on has finished.
+    Independent tasks run at the same time (up to `max_workers`).
+    """
+
+    def __init__(self, max_workers: int = 4):
+        self.max_workers = max(1, max_workers)
+        self._tasks: dict[str, tuple[Callable, tuple]] = {}
+
+    def add(self, name: str, func: Callable, depends_on=()):
+        if name in self._tasks:
+            raise Exception("Task {} already added".format(name))
+        self._tasks[name] = (func, tuple(depends_on))
+
+    def _validate(self):
+        for name, (_, deps) in self._tasks.items():
+            for dep in deps:
+                if dep not in self._tasks:
+                    raise Exception(
+                        "Task {} depends on unknown task {}".format(name, dep)
+                    )
+        # Kahn's algorithm, only to detect cycles before anything starts
+        left = {name: set(deps) for name, (_, deps) in self._tasks.items()}
+        while left:
+            ready = [name for name, deps in left.items() if not deps]
+            if not ready:
+                raise Exception(
+                    "Dependency cycle between tasks: {}".format(', '.join(sorted(left)))
+                )
+            for name in ready:
+                del left[name]
+            for deps in left.values():
+                deps.difference_update(ready)
+
+    def run(self):
+        self._validate()
+        pending = dict(self._tasks)
+        done = set()
+        running = {}
+        error = None
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            while running or (pending and error is None):
+                if error is None:
+                    ready = [
+                        name for name, (_, deps) in pending.items()
+                        if all(dep in done for dep in deps)
+                    ]
+                    for name in ready:
+                        func, _ = pending.pop(name)
+                        logger.debug("Scheduler: start {}".format(name))
+                        running[pool.submit(func)] = name
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    exc = future.exception()
+                    if exc is not None:
+                        # Let already running tasks finish, don't start new ones
+                        if error is None:
+                            logger.error("{} failed".format(name))
+                            error = exc
+                        continue
+                    logger.debug("Scheduler: done {}".format(name))
+                    done.add(name)
+        if error is not None:
+            raise error
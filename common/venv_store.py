@@ -0,0 +1,272 @@
+import csv
+import fcntl
+import hashlib
+import os
+import platform
+import re
+import shutil
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Optional
+from common.logger import logger
+
+
+PIN_REGEX = re.compile(r'^\s*([A-Za-z0-9][A-Za-z0-9._-]*)\s*==\s*([^\s;,]+)\s*$')
+
+
+def normalize_name(name: str) -> str:
+    return re.sub(r'[-_.]+', '_', name).lower()
+
+
+class VenvStore:
+    """Installed python distributions, shared by the venvs of all toolboxes.
+
+    Layout:
+        <python>/<name>-<version>-<hash>/site-packages/   files of the distribution
+        <python>/<name>-<version>-<hash>/bin/             its scripts, shebang is '#!python'
+        <python>/<name>-<version>-<hash>/.complete        all files are in the store
+
+    <python> is the interpreter of the venv (cpython-python3.11-x86_64), <hash>
+    is sha256 of the RECORD rows with hashes inside site-packages, so equal
+    distributions share the entry. Files with a RECORD hash are hardlinked into
+    the venvs and read-only, the other files (RECORD, INSTALLER, ...) and the
+    scripts are copied. Bytecode is not stored, python compiles it on import.
+    An entry whose files have no links besides the store one is used by no
+    venv, prune() removes it.
+    """
+
+    def __init__(self, root: Path):
+        self.root = Path(root)
+        self.lock_path = self.root / '.lock'
+        self._lock = threading.Lock()
+        self.root.mkdir(parents=True, exist_ok=True)
+
+    def link_venv(self, venv_path: Path) -> int:
+        """Moves distributions of the venv into the store, or hardlinks the
+        ones which are there already. Returns the number of linked files"""
+        site_packages, entries_root = self._venv_paths(venv_path)
+        if not site_packages:
+            return 0
+        linked = 0
+        with self._locked():
+            for dist_info in sorted(site_packages.glob('*.dist-info')):
+                rows = self._read_record(dist_info)
+                if rows is None:
+                    continue
+                entry = entries_root / self._entry_name(dist_info, rows)
+                try:
+                    linked += self._link_dist(entry, site_packages, venv_path / 'bin', rows)
+                except OSError as exc:
+                    # f.e. the store and the venv are on different filesystems
+                    logger.debug("Venv store: can't link {}: {}".format(dist_info.name, exc))
+                    return linked
+        return linked
+
+    def prelink(self, venv_path: Path, packages: list) -> list:
+        """Puts pinned packages (name==version) from the store into a new venv,
+        so pip finds them installed. Returns the linked packages"""
+        site_packages, entries_root = self._venv_paths(venv_path)
+        if not site_packages or not entries_root.exists():
+            return []
+        installed = {
+            normalize_name(path.name.rsplit('-', 1)[0])
+            for path in site_packages.glob('*.dist-info')
+        }
+        done = []
+        with self._locked():
+            for package in packages:
+                match = PIN_REGEX.match(str(package))
+                if not match or normalize_name(match.group(1)) in installed:
+                    continue
+                name, version = normalize_name(match.group(1)), match.group(2)
+                entry = self._find_entry(entries_root, name, version)
+                if not entry:
+                    continue
+                try:
+                    self._prelink_dist(entry, site_packages, venv_path / 'bin')
+                except OSError as exc:
+                    logger.debug("Venv store: can't prelink {}: {}".format(package, exc))
+                    continue
+                installed.add(name)
+                done.append(package)
+        return done
+
+    def prune(self) -> int:
+        """Removes entries which no venv links any more. Returns their number"""
+        removed = 0
+        with self._locked():
+            for complete in sorted(self.root.glob('*/*/.complete')):
+                entry = complete.parent
+                if self._entry_used(entry):
+                    continue
+                logger.debug("Venv store: remove unused {}".format(entry.name))
+                shutil.rmtree(entry)
+                removed += 1
+        return removed
+
+    def _entry_used(self, entry: Path) -> bool:
+        stored = entry / 'site-packages'
+        dist_info = next(stored.glob('*.dist-info'), None)
+        rows = self._read_record(dist_info) if dist_info else None
+        hashed = [
+            row[0] for row in rows or []
+            if len(row) > 1 and row[1] and not row[0].startswith('..') and '__pycache__' not in row[0]
+        ]
+        # Nothing is linked from it, it can't be told if a venv uses it
+        if not hashed:
+            return True
+        for name in hashed:
+            try:
+                if os.stat(stored / name).st_nlink > 1:
+                    return True
+            except FileNotFoundError:
+                continue
+        return False
+
+    def _venv_paths(self, venv_path: Path) -> tuple:
+        site_packages = next(iter(sorted(Path(venv_path).glob('lib/python*/site-packages'))), None)
+        if not site_packages:
+            return None, None
+        implementation = 'python'
+        pyvenv_cfg = Path(venv_path) / 'pyvenv.cfg'
+        if pyvenv_cfg.exists():
+            with open(pyvenv_cfg, 'r') as f:
+                for line in f:
+                    key, _, value = line.partition('=')
+                    if key.strip() == 'implementation':
+                        implementation = value.strip().lower()
+        python = "{}-{}-{}".format(implementation, site_packages.parent.name, platform.machine())
+        return site_packages, self.root / python
+
+    def _read_record(self, dist_info: Path) -> Optional[list]:
+        record = dist_info / 'RECORD'
+        if not record.exists():
+            return None
+        with open(record, 'r', newline='') as f:
+            return [row for row in csv.reader(f) if row]
+
+    def _entry_name(self, dist_info: Path, rows: list) -> str:
+        name, _, version = dist_info.name[:-len('.dist-info')].rpartition('-')
+        digest = hashlib.sha256()
+        for row in sorted(rows):
+            if len(row) > 1 and row[1] and not row[0].startswith('..'):
+                digest.update("{},{}\n".format(row[0], row[1]).encode())
+        return "{}-{}-{}".format(normalize_name(name), version, digest.hexdigest()[:16])
+
+    def _find_entry(self, entries_root: Path, name: str, version: str) -> Optional[Path]:
+        for entry in sorted(entries_root.glob('{}-{}-*'.format(name, version))):
+            if (entry / '.complete').exists():
+                return entry
+        return None
+
+    def _link_dist(self, entry: Path, site_packages: Path, bin_path: Path, rows: list) -> int:
+        complete = (entry / '.complete').exists()
+        linked = 0
+        for row in rows:
+            path = os.path.normpath(site_packages / row[0])
+            hashed = len(row) > 1 and bool(row[1])
+            if not os.path.isfile(path) or '__pycache__' in row[0]:
+                continue
+            if os.path.dirname(path) == os.path.normpath(bin_path):
+                if not complete:
+                    self._store_script(path, entry / 'bin' / os.path.basename(path))
+                continue
+            if row[0].startswith('..'):
+                continue
+            stored = entry / 'site-packages' / row[0]
+            if not hashed:
+                if not complete:
+                    self._copy(path, stored)
+                continue
+            if not stored.exists():
+                stored.parent.mkdir(parents=True, exist_ok=True)
+                os.chmod(path, os.stat(path).st_mode & ~0o222)
+                os.link(path, stored)
+            elif not os.path.samestat(os.stat(path), os.stat(stored)):
+                if os.path.getsize(path) != os.path.getsize(stored):
+                    continue
+                self._link(stored, Path(path))
+                linked += 1
+        if not complete:
+            (entry / '.complete').touch()
+        return linked
+
+    def _prelink_dist(self, entry: Path, site_packages: Path, bin_path: Path):
+        stored = entry / 'site-packages'
+        dist_info = next(stored.glob('*.dist-info'))
+        rows = self._read_record(dist_info) or []
+        # Check first, a half linked distribution looks installed to pip
+        for row in rows:
+            if row[0].startswith('..') or '__pycache__' in row[0]:
+                continue
+            if not (stored / row[0]).exists():
+                raise OSError("{} is not in the store".format(row[0]))
+        for row in rows:
+            if '__pycache__' in row[0]:
+                continue
+            if row[0].startswith('..'):
+                script = entry / 'bin' / os.path.basename(row[0])
+                if script.exists():
+                    self._write_script(script, bin_path / script.name, bin_path)
+                continue
+            target = site_packages / row[0]
+            target.parent.mkdir(parents=True, exist_ok=True)
+            if len(row) > 1 and row[1]:
+                self._link(stored / row[0], target)
+            else:
+                self._copy(stored / row[0], target)
+
+    def _link(self, src: Path, dst: Path):
+        tmp_path = dst.with_name(dst.name + '.store-tmp')
+        if tmp_path.exists():
+            os.remove(tmp_path)
+        os.link(src, tmp_path)
+        os.replace(tmp_path, dst)
+
+    def _copy(self, src, dst: Path):
+        dst.parent.mkdir(parents=True, exist_ok=True)
+        shutil.copy2(src, dst)
+
+    def _store_script(self, path: str, stored: Path):
+        with open(path, 'rb') as f:
+            content = f.read()
+        if content.startswith(b'#!'):
+            content = b'#!python' + content[content.find(b'\n'):]
+        stored.parent.mkdir(parents=True, exist_ok=True)
+        with open(stored, 'wb') as f:
+            f.write(content)
+
+    def _write_script(self, stored: Path, path: Path, bin_path: Path):
+        with open(stored, 'rb') as f:
+            content = f.read()
+        if content.startswith(b'#!python\n'):
+            content = "#!{}/python".format(bin_path).encode() + content[len(b'#!python'):]
+        with open(path, 'wb') as f:
+            f.write(content)
+        os.chmod(path, 0o755)
+
+    @contextmanager
+    def _locked(self):
+        # Thread lock for this process, flock for other install.py processes
+        with self._lock, open(self.lock_path, 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+_stores: dict[Path, VenvStore] = {}
+_stores_lock = threading.Lock()
+
+
+def get_venv_store(config) -> Optional[VenvStore]:
+    """One VenvStore per cache dir; None if the cache is disabled"""
+    if not config.cache_enabled:
+        return None
+    root = Path(config.cache_path) / 'venv-store'
+    with _stores_lock:
+        if root not in _stores:
+            _stores[root] = VenvStore(root)
+        return _stores[root]
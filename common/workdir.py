@@ -2,6 +2,8 @@ from pathlib import Path
 import os
 import shutil
 from common.logger import logger
+from common.manifest import InstallManifest
+from common.report import InstallReport
 
 class Workdir:
 
@@ -14,6 +16,10 @@ class Workdir:
         self.tmp = Path("{}/tmp".format(self.root))
         self.bin = Path("{}/bin".format(self.root))
         self.storage = Path("{}/storage".format(self.root))
+        # pip http and wheel cache, shared by all venvs of the toolbox
+        self.pip_cache = Path("{}/pip-cache".format(self.root))
+        self.manifest = InstallManifest(self.root / '.manifest.json', self.root)
+        self.report = InstallReport(self.root / '.report.json')
         logger.info("Root dir is: {}".format(self.root))
         logger.info("Bin dir is: {}".format(self.bin))
 
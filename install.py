@@ -1,94 +1,380 @@
 #!/usr/bin/python3
+import json
 import os
 import sys
+import threading
 from pathlib import Path
 from argparse import ArgumentParser
+from typing import Optional
 from common.logger import logger
-from common.validators import check_dependencies, validate_platform
 from common.logger import setup_logger
 from common.config import Config
 from common.workdir import Workdir
-from installers.activate import Activate
-from installers.python_venv import PythonVenv
-from installers.ansible import Ansible
-from installers.vault import Vault
-from installers.terraform import Terraform
-from installers.terragrunt import Terragrunt
-from installers.gcloud import Gcloud
-from installers.k9s import K9S
-from installers.kubectl import Kubectl
-from installers.gron import Gron
-from installers.helm import Helm
-from installers.argocd import ArgoCD
-from installers.ssh import SSH
+
+# Installers (and everything they import: downloader, cache, extract, ...)
+# are imported in the functions using them, so `--info` doesn't load them
 
 
 def run(args):
     setup_logger(debug=args.debug)
 
+    if args.fleet:
+        run_fleet(args)
+        return
+
     workdir = Workdir(root_dir=args.workdir)
-    workdir.prepare()
+    workdir.manifest.deep_verify = args.verify_installed
 
-    # Init config
-    current_exec_dir_path = Path(os.path.realpath(__file__)).parent
-    config = Config(
-        toolbox_name=args.toolbox_name,
-        toolbox_repo_dir=current_exec_dir_path,
-        workdir=workdir,
-        config_path=args.config,
-    )
+    if args.import_bundle:
+        import_bundle(args.import_bundle, workdir)
 
     if args.info:
+        info = _read_cached_info(workdir, args.config)
+        if info is not None:
+            print("\n\n")
+            print(info)
+            sys.exit(0)
+
+    config = make_config(args.toolbox_name, workdir, args.config)
+
+    if args.info:
+        info = get_info(config)
+        if workdir.root.exists():
+            _save_info_to_file(config)
         print("\n\n")
-        print(get_info(config))
+        print(info)
         sys.exit(0)
 
+    installers = make_installers(config)
+
+    if args.plan:
+        print_plan(config, make_plan(installers, config), args.plan_format)
+        sys.exit(0)
+
+    from common.validators import check_dependencies, validate_platform
     check_dependencies()
-    validate_platform()
-
-    installers = [
-        SSH(),
-        PythonVenv(),
-        Vault(),
-        Ansible(),
-        Terraform(),
-        Terragrunt(),
-        Gcloud(),
-        Kubectl(),
-        K9S(),
-        Gron(),
-        Helm(),
-        ArgoCD(),
-    ]
+    validate_platform(config)
 
-    activate_replaces = {}
-    activate = Activate()
+    install(config, installers, args)
+    confirm_writes(installers)
 
-    try:
-        for installer in installers:
-            activate_replaces.update(installer.make_activate_replaces())
-        activate.replace(activate_replaces)
-        if activate.is_valid():
-            activate.write_template()
+    if args.export_bundle:
+        export_bundle(args.export_bundle, config)
+
+    info = get_info(config)
+    _save_info_to_file(config)
+    print("\n\n")
+    print(info)
+
+
+def run_fleet(args):
+    """Installs the toolboxes of the fleet file in one process, `--fleet-jobs`
+    of them at the same time. They share the downloads, the venv store, the
+    pip cache and the binaries extracted from the same archive"""
+    from concurrent.futures import ThreadPoolExecutor
+    from common.validators import check_dependencies, validate_platform
+    configs = []
+    for toolbox in read_fleet(args.fleet):
+        workdir = Workdir(root_dir=toolbox['workdir'])
+        workdir.manifest.deep_verify = args.verify_installed
+        config = make_config(toolbox['name'], workdir, toolbox['config'])
+        if config.cache_enabled:
+            # Wheels built for one toolbox are reused by the others
+            workdir.pip_cache = Path(config.cache_path) / 'pip'
+        configs.append(config)
+
+    if args.plan:
+        plans = [(config, make_plan(make_installers(config), config)) for config in configs]
+        if args.plan_format == "json":
+            print(json.dumps([_plan_dict(config, steps) for config, steps in plans], indent=2))
         else:
-            logger.error("Internal error in activate.sh template")
+            for config, steps in plans:
+                print_plan(config, steps)
+        sys.exit(0)
+
+    check_dependencies()
+    for config in configs:
+        validate_platform(config)
+
+    def install_toolbox(config):
+        installers = make_installers(config)
+        install(config, installers, args)
+        _save_info_to_file(config)
+        return installers
+
+    with ThreadPoolExecutor(max_workers=max(1, args.fleet_jobs)) as pool:
+        futures = [(config, pool.submit(install_toolbox, config)) for config in configs]
+        # sys.exit() of an installer only ends its toolbox
+        failed = [config for config, future in futures if future.exception() is not None]
+
+    for config, future in futures:
+        if future.exception() is None:
+            confirm_writes(future.result())
+
+    print("\n\nFleet:")
+    for config, future in futures:
+        exc = future.exception()
+        if exc is None:
+            status = "ok"
+        elif isinstance(exc, SystemExit):
+            status = "failed"
+        else:
+            status = "failed: {}".format(exc)
+        print("\t{} ({}): {}".format(config.toolbox_name, config.workdir.root, status))
+        if exc is None:
+            print("\t\tsource {}".format(config.workdir.root / 'activate'))
+    if failed:
+        sys.exit(1)
+
+
+def read_fleet(fleet_path) -> list:
+    """Fleet file is a json list of {"config": ..., "workdir": ..., "name": ...},
+    relative paths are relative to the fleet file"""
+    fleet_path = Path(fleet_path).expanduser()
+    try:
+        with open(fleet_path, 'r') as f:
+            fleet = json.load(f)
+    except (OSError, ValueError) as exc:
+        logger.error("Error while read fleet file {}".format(fleet_path))
+        logger.error(exc)
+        sys.exit(1)
+    if not isinstance(fleet, list) or not fleet:
+        logger.error("Fleet file {} must be a non empty list".format(fleet_path))
+        sys.exit(1)
+    workdirs = set()
+    for number, toolbox in enumerate(fleet, 1):
+        missing = [
+            key for key in ('config', 'workdir', 'name')
+            if not isinstance(toolbox, dict) or not toolbox.get(key)
+        ]
+        if missing:
+            logger.error("Fleet file {}, toolbox {}: no {}".format(
+                fleet_path, number, ', '.join(missing),
+            ))
             sys.exit(1)
+        toolbox['config'] = str(fleet_path.parent / Path(toolbox['config']).expanduser())
+        workdir = (fleet_path.parent / Path(toolbox['workdir']).expanduser()).resolve()
+        toolbox['workdir'] = str(workdir)
+        if workdir in workdirs:
+            logger.error("Fleet file {}: workdir {} is used twice".format(fleet_path, workdir))
+            sys.exit(1)
+        workdirs.add(workdir)
+    return fleet
 
-        for installer in installers:
-            if installer.enabled:
-                logger.info("Install {}".format(installer.__class__.__name__))
-                installer.install()
+
+def make_config(toolbox_name, workdir, config_path) -> Config:
+    current_exec_dir_path = Path(os.path.realpath(__file__)).parent
+    return Config(
+        toolbox_name=toolbox_name,
+        toolbox_repo_dir=current_exec_dir_path,
+        workdir=workdir,
+        config_path=config_path,
+    )
+
+
+def install(config, installers, args):
+    from common.scheduler import Scheduler
+    workdir = config.workdir
+    workdir.prepare()
+    report = workdir.report
+    report.toolbox = config.toolbox_name
+    profiler = _Profiler() if args.profile else None
+    ok = False
+    try:
+        if profiler:
+            profiler.enable()
+        with report.phase("config write", installer="Activate"):
+            activate = render_activate(installers, config)
+            if activate.is_valid():
+                activate.write_template()
             else:
-                logger.info("Skip {}".format(installer.__class__.__name__))
-            print()
+                logger.error("Internal error in activate.sh template")
+                sys.exit(1)
+
+        scheduler = Scheduler(max_workers=args.jobs)
+        for installer in installers:
+            scheduler.add(
+                installer.__class__.__name__,
+                _make_install_task(installer, report, profiler),
+                depends_on=installer.depends_on,
+            )
+        scheduler.run()
+        ok = True
     finally:
         workdir.cleanup()
+        report.finish(ok)
+        report.write()
+        logger.info("Install report: {}".format(report.path))
+        if args.prometheus_textfile:
+            report.write_prometheus(args.prometheus_textfile)
+        if profiler:
+            profiler.disable()
+            profiler.dump(workdir.root / '.profile.pstats')
 
 
-    info = get_info(config)
-    _save_info_to_file(config)
-    print("\n\n")
-    print(info)
+def confirm_writes(installers):
+    for installer in installers:
+        installer.confirm_writes()
+
+
+def import_bundle(bundle_path, workdir):
+    """Unpack a bundle of another host, the install then only checks it"""
+    import tarfile
+    from common.bundle import BundleError, import_bundle as _import_bundle
+    try:
+        manifest = _import_bundle(Path(bundle_path), workdir.root)
+    except (BundleError, OSError, tarfile.TarError, ValueError) as exc:
+        logger.error("Error while import bundle {}".format(bundle_path))
+        logger.error(exc)
+        sys.exit(1)
+    logger.info("Bundle of {} from {} imported to {}".format(
+        manifest['toolbox_name'], manifest['root'], workdir.root,
+    ))
+
+
+def export_bundle(bundle_path, config):
+    import tarfile
+    from common.bundle import export_bundle as _export_bundle
+    from common.git import GitError
+    try:
+        _export_bundle(config.workdir.root, Path(bundle_path), config.toolbox_name)
+    except (GitError, OSError, tarfile.TarError) as exc:
+        logger.error("Error while export bundle {}".format(bundle_path))
+        logger.error(exc)
+        sys.exit(1)
+
+
+def make_installers(config) -> list:
+    from installers.ansible import Ansible
+    from installers.argocd import ArgoCD
+    from installers.gcloud import Gcloud
+    from installers.gron import Gron
+    from installers.helm import Helm
+    from installers.k9s import K9S
+    from installers.kubectl import Kubectl
+    from installers.python_venv import PythonVenv
+    from installers.ssh import SSH
+    from installers.terraform import Terraform
+    from installers.terragrunt import Terragrunt
+    from installers.vault import Vault
+    return [
+        SSH(config),
+        PythonVenv(config=config),
+        Vault(config),
+        Ansible(config),
+        Terraform(config),
+        Terragrunt(config),
+        Gcloud(config),
+        Kubectl(config),
+        K9S(config),
+        Gron(config),
+        Helm(config),
+        ArgoCD(config),
+    ]
+
+
+def render_activate(installers, config):
+    from installers.activate import Activate
+    activate_replaces = {}
+    activate = Activate(config)
+    for installer in installers:
+        activate_replaces.update(installer.make_activate_replaces())
+        activate.add_shims(installer.make_lazy_shims())
+    activate.replace(activate_replaces)
+    return activate
+
+
+def make_plan(installers, config) -> list:
+    """What install.py would do, without network and workdir changes"""
+    steps = render_activate(installers, config).plan()
+    for installer in installers:
+        steps += installer.plan()
+    return steps
+
+
+def print_plan(config, steps, plan_format="text"):
+    if plan_format == "json":
+        print(json.dumps(_plan_dict(config, steps), indent=2))
+        return
+    print("Plan for {} ({}):".format(config.toolbox_name, config.workdir.root))
+    if not steps:
+        print("\tNothing to do")
+    for step in steps:
+        print("\t{}".format(step))
+
+
+def _plan_dict(config, steps) -> dict:
+    return {
+        'toolbox': config.toolbox_name,
+        'workdir': str(config.workdir.root),
+        'steps': [step.to_dict() for step in steps],
+    }
+
+
+def _make_install_task(installer, report, profiler=None):
+    name = installer.__class__.__name__
+
+    def task():
+        if not installer.enabled:
+            logger.info("Skip {}".format(name))
+            return
+        logger.info("Install {}".format(name))
+        with report.installer(name):
+            if profiler:
+                profiler.run_in_thread(installer.install)
+            else:
+                installer.install()
+    return task
+
+
+class _Profiler:
+    """cProfile of the main thread and of every scheduler task
+
+    Before python 3.12 cProfile works per thread, so every task gets its own
+    profile and all of them are merged into one pstats file at the end. Since
+    3.12 the profile of the main thread covers all threads and only one
+    profiler can be active.
+    """
+
+    def __init__(self):
+        import cProfile
+        self._main = cProfile.Profile()
+        self._profiles = [self._main]
+        self._lock = threading.Lock()
+
+    def enable(self):
+        self._main.enable()
+
+    def disable(self):
+        self._main.disable()
+
+    def run_in_thread(self, func):
+        import cProfile
+        if sys.version_info >= (3, 12):
+            return func()
+        profile = cProfile.Profile()
+        with self._lock:
+            self._profiles.append(profile)
+        profile.enable()
+        try:
+            return func()
+        finally:
+            profile.disable()
+
+    def dump(self, path: Path, top: int = 25):
+        import io
+        import pstats
+        stats = pstats.Stats(self._profiles[0])
+        for profile in self._profiles[1:]:
+            # Profile without any calls can't be loaded by pstats
+            if profile.getstats():
+                stats.add(profile)
+        stats.dump_stats(str(path))
+        out = io.StringIO()
+        stats.stream = out
+        stats.sort_stats('cumulative').print_stats(top)
+        logger.info("Profile saved to {}".format(path))
+        logger.debug(out.getvalue())
 
 
 # for alias admin-toolbox-info
@@ -97,17 +383,32 @@ def _save_info_to_file(config):
         f.write(get_info(config))
 
 
+def _read_cached_info(workdir, config_path) -> Optional[str]:
+    """.info of the last install, if the config and install.py are older"""
+    info_path = workdir.root / '.info'
+    try:
+        info_mtime = os.stat(info_path).st_mtime_ns
+        for source in (Path(config_path).expanduser(), Path(os.path.realpath(__file__))):
+            if os.stat(source).st_mtime_ns > info_mtime:
+                logger.debug("{} is newer than {}".format(source, info_path))
+                return None
+        with open(info_path, 'r') as f:
+            return f.read()
+    except OSError:
+        return None
+
+
 def get_info(config):
+    """Only config values, installers are not created here"""
     help = []
-    activate = Activate()
-    ansible = Ansible()
-    gcloud = Gcloud()
-    help.append("To start working with the env: \n\tsource {}".format(activate.install_path))
+    activate_path = config.workdir.root / 'activate'
+    ansible_repo = Path(config.ansible_repo_path)
+    help.append("To start working with the env: \n\tsource {}".format(activate_path))
     help.append("To end working with the env: \n\tdeactivate")
-    help.append("Add alias to .<shell>rc: \n\t alias [alias]=\"source {}\"".format(activate.install_path))
+    help.append("Add alias to .<shell>rc: \n\t alias [alias]=\"source {}\"".format(activate_path))
     help.append("\nToolbox dir: {}".format(config.workdir.root))
-    help.append("Ansible: {}".format(ansible.repo))
-    if gcloud.version and gcloud.url:
+    help.append("Ansible: {}".format(ansible_repo))
+    if config.gcloud_ver and config.gcloud_url:
         help.append("\nGoogle:\n\tLogin to gcloud with: gcloud auth login --no-launch-browser")
         help.append("\tToestaan == accept")
         help.append("\tUse browser with proxy (waterfox?)")
@@ -116,7 +417,7 @@ def get_info(config):
     help.append("\nCLI:")
     help.append("\tVault login:> vault-login <username>")
     help.append("\tVault logout:> vault-logout")
-    if ansible.repo:
+    if ansible_repo:
         help.append("\tcd to Ansible dir:> ans")
         help.append("\tcd to dir in Ansible:> cd $ans/common_roles")
     return '\n'.join(help)
@@ -126,23 +427,75 @@ if __name__ == "__main__":
     parser = ArgumentParser()
     parser.add_argument(
         "-c", "--config",
-        required=True,
     )
     parser.add_argument(
         "-w", "--workdir",
         help="Workdir with binaries and configs (default: ~/.admin-toolbox)",
-        required=True,
     )
     parser.add_argument(
         "-n", "--toolbox-name",
         help="Toolbox name",
-        required=True,
     )
     parser.add_argument(
         "-i", "--info",
         action='store_true',
         default=False,
     )
+    parser.add_argument(
+        "--plan",
+        action='store_true',
+        help="show what would be installed or changed, and why, then exit",
+        default=False,
+    )
+    parser.add_argument(
+        "--plan-format",
+        choices=["text", "json"],
+        default="text",
+    )
+    parser.add_argument(
+        "-j", "--jobs",
+        type=int,
+        help="How many installers run at the same time (default: 4)",
+        default=4,
+    )
+    parser.add_argument(
+        "--verify-installed",
+        action='store_true',
+        help="check sha256 of installed binaries, not only size and mtime",
+        default=False,
+    )
+    parser.add_argument(
+        "--prometheus-textfile",
+        help="also write the install report as prometheus textfile (node_exporter)",
+        default="",
+    )
+    parser.add_argument(
+        "--profile",
+        action='store_true',
+        help="cProfile install.py, saved to <workdir>/.profile.pstats",
+        default=False,
+    )
+    parser.add_argument(
+        "--export-bundle",
+        help="after the install pack the workdir into a tar.gz bundle for --import-bundle",
+        default="",
+    )
+    parser.add_argument(
+        "--import-bundle",
+        help="unpack a bundle made with --export-bundle to the empty workdir, then install",
+        default="",
+    )
+    parser.add_argument(
+        "--fleet",
+        help="json file with toolboxes (config, workdir, name) to install in one run, instead of -c, -w, -n",
+        default="",
+    )
+    parser.add_argument(
+        "--fleet-jobs",
+        type=int,
+        help="How many toolboxes of --fleet are installed at the same time (default: 4)",
+        default=4,
+    )
     parser.add_argument(
         "--debug",
         action='store_true',
@@ -150,5 +503,10 @@ if __name__ == "__main__":
         default=False,
     )
     args = parser.parse_args()
+    if args.fleet:
+        if args.info or args.profile or args.import_bundle or args.export_bundle:
+            parser.error("--fleet can't be used with --info, --profile and bundles")
+    elif not (args.config and args.workdir and args.toolbox_name):
+        parser.error("the following arguments are required: -c/--config, -w/--workdir, -n/--toolbox-name")
     run(args)
 
@@ -1,14 +1,54 @@
-from common.config import get_config
-from common.logger import logger
+import os
 import re
+import shutil
+from pathlib import Path
+from typing import Optional
+from common.config import Config, get_config
+from common.logger import logger
+from installers.installer import PlanStep
+
+
+SHELLS = ('bash', 'zsh')
+PLACEHOLDER_REGEX = re.compile(r'<([A-Z][A-Z0-9_ ]*)>')
+SECTION_REGEX = re.compile(r'^\s*# @(if|else|endif)\b\s*(\S*)\s*$')
+
+DISPATCHER = """\
+# Sources activate script compiled for the current shell
+if [ -n "${{ZSH_VERSION-}}" ]; then
+    source "{zsh}"
+else
+    source "{bash}"
+fi
+"""
 
 
 class Activate:
-    def __init__(self):
-        self._config = get_config()
+    """Compiles templates/activate.sh into activate.bash and activate.zsh
+
+    Template sections `# @if NAME` ... `# @else` ... `# @endif` are kept only
+    if placeholder <NAME> is not empty or NAME is the target shell, so the
+    scripts contain no code of disabled tools and no runtime checks for them.
+    `activate` only sources the script of the current shell.
+
+    In lazy mode (activate.lazy in config) the scripts only set exports and
+    aliases: <workdir>/bin/shims has links to templates/lazy_shim.sh named
+    after the tools of make_lazy_shims(), the shim loads vault env vars or
+    starts ssh-agent once per shell session and runs the tool.
+    """
+
+    def __init__(self, config: Optional[Config] = None):
+        self._config = config or get_config()
         self.template_path = self._config.templates_path / 'activate.sh'
         self.install_path = self._config.workdir.root / 'activate'
+        self.lazy = self._config.activate_lazy
+        self.shims_dir = self._config.workdir.bin / 'shims'
+        self.shim_template_path = self._config.templates_path / 'lazy_shim.sh'
+        self.shim_path = self.shims_dir / '.shim'
+        self.shims: list[str] = []
         self.template = ""
+        self.replaces: dict[str, str] = {}
+        self.errors: list[str] = []
+        self._scripts: dict[Path, str] = {}
         self.load_template()
 
     def load_template(self):
@@ -16,31 +56,166 @@ class Activate:
             self.template = f.read()
             self._apply_default_replaces()
 
+    def shell_path(self, shell: str) -> Path:
+        return self.install_path.with_name('activate.{}'.format(shell))
+
     def write_template(self):
-        with open(self.install_path, 'w') as f:
-            f.write(self.template)
+        if self.lazy:
+            self.shims_dir.mkdir(parents=True, exist_ok=True)
+        elif self.shims_dir.exists():
+            shutil.rmtree(self.shims_dir)
+        for path, content in self.compile().items():
+            if path.exists():
+                with open(path, 'r') as f:
+                    if f.read() == content:
+                        continue
+            tmp_path = path.with_name(path.name + '.tmp')
+            with open(tmp_path, 'w') as f:
+                f.write(content)
+            if path == self.shim_path:
+                os.chmod(tmp_path, 0o755)
+            os.replace(tmp_path, path)
+        if self.lazy:
+            self._link_shims()
+
+    def add_shims(self, names: list):
+        self.shims += [name for name in names if name not in self.shims]
 
     def replace(self, replaces: dict[str, str]):
-        for repl_from, repl_to in replaces.items():
-            self.template = self.template.replace(repl_from, repl_to)
+        self.replaces.update(replaces)
+        self._scripts = {}
 
-    def is_valid(self) -> bool:
-        variable_regex = re.compile('.*<.*>.*')
-        for line in self.template.split('\n'):
-            if variable_regex.match(line):
-                logger.error(
-                    "Error. 'activate' contains variable from template ({})".format(line)
+    def compile(self) -> dict[Path, str]:
+        """Scripts to write, path -> content. Errors are in self.errors"""
+        if not self._scripts:
+            self.errors = []
+            scripts = {
+                self.install_path: DISPATCHER.format(
+                    **{shell: self.shell_path(shell) for shell in SHELLS}
+                ),
+            }
+            for shell in SHELLS:
+                scripts[self.shell_path(shell)] = self._compile(
+                    self.template, shell, "activate.{}".format(shell),
                 )
-                return False
-        return True
+            if self.lazy:
+                with open(self.shim_template_path, 'r') as f:
+                    scripts[self.shim_path] = self._compile(f.read(), 'bash', "lazy shim")
+            self._scripts = scripts
+        return self._scripts
+
+    def plan(self) -> list:
+        """Steps for writing the compiled scripts, call after replace()"""
+        changed = []
+        for path, content in self.compile().items():
+            if not path.exists():
+                changed.append("{} doesn't exist".format(path))
+                continue
+            with open(path, 'r') as f:
+                if f.read() != content:
+                    changed.append("{} content changed".format(path))
+        if self.lazy and set(self._linked_shims()) != set(self.shims):
+            changed.append("{} links changed".format(self.shims_dir))
+        elif not self.lazy and self.shims_dir.exists():
+            changed.append("{} is not used".format(self.shims_dir))
+        if not changed:
+            return []
+        return [PlanStep(self.__class__.__name__, "write activate", ', '.join(changed))]
+
+    def is_valid(self) -> bool:
+        self.compile()
+        for error in self.errors:
+            logger.error("Error. 'activate' template: {}".format(error))
+        return not self.errors
+
+    def _linked_shims(self) -> list:
+        if not self.shims_dir.exists():
+            return []
+        return [
+            path.name for path in self.shims_dir.iterdir()
+            if path.is_symlink() and os.readlink(path) == self.shim_path.name
+        ]
+
+    def _link_shims(self):
+        linked = self._linked_shims()
+        for name in linked:
+            if name not in self.shims:
+                os.remove(self.shims_dir / name)
+        for name in self.shims:
+            if name not in linked:
+                link = self.shims_dir / name
+                if link.is_symlink() or link.exists():
+                    os.remove(link)
+                os.symlink(self.shim_path.name, link)
+
+    def _compile(self, template: str, shell: str, name: str) -> str:
+        replaces = dict(self.replaces)
+        replaces['<ALIASES>'] = 'BASH_ALIASES' if shell == 'bash' else 'aliases'
+
+        lines = []
+        # (keep lines of the enclosing section, condition of this section)
+        sections = []
+        keep = True
+        for number, line in enumerate(template.split('\n'), 1):
+            match = SECTION_REGEX.match(line)
+            if not match:
+                if keep:
+                    lines.append(line)
+                continue
+            directive, section = match.groups()
+            if directive == 'if':
+                condition = self._condition(section, shell, replaces, name, number)
+                sections.append((keep, condition))
+                keep = keep and condition
+            elif not sections:
+                self._error(name, number, "'@{}' without '@if'".format(directive))
+            elif directive == 'else':
+                outer_keep, condition = sections[-1]
+                keep = outer_keep and not condition
+            else:
+                keep = sections.pop()[0]
+        if sections:
+            self._error(name, number, "'@if' without '@endif'")
+
+        # Sections removed from the middle of the script leave empty lines
+        script = re.sub(r'\n{3,}', '\n\n', '\n'.join(lines))
+
+        unknown = set()
+
+        def substitute(match):
+            if match.group(0) not in replaces:
+                unknown.add(match.group(0))
+                return match.group(0)
+            return replaces[match.group(0)]
+
+        script = PLACEHOLDER_REGEX.sub(substitute, script)
+        for placeholder in sorted(unknown):
+            self._error(name, None, "no value for {}".format(placeholder))
+        return script
+
+    def _condition(self, section: str, shell: str, replaces: dict, name: str, number: int) -> bool:
+        if section in SHELLS:
+            return section == shell
+        placeholder = '<{}>'.format(section)
+        if placeholder not in replaces:
+            self._error(name, number, "no value for section {}".format(placeholder))
+            return False
+        return bool(replaces[placeholder])
+
+    def _error(self, name: str, number, message: str):
+        where = name
+        if number is not None:
+            where = "{}, template line {}".format(where, number)
+        self.errors.append("{}: {}".format(where, message))
 
     def _apply_default_replaces(self):
         replaces = {
             "<TOOLBOX_NAME>": str(self._config.toolbox_name),
+            "<TOOLBOX_PROMPT>": os.path.basename(str(self._config.toolbox_name)),
             "<WORKDIR_ROOT>": str(self._config.workdir.root),
             "<WORKDIR_TMP>": str(self._config.workdir.tmp),
             "<WORKDIR_BIN>": str(self._config.workdir.bin),
+            "<LAZY>": "true" if self.lazy else "",
+            "<LAZY_SHIMS_DIR>": str(self.shims_dir),
         }
         self.replace(replaces)
-
-
@@ -1,20 +1,39 @@
+import difflib
+import io
 import shutil
 import os
 import subprocess
 import sys
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from typing import Optional
+from common import git
 from common.logger import logger
-from common.config import get_config
+from common.config import Config, get_config
 from configparser import ConfigParser
 from installers.python_venv import PythonVenv
 from installers.installer import Installer
 from installers.ssh import SSH
 
+# Entry points of ansible-core, shims of the lazy activate mode
+ANSIBLE_COMMANDS = (
+    'ansible',
+    'ansible-config',
+    'ansible-console',
+    'ansible-doc',
+    'ansible-galaxy',
+    'ansible-inventory',
+    'ansible-playbook',
+    'ansible-pull',
+    'ansible-vault',
+)
+
 
 class Ansible(Installer):
+    depends_on = ('PythonVenv', 'SSH')
 
-    def __init__(self):
-        self._config = get_config()
+    def __init__(self, config: Optional[Config] = None):
+        self._config = config or get_config()
         self.workdir = self._config.workdir
         self.enabled = self._config.ansible_enabled
         self.repo: Path = Path(self._config.ansible_repo_path)
@@ -22,24 +41,48 @@ class Ansible(Installer):
         self.repo_url = self._config.ansible_repo_url
         self.workdir_ansible = self.workdir.root / 'ansible/'
         self.workdir_root_bin = self.workdir.bin
-        self.venv = PythonVenv(self.workdir_ansible / 'venv/')
+        self.venv = PythonVenv(self.workdir_ansible / 'venv/', self._config)
         self.cfg_path = self._config.ansible_cfg_path
         self.repo_cfg_path = self._config.ansible_repo_cfg_path
         self.activate_path = self.workdir.root / "activate"
         self.inventory_file_path = self.workdir_ansible / "inventory.ini"
         self.use_ssh_agent = self._config.ansible_use_ssh_agent
         self.use_venv_for_localhost_delegation = self._config.ansible_use_venv_for_localhost_delegation
-        self.python = PythonVenv()
-        self._prepare_dirs()
+        self.python = PythonVenv(config=self._config)
+        # (path, current content, new content) of configs changed by hand
+        self.pending_writes: list[tuple] = []
 
     def install(self):
-        self._create_venv()
-        self._clone_repo()
+        report = self.workdir.report
+        self._prepare_dirs()
+        # The clone and the venv don't depend on each other,
+        # pip waits for both (requirements.txt is in the repo)
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            clone = executor.submit(self._clone_repo)
+            self.venv.prepare(self._venv_requirements()[0])
+            clone.result()
         self._install_venv_requirements()
-        self._setup_ansible_cfg()
+        with report.phase("config write"):
+            self._setup_ansible_cfg()
         self._create_bin_links()
         #self._delete_repo()
 
+    def plan(self) -> list:
+        if not self.enabled:
+            return []
+        steps = []
+        if self.repo_url and not self.repo.exists():
+            steps.append(self._step(
+                "clone", "{} doesn't exist, {} clone".format(self.repo, self._config.ansible_clone_mode),
+            ))
+        steps += self._own_steps(self.venv.plan_ensure(*self._venv_requirements()))
+        if self.use_venv_for_localhost_delegation:
+            steps += self._plan_write(
+                self.inventory_file_path, self._render_inventory(), "inventory.ini",
+            )
+        steps += self._plan_write(self.cfg_path, self._render_ansible_cfg(), "ansible.cfg")
+        return steps
+
     def make_activate_replaces(self) -> dict:
         replaces = {
             "<ANSIBLE_PATH>": str(self.repo),
@@ -53,56 +96,90 @@ class Ansible(Installer):
             replaces["<ANSIBLE_ENABLED>"] = "true"
         return replaces
 
+    def make_lazy_shims(self) -> list:
+        if not self.enabled:
+            return []
+        return list(ANSIBLE_COMMANDS)
+
     def _prepare_dirs(self):
         self.workdir_ansible.mkdir(exist_ok=True)
 
-    def _create_venv(self):
-        self.venv.create_venv(force=True)
-
     def _clone_repo(self):
         if not self.repo_url:
             logger.info("No ansible repo, skip clone")
             return
-        if self.repo.exists():
+        with self.workdir.report.phase("git clone", self.__class__.__name__):
+            if self.repo.exists():
+                self._update_repo()
+                return
+            mode = self._config.ansible_clone_mode
+            logger.info("Clone ansible repo to {} ({} clone)".format(self.repo, mode))
+            try:
+                git.clone(
+                    self.repo_url,
+                    self.repo,
+                    mode=mode,
+                    branch=self._config.ansible_repo_branch,
+                    depth=self._config.ansible_clone_depth,
+                    sparse_paths=self._config.ansible_clone_sparse_paths,
+                    reference=self._clone_reference(),
+                )
+            except git.GitError as exc:
+                logger.error(
+                    "Error while clone ansible repo {}".format(self.repo_url)
+                )
+                logger.error(exc)
+                sys.exit(1)
+
+    def _update_repo(self):
+        if not self._config.ansible_repo_update:
+            logger.info("Ansible repo already exists, skip update ({})".format(self.repo))
+            return
+        if git.origin_url(self.repo) != self.repo_url:
             logger.info(
-                ("Ansible repo already exists, skip clone ({}). "
-                "Do `git pull`"
-                ).format(self.repo)
+                "Ansible repo {} is not a clone of {}, skip update".format(self.repo, self.repo_url)
             )
             return
-        logger.info("Clone ansible repo to {}".format(self.repo))
         try:
-            subprocess.run(
-                ['git', 'clone', self.repo_url, str(self.repo)],
-                check=True,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.STDOUT,
+            if git.update(self.repo):
+                logger.info("Ansible repo updated ({})".format(self.repo))
+        except git.GitError as exc:
+            # Local commits or changes, offline, ... - the repo is left as is
+            logger.warning(
+                "Can't fast-forward ansible repo {}, do `git pull`".format(self.repo)
             )
-        except subprocess.CalledProcessError as exc:
-            logger.error(
-                "Error while clone ansible repo {}".format(self.repo_url)
-            )
-            logger.error(exc.stdout)
-            sys.exit(1)
+            logger.warning(exc)
+
+    def _clone_reference(self):
+        """Repo to borrow objects from; 'cache' is a mirror in the cache dir,
+        shared by the toolboxes of the user"""
+        reference = self._config.ansible_clone_reference
+        if not reference:
+            return None
+        if reference != "cache":
+            return Path(reference).expanduser()
+        if not self._config.cache_enabled:
+            logger.debug("Cache is disabled, clone ansible repo without reference")
+            return None
+        return git.reference_mirror(self.repo_url, Path(self._config.cache_path) / 'git')
 
     def _delete_repo(self):
         if self.repo.exists():
             shutil.rmtree(self.repo)
 
-    def _install_venv_requirements(self):
+    def _venv_requirements(self) -> tuple:
+        # ansible, venv_packages and the repo requirements are resolved together
+        packages = list(self._config.ansible_venv_packages)
         if self.version:
-            self.venv.install_packages(['ansible=={}'.format(self.version)])
-        requirements = self.repo.joinpath("requirements.txt")
+            packages.append('ansible=={}'.format(self.version))
+        requirements = []
+        if self.repo.joinpath("requirements.txt").exists():
+            requirements.append(self.repo.joinpath("requirements.txt"))
+        return packages, requirements
+
+    def _install_venv_requirements(self):
         logger.debug('Install ansible requirements')
-        if requirements.exists():
-            try:
-                self.venv.install_requirements(requirements)
-            except subprocess.CalledProcessError as exc:
-                logger.error(
-                    "Error while install ansible requirements",
-                )
-                logger.error(exc.stdout)
-                sys.exit(1)
+        self.venv.ensure(*self._venv_requirements())
 
     def _create_bin_links(self):
         bin_files = [
@@ -130,105 +207,104 @@ class Ansible(Installer):
                 logger.error(exc.stdout)
                 sys.exit(1)
 
-    def _setup_ansible_cfg_ssh(self, tmp_src_cfg_path: Path, default_src_cfg: Path):
-        ssh = SSH()
+    def _setup_ansible_cfg_ssh(self, config: ConfigParser, src_cfg_path: Path) -> bool:
+        ssh = SSH(self._config)
         if not ssh.enabled or not self.use_ssh_agent:
             logger.debug("Ansible: not ssh.enabled or not self.use_ssh_agent")
-            return
-        config = ConfigParser()
-        config.read(tmp_src_cfg_path)
+            return False
         if "ssh_connection" in config:
-            logger.warn(
-                "[ssh_connection] section already exists in ansible config {}, ".format(default_src_cfg),
-                "skip ssh bastion setup for ansible"
+            logger.warning(
+                "[ssh_connection] section already exists in ansible config {}, "
+                "skip ssh bastion setup for ansible".format(src_cfg_path)
             )
-            return
+            return False
         config["ssh_connection"] = {}
         config["ssh_connection"]["ssh_args"] = "-F {}\n".format(ssh.config_path)
-        with open(tmp_src_cfg_path, 'w') as f:
-            config.write(f)
-
-    def _setup_ansible_cfg_inventory(
-            self,
-            tmp_src_cfg_path: Path,
-            tmp_src_inventory_path: Path
-        ):
+        return True
+
+    def _setup_ansible_cfg_inventory(self, config: ConfigParser) -> bool:
         if not self.use_venv_for_localhost_delegation:
             logger.debug("Ansible: use_venv_for_localhost_delegation is false")
-            return
-        from configparser import ConfigParser
-        config = ConfigParser()
-        config.read(tmp_src_cfg_path)
-
-        inventory_content = (
-            "localhost ansible_connection=local "
-            "ansible_python_interpreter={}/python\n".format(self.venv.bin_path)
-        )
-
-        with open(tmp_src_inventory_path, 'w') as f:
-            f.write(inventory_content)
-
-        self._copy_file(tmp_src_inventory_path, self.inventory_file_path)
+            return False
 
         if not 'defaults' in config:
             config['defaults'] = {}
 
         if not 'inventory' in config['defaults']:
-            config['default']['inventory'] = str(self.inventory_file_path)
+            config['defaults']['inventory'] = str(self.inventory_file_path)
         else:
             current_inventory = config['defaults']['inventory']
             config['defaults']['inventory'] = "{},{}".format(
                 current_inventory,
                 self.inventory_file_path,
             )
+        return True
 
-        with open(tmp_src_cfg_path, 'w') as f:
-            config.write(f)
-
-
-    def _setup_ansible_cfg(self):
+    def _src_cfg_path(self) -> Path:
         if os.path.exists(self.repo_cfg_path):
-            default_src_cfg = Path(self.repo_cfg_path)
-        else:
-            default_src_cfg = self._config.toolbox_repo_dir / 'ansible.cfg'
-        print("Ansible source cfg: {}".format(default_src_cfg))
-
-        tmp_src_cfg_path = self._config.workdir.root / "_tmp_ansible.cfg"
-        shutil.copyfile(default_src_cfg, tmp_src_cfg_path)
+            return Path(self.repo_cfg_path)
+        return self._config.toolbox_repo_dir / 'ansible.cfg'
 
-        self._setup_ansible_cfg_ssh(tmp_src_cfg_path, default_src_cfg)
+    def _render_ansible_cfg(self) -> str:
+        src_cfg_path = self._src_cfg_path()
+        with open(src_cfg_path, 'r') as f:
+            src_cfg = f.read()
+        config = ConfigParser(interpolation=None)
+        config.read_string(src_cfg)
+        changed = self._setup_ansible_cfg_ssh(config, src_cfg_path)
+        changed = self._setup_ansible_cfg_inventory(config) or changed
+        if not changed:
+            return src_cfg
+        out = io.StringIO()
+        config.write(out)
+        return out.getvalue()
 
-        tmp_src_inventory_path = self._config.workdir.root / "_tmp_inventory.ini"
-        self._setup_ansible_cfg_inventory(tmp_src_cfg_path, tmp_src_inventory_path)
+    def _render_inventory(self) -> str:
+        return (
+            "localhost ansible_connection=local "
+            "ansible_python_interpreter={}/python\n".format(self.venv.bin_path)
+        )
 
-        self._copy_file(tmp_src_cfg_path, self.cfg_path)
+    def _setup_ansible_cfg(self):
+        logger.debug("Ansible source cfg: {}".format(self._src_cfg_path()))
+        if self.use_venv_for_localhost_delegation:
+            self._write_file(self.inventory_file_path, self._render_inventory())
+        self._write_file(self.cfg_path, self._render_ansible_cfg())
         os.chmod(self.cfg_path, 0o0660)
 
-    def _copy_file(self, src, dest, no_ask=False):
-        if no_ask:
-            override = 'Y'
-        else:
-            override = 'N'
-        if not no_ask and os.path.exists(self.cfg_path):
-            diff = subprocess.run(
-                ['diff', src, dest],
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-            ).stdout.decode('utf-8')
-            if not diff:
-                override = "y"
-            else:
-                print("File config diff {} {}:".format(src, dest))
-                print(diff)
-                override = input('File already exists, override? \n \t{} -> {} \n (y/N): '.format(
-                    src, dest
-                ))
-
-        else:
-            override = "y"
-
-        if override.lower() == 'y':
-            shutil.copy(src, dest)
-        else:
-            logger.info("Skip {}", dest)
+    def _write_file(self, dest: Path, content: str, no_ask=False):
+        if os.path.exists(dest):
+            with open(dest, 'r') as f:
+                current = f.read()
+            if current == content:
+                logger.debug("{} is up to date".format(dest))
+                return
+            if not no_ask:
+                # Installers run in threads, confirm_writes() asks later
+                self.pending_writes.append((dest, current, content))
+                return
+        with open(dest, 'w') as f:
+            f.write(content)
 
+    def confirm_writes(self):
+        for dest, current, content in self.pending_writes:
+            if not sys.stdin.isatty():
+                logger.warning("{} differs from the new content, skip: stdin is not a terminal".format(dest))
+                continue
+            diff = ''.join(difflib.unified_diff(
+                current.splitlines(keepends=True),
+                content.splitlines(keepends=True),
+                str(dest),
+                "new",
+            ))
+            print("File config diff {}:".format(dest))
+            print(diff)
+            override = input('File already exists, override? \n \t{} \n (y/N): '.format(
+                dest
+            ))
+            if override.lower() != 'y':
+                logger.info("Skip {}".format(dest))
+                continue
+            with open(dest, 'w') as f:
+                f.write(content)
+        self.pending_writes = []
@@ -4,16 +4,17 @@ import os
 import re
 import shutil
 from pathlib import Path
+from typing import Optional
 from common.logger import logger
-from common.config import get_config
-from common.download_file import download_file
-from installers.installer import Installer
+from common.config import Config, get_config
+from common.artifact_cache import download_artifact
+from installers.installer import BinaryInstaller
 
 
-class ArgoCD(Installer):
+class ArgoCD(BinaryInstaller):
 
-    def __init__(self):
-        self._config = get_config()
+    def __init__(self, config: Optional[Config] = None):
+        self._config = config or get_config()
         self.enabled = self._config.argocd_enabled
         self.workdir = self._config.workdir
         self.desired_platform = self._config.platform
@@ -24,15 +25,17 @@ class ArgoCD(Installer):
 
     def install(self):
         logger.info('Install ArgoCD ...')
-        current_version = self._check_current_ver()
+        current_version = self._current_version()
         if current_version == self.desired_ver:
             logger.info('argocd already installed')
             return
         self._download()
+        self._record_installed()
         logger.info("ArgoCD installed")
 
     def make_activate_replaces(self) -> dict:
         return {
+            "<ARGOCD_ENABLED>": "true" if self.enabled else "",
             "<ALIAS_ARGOCD>": f"argocd='argocd --config {self.cfg_path}'",
         }
 
@@ -69,7 +72,7 @@ class ArgoCD(Installer):
         )
 
         logger.debug('Download argocd {} -> {}'.format(url, self.bin_path))
-        if not download_file(url, self.bin_path, self._config.proxies):
+        if not download_artifact(url, self.bin_path, self._config):
             sys.exit(1)
         os.chmod(self.bin_path, 0o550)
 
@@ -1,19 +1,25 @@
+import io
+import json
 import subprocess
 import re
 import os
 import sys
 import shutil
+import time
+from configparser import ConfigParser
 from pathlib import Path
+from typing import Optional
 from common.logger import logger
-from common.config import get_config
-from common.download_file import download_file
-from installers.installer import Installer
+from common.config import Config, get_config
+from common.extract import download_and_extract_tree
+from common.manifest import file_sha256
+from installers.installer import BinaryInstaller
 
 
-class Gcloud(Installer):
+class Gcloud(BinaryInstaller):
 
-    def __init__(self):
-        self._config = get_config()
+    def __init__(self, config: Optional[Config] = None):
+        self._config = config or get_config()
         self.enabled = self._config.gcloud_enabled
         self.workdir = self._config.workdir
         self.workdir_gcloud = self.workdir.root / 'gcloud/'
@@ -24,20 +30,44 @@ class Gcloud(Installer):
         self.cfg_path = self.workdir_gcloud / 'cfg'
         self.version = self._config.gcloud_ver
         self.url = self._config.gcloud_url
+        self.sdk_path = self.workdir_gcloud / 'google-cloud-sdk'
+        self.components = list(self._config.gcloud_components)
+        # Components installed by us, {"sdk_version": ..., "components": [...]}
+        self.components_snapshot_path = self.workdir_gcloud / 'components.json'
 
     def install(self):
         logger.info('Install gcloud ...')
         self._prepare()
-        current_version = self._check_current_ver()
+        current_version = self._current_version()
         if current_version == self.desired_ver:
             logger.info('Gcloud already installed')
         else:
             self._download()
+            self._record_installed()
             logger.info("Gcloud installed")
-        self._install_components()
-        logger.info("Gcloud components installed")
-        self._prepare_config()
+        missing = self._missing_components()
+        if missing:
+            with self.workdir.report.phase("components install"):
+                self._install_components(missing)
+            logger.info("Gcloud components installed")
+        else:
+            logger.debug("Gcloud components already installed")
+        with self.workdir.report.phase("config write"):
+            self._prepare_config()
+
 
+    def plan(self) -> list:
+        steps = super().plan()
+        if not self.enabled:
+            return steps
+        # A new SDK comes without components
+        missing = self.components if steps else self._missing_components()
+        if missing:
+            steps.append(self._step("install components", ' '.join(missing)))
+        properties = self._render_properties()
+        if properties is not None:
+            steps += self._plan_write(self._properties_path(), properties, "gcloud properties")
+        return steps
 
     def make_activate_replaces(self) -> dict:
         replaces = {
@@ -50,6 +80,13 @@ class Gcloud(Installer):
             replaces['<GCLOUD_ENABLED>'] = ""
         return replaces
 
+    def _manifest_path(self):
+        # bin/gcloud is the same wrapper script in every SDK release
+        version_file = self.workdir_gcloud / 'google-cloud-sdk/VERSION'
+        if version_file.exists():
+            return version_file
+        return self.bin_path
+
     def _prepare(self):
         self.workdir_gcloud.mkdir(exist_ok=True)
         self.cfg_path.mkdir(exist_ok=True)
@@ -81,40 +118,33 @@ class Gcloud(Installer):
             sys.exit(1)
 
     def _download(self):
+        """Unpacks the new SDK next to the current one, files which didn't
+        change are hardlinked from it. google-cloud-sdk is a symlink to the
+        SDK dir, it is switched to the new SDK when it is ready"""
         url = self.download_url.format(
             ver=self.desired_ver,
             os=self.desired_platform,
             arch="x86_64",
         )
-        zip_arch = self.workdir.tmp / 'gcloud.zip'
-
-        logger.debug('Download gcloud {} -> {}'.format(url, zip_arch))
-        if not download_file(url, zip_arch, self._config.proxies):
-            sys.exit(1)
+        current_tree = self._current_tree()
+        new_tree = self.workdir_gcloud / 'sdk-{}-{}'.format(self.desired_ver, int(time.time()))
+        staging = new_tree.with_name(new_tree.name + '.tmp')
+        if staging.exists():
+            shutil.rmtree(staging)
 
-        # Remove old version
-        release_dir = self.workdir_gcloud / 'google-cloud-sdk'
-        if os.path.exists(release_dir):
-            shutil.rmtree(release_dir)
-
-        # Unzip
-        logger.debug('Unzip gcloud {}'.format(zip_arch))
-        try:
-            Path(self.workdir.root / 'gcloud').mkdir(exist_ok=True)
-            subprocess.run(
-                ['tar', '-x', '-f', zip_arch, '-C', self.workdir.root / 'gcloud'],
-                check=True,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.STDOUT,
-            )
-        except subprocess.CalledProcessError as exc:
-            logger.error("Error while unpack gcloud")
-            logger.error(exc.stdout)
-            sys.exit(1)
+        logger.debug('Download gcloud {} -> {}'.format(url, staging))
+        files = download_and_extract_tree(
+            url, staging, self._config, self._linkable_files(current_tree),
+        )
+        os.rename(staging / 'google-cloud-sdk', new_tree)
+        shutil.rmtree(staging)
+        prefix = 'google-cloud-sdk/'
+        self._write_tree_manifest(new_tree, {
+            name[len(prefix):]: entry for name, entry in files.items() if name.startswith(prefix)
+        })
+        self._switch_tree(new_tree)
 
         logger.debug('Link gcloud bin to {}'.format(self.bin_path))
-        os.remove(zip_arch)
-
         # ln -s to bin
         try:
             subprocess.run(
@@ -128,51 +158,184 @@ class Gcloud(Installer):
             logger.error(exc.stdout)
             sys.exit(1)
 
+    def _current_tree(self) -> Optional[Path]:
+        if self.sdk_path.is_symlink():
+            return self.sdk_path.resolve() if self.sdk_path.exists() else None
+        # Installed before SDK dirs were versioned
+        if self.sdk_path.is_dir():
+            return self.sdk_path
+        return None
+
+    def _tree_manifest_path(self, tree: Path) -> Path:
+        return tree.with_name(tree.name + '.files.json')
 
-    def _install_components(self):
-        components = ['gke-gcloud-auth-plugin']
-        for component in components:
-            logger.info("\tInstall gcloud component: {} ...".format(component))
+    def _write_tree_manifest(self, tree: Path, files: dict):
+        path = self._tree_manifest_path(tree)
+        tmp_path = path.with_name(path.name + '.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(files, f)
+        os.replace(tmp_path, path)
+
+    def _linkable_files(self, tree: Optional[Path]) -> dict:
+        """{sha256: path} of files of the SDK tree which are unchanged since
+        it was unpacked (same size and mtime as in its manifest)"""
+        if not tree:
+            return {}
+        manifest_path = self._tree_manifest_path(tree)
+        linkable = {}
+        if not manifest_path.exists():
+            # No manifest for an SDK of an older toolbox, hash its files
+            for root, _, names in os.walk(tree):
+                for name in names:
+                    path = os.path.join(root, name)
+                    if os.path.isfile(path) and not os.path.islink(path):
+                        linkable[file_sha256(path)] = path
+            return linkable
+        with open(manifest_path, 'r') as f:
+            files = json.load(f)
+        for name, entry in files.items():
+            path = tree / name
             try:
-                subprocess.run(
-                    [self.bin_path, 'components', 'install', '-q', component],
-                    check=True,
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.STDOUT,
-                )
-            except subprocess.CalledProcessError as exc:
-                logger.error(
-                    "Error while install gcloud component {}".format(component)
-                )
-                logger.error(exc.stdout)
-                sys.exit(1)
-
-    def _exec(self, cmd):
-        os.environ['CLOUDSDK_CONFIG'] = str(self.cfg_path)
+                stat = os.lstat(path)
+            except FileNotFoundError:
+                continue
+            if stat.st_size == entry['size'] and stat.st_mtime_ns == entry['mtime']:
+                linkable[entry['sha256']] = path
+        return linkable
+
+    def _switch_tree(self, new_tree: Path):
+        tmp_link = self.sdk_path.with_name(self.sdk_path.name + '.tmp')
+        if tmp_link.is_symlink() or tmp_link.exists():
+            os.remove(tmp_link)
+        os.symlink(new_tree.name, tmp_link)
+        # os.replace() can't put a link in place of a dir: the SDK of older
+        # versions is moved aside right before the link takes its place
+        if not self.sdk_path.is_symlink() and self.sdk_path.is_dir():
+            os.rename(self.sdk_path, self.workdir_gcloud / 'sdk-legacy')
+        os.replace(tmp_link, self.sdk_path)
+        # Old SDKs and leftovers of interrupted upgrades
+        for path in self.workdir_gcloud.glob('sdk-*'):
+            if path == new_tree or path == self._tree_manifest_path(new_tree):
+                continue
+            if path.is_dir() and not path.is_symlink():
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+
+    def _sdk_version(self):
+        version_file = self.sdk_path / 'VERSION'
+        if not version_file.exists():
+            return None
+        with open(version_file, 'r') as f:
+            return f.read().strip()
+
+    def _missing_components(self) -> list:
+        """Components which are not in the snapshot of the installed SDK version"""
+        if not self.components:
+            return []
+        snapshot = {}
+        if self.components_snapshot_path.exists():
+            try:
+                with open(self.components_snapshot_path, 'r') as f:
+                    snapshot = json.load(f)
+            except json.decoder.JSONDecodeError:
+                snapshot = {}
+        installed = set()
+        if snapshot.get('sdk_version') and snapshot['sdk_version'] == self._sdk_version():
+            installed = set(snapshot.get('components', []))
+        # Removed with `gcloud components remove`
+        install_dir = self.sdk_path / '.install'
+        if install_dir.exists():
+            installed = {
+                c for c in installed if (install_dir / '{}.manifest'.format(c)).exists()
+            }
+        return [c for c in self.components if c not in installed]
+
+    def _install_components(self, components: list):
+        # One run for all components: every gcloud run starts the SDK python
+        # and reads the component index from the network
+        logger.info("\tInstall gcloud components: {} ...".format(' '.join(components)))
+        env = dict(os.environ, CLOUDSDK_CONFIG=str(self.cfg_path))
         try:
-            p = subprocess.run(
-                [self.bin_path,] + cmd,
+            subprocess.run(
+                [self.bin_path, 'components', 'install', '-q'] + components,
                 check=True,
                 stdout=subprocess.PIPE,
                 stderr=subprocess.STDOUT,
+                env=env,
             )
-            if p.stdout:
-                return p.stdout.decode("utf-8")
         except subprocess.CalledProcessError as exc:
-            logger.error("Error while get config list")
+            logger.error(
+                "Error while install gcloud components {}".format(' '.join(components))
+            )
             logger.error(exc.stdout)
             sys.exit(1)
+        snapshot = {
+            'sdk_version': self._sdk_version(),
+            'components': sorted(set(self.components) | set(components)),
+        }
+        tmp_path = self.components_snapshot_path.with_name(self.components_snapshot_path.name + '.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(snapshot, f, indent=1)
+        os.replace(tmp_path, self.components_snapshot_path)
 
-    def _prepare_config(self):
+    def _properties_path(self) -> Path:
+        # `gcloud config set` writes to the active named configuration
+        name = 'default'
+        active_config = self.cfg_path / 'active_config'
+        if active_config.exists():
+            with open(active_config, 'r') as f:
+                name = f.read().strip() or name
+        return self.cfg_path / 'configurations' / 'config_{}'.format(name)
+
+    def _proxy_properties(self) -> dict:
         proxy = self._config.proxies['http']
-        if proxy:
-            proxy = proxy.replace('http://', '')
-            addr = proxy
-            port = '80'
-            if ':' in proxy:
-                addr, port = proxy.split(':')
-            self._exec(['config', 'set', 'proxy/type', 'http'])
-            self._exec(['config', 'set', 'proxy/address', addr])
-            self._exec(['config', 'set', 'proxy/port', port])
-        else:
+        if not proxy:
+            return {}
+        proxy = proxy.replace('http://', '')
+        addr = proxy
+        port = '80'
+        if ':' in proxy:
+            addr, port = proxy.split(':')
+        return {'type': 'http', 'address': addr, 'port': port}
+
+    def _render_properties(self) -> Optional[str]:
+        """Properties file with the proxy merged into the user properties,
+        None without proxy"""
+        proxy = self._proxy_properties()
+        if not proxy:
+            return None
+        path = self._properties_path()
+        current = ""
+        if path.exists():
+            with open(path, 'r') as f:
+                current = f.read()
+        config = ConfigParser(interpolation=None)
+        config.read_string(current)
+        if 'proxy' in config and all(
+            config['proxy'].get(key) == value for key, value in proxy.items()
+        ):
+            return current
+        if 'proxy' not in config:
+            config['proxy'] = {}
+        config['proxy'].update(proxy)
+        out = io.StringIO()
+        config.write(out)
+        return out.getvalue()
+
+    def _prepare_config(self):
+        properties = self._render_properties()
+        if properties is None:
             logger.warning('No http proxy for gcloud')
+            return
+        path = self._properties_path()
+        if path.exists():
+            with open(path, 'r') as f:
+                if f.read() == properties:
+                    logger.debug("{} is up to date".format(path))
+                    return
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(path.name + '.tmp')
+        with open(tmp_path, 'w') as f:
+            f.write(properties)
+        os.replace(tmp_path, path)
@@ -3,35 +3,52 @@ import os
 import subprocess
 import sys
 from pathlib import Path
+from typing import Optional
 from common.logger import logger
-from common.config import get_config
+from common.config import Config, get_config
 from installers.installer import Installer
+from installers.python_venv import PythonVenv
 
 
 class Gron(Installer):
+    # gron.yml points to the ansible repo
+    depends_on = ('Ansible',)
 
-    def __init__(self):
-        self._config = get_config()
+    def __init__(self, config: Optional[Config] = None):
+        self._config = config or get_config()
         self.enabled = self._config.gron_enabled
         self.repo_url = self._config.gron_repo_url
         self.workdir = self._config.workdir
         self.workdir_gron = self.workdir.root / 'gron/'
         self.workdir_root_bin = self.workdir.bin
-        self.venv = self.workdir_gron / 'venv/'
+        self.venv = PythonVenv(self.workdir_gron / 'venv/', self._config)
         self.repo = self.workdir_gron / 'repo/'
         self.gron_cfg_path = self.workdir_gron / 'gron.yml'
 
     def install(self):
         logger.info('Install gron ...')
+        report = self.workdir.report
         self._prepare_dirs()
-        self._create_venv()
-        self._clone_repo()
+        with report.phase("git clone"):
+            self._clone_repo()
         self._install_venv_requirements()
-        self._setup_gron_cfg()
-        self._create_bin()
+        with report.phase("config write"):
+            self._setup_gron_cfg()
+            self._create_bin()
         logger.info("Gron installed")
         #self._delete_repo()
 
+    def plan(self) -> list:
+        if not self.enabled:
+            return []
+        steps = []
+        if not self.repo.exists():
+            steps.append(self._step("clone", "{} doesn't exist".format(self.repo)))
+        steps += self._own_steps(self.venv.plan_ensure([], self._venv_requirements()))
+        steps += self._plan_write(self.gron_cfg_path, self._render_gron_cfg(), "gron.yml")
+        steps += self._plan_write(self.workdir.bin / 'gron', self._render_bin(), "bin/gron")
+        return steps
+
     def make_activate_replaces(self) -> dict:
         return {
 
@@ -41,25 +58,6 @@ class Gron(Installer):
     def _prepare_dirs(self):
         self.workdir_gron.mkdir(exist_ok=True)
 
-    def _create_venv(self, force=False):
-        if not force and self.venv.exists():
-            logger.debug('gron venv exists')
-            return
-        elif force and os.path.exists(self.venv):
-            shutil.rmtree(self.venv)
-        try:
-            subprocess.run(
-                ['virtualenv', '-p', 'python3', str(self.venv)],
-                check=True,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.STDOUT,
-            )
-            logger.debug('gron venv created')
-        except subprocess.CalledProcessError as exc:
-            logger.error("Error while creating gron venv")
-            logger.error(exc.stdout)
-            sys.exit(1)
-
     def _clone_repo(self):
         if self.repo.exists():
             logger.info(
@@ -89,35 +87,24 @@ class Gron(Installer):
 
     def _install_venv_requirements(self):
         logger.debug('Install gron requirements')
-        try:
-            subprocess.run(
-                [
-                    '{}/bin/pip'.format(self.venv),
-                    'install',
-                    '-r',
-                    '{}/requirements.txt'.format(self.repo)
-                ],
-                check=True,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.STDOUT,
-            )
-        except subprocess.CalledProcessError as exc:
-            logger.error(
-                "Error while install ansible requirements",
-            )
-            logger.error(exc.stdout)
-            sys.exit(1)
+        self.venv.ensure([], self._venv_requirements())
 
-    def _create_bin(self):
-        bin_source = "{}/bin/python3 {}/src/main.py -c {} $*".format(
-            self.venv, self.repo, self.gron_cfg_path,
+    def _venv_requirements(self) -> list:
+        if not self.repo.joinpath('requirements.txt').exists():
+            return []
+        return [self.repo / 'requirements.txt']
+
+    def _render_bin(self) -> str:
+        return "{}/python3 {}/src/main.py -c {} $*".format(
+            self.venv.bin_path, self.repo, self.gron_cfg_path,
         )
+
+    def _create_bin(self):
         with open(self.workdir.bin / 'gron', 'w') as f:
-            f.write(bin_source)
+            f.write(self._render_bin())
         os.chmod(self.workdir.bin / 'gron', 0o0770)
 
-
-    def _setup_gron_cfg(self):
+    def _render_gron_cfg(self) -> str:
         replaces = {
             "<ANSIBLE_PATH>": str(self._config.ansible_repo_path),
         }
@@ -126,8 +113,9 @@ class Gron(Installer):
 
         for repl_from, repl_to in replaces.items():
             gron_cfg = gron_cfg.replace(repl_from, repl_to)
+        return gron_cfg
 
+    def _setup_gron_cfg(self):
         with open(self.gron_cfg_path, 'w') as f:
-            f.write(gron_cfg)
-
+            f.write(self._render_gron_cfg())
 
@@ -2,18 +2,17 @@ import subprocess
 import sys
 import os
 import re
-import shutil
-from pathlib import Path
+from typing import Optional
 from common.logger import logger
-from common.config import get_config
-from common.download_file import download_file
-from installers.installer import Installer
+from common.config import Config, get_config
+from common.extract import download_and_extract
+from installers.installer import BinaryInstaller
 
 
-class Helm(Installer):
+class Helm(BinaryInstaller):
 
-    def __init__(self):
-        self._config = get_config()
+    def __init__(self, config: Optional[Config] = None):
+        self._config = config or get_config()
         self.enabled = self._config.helm_enabled
         self.workdir = self._config.workdir
         self.desired_platform = self._config.platform
@@ -23,17 +22,17 @@ class Helm(Installer):
 
     def install(self):
         logger.info('Install Helm ...')
-        current_version = self._check_current_ver()
+        current_version = self._current_version()
         if current_version == self.desired_ver:
             logger.info('helm already installed')
             return
         self._download()
+        self._record_installed()
         logger.info("Helm installed")
 
     def make_activate_replaces(self) -> dict:
         return  {}
 
-
     def _check_current_ver(self):
         if not os.path.exists(self.bin_path):
             return None
@@ -69,27 +68,9 @@ class Helm(Installer):
             os=self.desired_platform,
             arch=arch,
         )
-        zip_arch = self.workdir.tmp / 'helm.tar.gz'
-
-        logger.debug('Download helm {} -> {}'.format(url, zip_arch))
-        if not download_file(url, zip_arch, self._config.proxies):
-            sys.exit(1)
-
-        # Unzip
-        logger.debug('Unzip helm {}'.format(zip_arch))
-        try:
-            Path(self.workdir.tmp / 'helm').mkdir(exist_ok=True)
-            subprocess.run(
-                ['tar', '-x', '-f', zip_arch, '-C', self.workdir.tmp/ 'helm'],
-                check=True,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.STDOUT,
-            )
-        except subprocess.CalledProcessError as exc:
-            logger.error("Error while unpack helm")
-            logger.error(exc.stdout)
-            sys.exit(1)
-
-        logger.debug('Move helm bin to {}'.format(self.bin_path))
-        os.remove(zip_arch)
-        shutil.move(self.workdir.tmp / f'helm/{self.desired_platform}-{arch}/helm', self.bin_path)
+        logger.debug('Download helm {} -> {}'.format(url, self.bin_path))
+        download_and_extract(
+            url,
+            {'{}-{}/helm'.format(self.desired_platform, arch): self.bin_path},
+            self._config,
+        )
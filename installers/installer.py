@@ -1,7 +1,54 @@
 import abc
+import os
+from pathlib import Path
+
+
+class PlanStep:
+    """Something install.py would do, see `install.py --plan`"""
+
+    def __init__(self, installer: str, action: str, reason: str):
+        self.installer = installer
+        self.action = action
+        self.reason = reason
+
+    def to_dict(self) -> dict:
+        return {
+            'installer': self.installer,
+            'action': self.action,
+            'reason': self.reason,
+        }
+
+    def __str__(self):
+        return "{}: {} ({})".format(self.installer, self.action, self.reason)
 
 
 class Installer(abc.ABC):
+    # Class names of installers which must be installed before this one
+    depends_on: tuple = ()
+
+    def plan(self) -> list:
+        """PlanSteps which install() would do now.
+
+        Must not touch the network or change the workdir.
+        """
+        return []
+
+    def _step(self, action: str, reason: str) -> PlanStep:
+        return PlanStep(self.__class__.__name__, action, reason)
+
+    def _own_steps(self, steps: list) -> list:
+        """Steps of a helper (f.e. its PythonVenv) as steps of this installer"""
+        return [self._step(step.action, step.reason) for step in steps]
+
+    def _plan_write(self, path, content: str, what: str) -> list:
+        """Step for writing `content` to `path`, if it differs"""
+        if not os.path.exists(path):
+            return [self._step("write {}".format(what), "{} doesn't exist".format(path))]
+        with open(path, 'r') as f:
+            if f.read() == content:
+                return []
+        return [self._step("write {}".format(what), "{} content changed".format(path))]
+
     @abc.abstractmethod
     def install(self):
         """install"""
@@ -10,4 +57,59 @@ class Installer(abc.ABC):
     def make_activate_replaces(self) -> dict:
         """dict with replaces for activate script"""
 
+    def make_lazy_shims(self) -> list:
+        """Commands set up by a shim on the first call in lazy activate mode"""
+        return []
+
+    def confirm_writes(self):
+        """Asks the questions install() put off. Runs on the main thread after
+        all installers, so prompts don't mix with the log of other installers"""
+
+
+class BinaryInstaller(Installer):
+    """Installer of a single versioned binary (self.bin_path, self.desired_ver)
+
+    Installed versions are kept in the workdir manifest, the binary itself
+    is run (`_check_current_ver()`) only when the manifest can't tell.
+    """
+
+    def _manifest_name(self) -> str:
+        return self.__class__.__name__.lower()
+
+    def _manifest_path(self) -> Path:
+        return self.bin_path
+
+    def _current_version(self, record: bool = True):
+        manifest = self.workdir.manifest
+        with self.workdir.report.phase("version check") as phase:
+            phase['source'] = 'manifest'
+            version = manifest.get_version(self._manifest_name(), self._manifest_path())
+            if version is not None:
+                return version
+            phase['source'] = 'binary'
+            version = self._check_current_ver()
+        if version and record:
+            manifest.record(self._manifest_name(), version, self._manifest_path())
+        return version
+
+    def plan(self) -> list:
+        if not self.enabled:
+            return []
+        current_version = self._current_version(record=False)
+        if current_version == self.desired_ver:
+            return []
+        if current_version:
+            reason = "installed {}, want {}".format(current_version, self.desired_ver)
+        else:
+            reason = "not installed, want {}".format(self.desired_ver)
+        return [self._step("download", reason)]
+
+    def _record_installed(self):
+        self.workdir.manifest.record(
+            self._manifest_name(), self.desired_ver, self._manifest_path(),
+        )
+
+    @abc.abstractmethod
+    def _check_current_ver(self):
+        """version reported by the installed binary, None if not installed"""
 
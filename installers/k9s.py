@@ -2,18 +2,17 @@ import subprocess
 import sys
 import os
 import re
-import shutil
-from pathlib import Path
+from typing import Optional
 from common.logger import logger
-from common.config import get_config
-from common.download_file import download_file
-from installers.installer import Installer
+from common.config import Config, get_config
+from common.extract import download_and_extract
+from installers.installer import BinaryInstaller
 
 
-class K9S(Installer):
+class K9S(BinaryInstaller):
 
-    def __init__(self):
-        self._config = get_config()
+    def __init__(self, config: Optional[Config] = None):
+        self._config = config or get_config()
         self.enabled = self._config.k9s_enabled
         self.workdir = self._config.workdir
         self.desired_platform = self._config.platform
@@ -23,11 +22,12 @@ class K9S(Installer):
 
     def install(self):
         logger.info('Install k9s ...')
-        current_version = self._check_current_ver()
+        current_version = self._current_version()
         if current_version == self.desired_ver:
             logger.info('k9s already installed')
             return
         self._download()
+        self._record_installed()
         logger.info("k9s installed")
 
     def make_activate_replaces(self) -> dict:
@@ -72,27 +72,5 @@ class K9S(Installer):
             os=self.desired_platform,
             arch=arch,
         )
-        zip_arch = self.workdir.tmp / 'k9s.tar.gz'
-
-        logger.debug('Download k9s {} -> {}'.format(url, zip_arch))
-        if not download_file(url, zip_arch, self._config.proxies):
-            sys.exit(1)
-
-        # Unzip
-        logger.debug('Unzip k9s {}'.format(zip_arch))
-        try:
-            Path(self.workdir.tmp / 'k9s').mkdir(exist_ok=True)
-            subprocess.run(
-                ['tar', '-x', '-f', zip_arch, '-C', self.workdir.tmp/ 'k9s'],
-                check=True,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.STDOUT,
-            )
-        except subprocess.CalledProcessError as exc:
-            logger.error("Error while unpack k9s")
-            logger.error(exc.stdout)
-            sys.exit(1)
-
-        logger.debug('Move k9s bin to {}'.format(self.bin_path))
-        os.remove(zip_arch)
-        shutil.move(self.workdir.tmp / 'k9s/k9s', self.bin_path)
+        logger.debug('Download k9s {} -> {}'.format(url, self.bin_path))
+        download_and_extract(url, {'k9s': self.bin_path}, self._config)
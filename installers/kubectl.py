@@ -3,16 +3,17 @@ import sys
 import json
 import os
 import traceback
+from typing import Optional
 from common.logger import logger
-from common.config import get_config
-from common.download_file import download_file
-from installers.installer import Installer
+from common.config import Config, get_config
+from common.artifact_cache import download_artifact
+from installers.installer import BinaryInstaller
 
 
-class Kubectl(Installer):
+class Kubectl(BinaryInstaller):
 
-    def __init__(self):
-        self._config = get_config()
+    def __init__(self, config: Optional[Config] = None):
+        self._config = config or get_config()
         self.enabled = self._config.kubectl_enabled
         self.workdir = self._config.workdir
         self.desired_platform = self._config.platform
@@ -24,16 +25,17 @@ class Kubectl(Installer):
     def install(self):
         logger.info('Install kubectl ...')
         self.config_path.mkdir(exist_ok=True)
-        current_version = self._check_current_ver()
+        current_version = self._current_version()
         if current_version == self.desired_ver:
             logger.info('kubectl already installed')
             return
         self._download()
+        self._record_installed()
         logger.info("kubectl installed")
 
     def make_activate_replaces(self) -> dict:
         return {
-            "<KUBE_ENABLED>": str(self.enabled),
+            "<KUBE_ENABLED>": "true" if self.enabled else "",
             "<KUBE_CONFIG_PATH>": str(self.config_path),
         }
 
@@ -73,7 +75,7 @@ class Kubectl(Installer):
             arch="amd64",
         )
         logger.debug('Download kubectl {} -> {}'.format(url, self.bin_path))
-        if not download_file(url, self.bin_path, self._config.proxies):
+        if not download_artifact(url, self.bin_path, self._config):
             sys.exit(1)
         os.chmod(self.bin_path, 0o550)
 
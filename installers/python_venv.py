@@ -1,7 +1,10 @@
-import traceback
+import functools
+import hashlib
+import json
 from typing import Optional
 from common.config import get_config, Config
 from common.logger import logger
+from common.venv_store import get_venv_store
 import shutil
 from pathlib import Path
 import subprocess
@@ -11,9 +14,70 @@ import sys
 from installers.installer import Installer
 
 
+@functools.lru_cache(maxsize=None)
+def base_interpreter() -> dict:
+    """python3 of PATH, which virtualenv uses: its real executable and version.
+    python3 may be a pyenv/asdf shim, so it is run once to resolve it"""
+    python3 = shutil.which('python3')
+    if not python3:
+        return {}
+    p = subprocess.run(
+        [python3, '-c', 'import sys; print(sys.executable); print(".".join(map(str, sys.version_info)))'],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+        text=True,
+    )
+    out = p.stdout.split('\n')
+    if p.returncode != 0 or len(out) < 2:
+        return {}
+    return {
+        'executable': os.path.realpath(out[0]),
+        'version': out[1],
+    }
+
+
+def venv_interpreter(venv_path: Path) -> dict:
+    """Base interpreter of the venv from its pyvenv.cfg, as base_interpreter()"""
+    cfg = read_pyvenv_cfg(venv_path)
+    executable = cfg.get('base-executable') or cfg.get('executable', '')
+    return {
+        'executable': os.path.realpath(executable) if executable else '',
+        # virtualenv writes version_info, venv module writes version
+        'version': cfg.get('version_info') or cfg.get('version', ''),
+    }
+
+
+def same_interpreter(venv: dict, base: dict) -> bool:
+    if not venv or not base:
+        return False
+    # 3.11.7.final.0 and 3.11.7 are the same version
+    if venv['version'].split('.')[:3] != base['version'].split('.')[:3]:
+        return False
+    return venv['executable'] == base['executable']
+
+
+def read_pyvenv_cfg(venv_path: Path) -> dict:
+    pyvenv_cfg = Path(venv_path) / 'pyvenv.cfg'
+    values = {}
+    if not pyvenv_cfg.exists():
+        return values
+    with open(pyvenv_cfg, 'r') as f:
+        for line in f:
+            key, _, value = line.partition('=')
+            values[key.strip()] = value.strip()
+    return values
+
+
 class PythonVenv(Installer):
-    def __init__(self, workdir: Optional[Path] = None):
-        self._config: Config = get_config()
+    """Virtualenv with a fingerprint of what it was built from
+
+    .fingerprint.json keeps packages and sha256 of requirements files;
+    ensure() changes the venv only when they differ or python3 of PATH is
+    not the interpreter of pyvenv.cfg any more.
+    """
+
+    def __init__(self, workdir: Optional[Path] = None, config: Optional[Config] = None):
+        self._config: Config = config or get_config()
         self.enabled = self._config.python_enabled
         self.workdir = Path()
         self.is_standalone = False
@@ -24,13 +88,18 @@ class PythonVenv(Installer):
             self.is_standalone = True
         self.venv_path = self.workdir
         self.bin_path = self.venv_path / 'bin'
+        self.fingerprint_path = self.venv_path / '.fingerprint.json'
         self.workdir_root_bin = self._config.workdir.bin
 
     def install(self):
         self._prepare_dirs()
-        self.create_venv(force=True)
         if self.is_standalone:
-            self.install_packages(self._config.python_packages)
+            self.ensure(self._config.python_packages)
+
+    def plan(self) -> list:
+        if not self.enabled:
+            return []
+        return self.plan_ensure(self._config.python_packages)
 
     def make_activate_replaces(self) -> dict:
         replaces = {}
@@ -41,28 +110,108 @@ class PythonVenv(Installer):
         replaces["<PYTHON_VENV>"] = str(self.venv_path)
         return replaces
 
+    def ensure(self, packages: list, requirements: Optional[list] = None):
+        """Create, update or leave the venv, depending on its fingerprint"""
+        report = self._config.workdir.report
+        fingerprint = self._fingerprint(packages, requirements)
+        action, reason = self._ensure_action(fingerprint)
+        if not action:
+            logger.debug("Python venv {} is up to date".format(self.venv_path))
+            return
+        logger.debug("Python venv {}: {} ({})".format(self.venv_path, action, reason))
+        store = get_venv_store(self._config)
+        if action == "create venv":
+            self._create(packages)
+        with report.phase("pip install"):
+            self.install_packages(packages, requirements)
+        if store:
+            with report.phase("venv link") as record:
+                record['files'] = store.link_venv(self.venv_path)
+                # Distributions this venv had before may be used by no venv now
+                record['pruned'] = store.prune()
+        self._write_fingerprint(fingerprint)
+
+    def prepare(self, packages: list):
+        """Creates the venv if ensure() would, before requirements files exist"""
+        fingerprint = self._fingerprint(packages)
+        action, reason = self._ensure_action(fingerprint)
+        if action != "create venv":
+            return
+        logger.debug("Python venv {}: {} ({})".format(self.venv_path, action, reason))
+        self._create(packages)
+        # Nothing is installed yet, ensure() runs pip for everything
+        self._write_fingerprint(dict(fingerprint, packages=[], requirements={}))
+
+    def plan_ensure(self, packages: list, requirements: Optional[list] = None) -> list:
+        action, reason = self._ensure_action(self._fingerprint(packages, requirements))
+        if not action:
+            return []
+        return [self._step(action, "{}: {}".format(self.venv_path, reason))]
+
+    def _create(self, packages: list):
+        store = get_venv_store(self._config)
+        with self._config.workdir.report.phase("venv create"):
+            self.create_venv(force=True)
+            if store:
+                prelinked = store.prelink(self.venv_path, packages)
+                if prelinked:
+                    logger.debug("Python venv {}: {} from the venv store".format(
+                        self.venv_path, ' '.join(prelinked),
+                    ))
+
+    def _ensure_action(self, fingerprint: dict) -> tuple:
+        if not self._is_venv_valid():
+            return "create venv", "doesn't exist or broken"
+        venv, base = venv_interpreter(self.venv_path), base_interpreter()
+        if not same_interpreter(venv, base):
+            return "create venv", "python3 changed: {} {} -> {} {}".format(
+                venv['executable'], venv['version'], base.get('executable'), base.get('version'),
+            )
+        stored = self._read_fingerprint()
+        # Fingerprints of older versions have the interpreter too
+        stored.pop('interpreter', None)
+        if stored == fingerprint:
+            return "", ""
+        # pip doesn't remove packages, the venv is built again without them
+        if not set(stored.get('packages', [])) <= set(fingerprint['packages']):
+            return "create venv", "packages removed"
+        return "pip install", "packages or requirements changed"
+
+    def _fingerprint(self, packages: list, requirements: Optional[list] = None) -> dict:
+        requirements_sha = {}
+        for path in requirements or []:
+            with open(path, 'rb') as f:
+                requirements_sha[str(path)] = hashlib.sha256(f.read()).hexdigest()
+        return {
+            'packages': sorted(str(package) for package in packages),
+            'requirements': requirements_sha,
+        }
+
+    def _read_fingerprint(self) -> dict:
+        if not self.fingerprint_path.exists():
+            return {}
+        try:
+            with open(self.fingerprint_path, 'r') as f:
+                return json.load(f)
+        except json.decoder.JSONDecodeError:
+            return {}
+
+    def _write_fingerprint(self, fingerprint: dict):
+        tmp_path = self.fingerprint_path.with_name(self.fingerprint_path.name + '.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(fingerprint, f, indent=1)
+        os.replace(tmp_path, self.fingerprint_path)
+
     def _prepare_dirs(self):
         self.workdir.mkdir(exist_ok=True)
 
-    def _is_venv_valid(self):
-        if not self.venv_path.exists():
+    def _is_venv_valid(self) -> bool:
+        """pyvenv.cfg is there and its interpreter still exists, without running it"""
+        home = read_pyvenv_cfg(self.venv_path).get('home', '')
+        if not home or not os.path.isdir(home):
             return False
-        pip_bin = self.venv_path / 'bin/pip'
-        try:
-            p = subprocess.run(
-                [str(pip_bin), '-h'],
-                check=True,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.STDOUT,
-            )
-            if p.stderr:
-                logger.debug(p.stderr.decode("utf-8"))
-            if p.returncode == 0:
-                return True
-        except:
-            logger.debug(traceback.format_exc())
-            return False
-        return False
+        # bin/python is a symlink to the base interpreter
+        return os.path.exists(self.bin_path / 'python') and os.path.exists(self.bin_path / 'pip')
 
     def create_venv(self, force=False):
         if not force and self.venv_path.exists():
@@ -70,6 +219,7 @@ class PythonVenv(Installer):
                 shutil.rmtree(self.venv_path)
             else:
                 logger.debug("Python venv {} already exists and OK".format(self.venv_path))
+                return
         elif force and os.path.exists(self.venv_path):
             shutil.rmtree(self.venv_path)
         try:
@@ -89,48 +239,34 @@ class PythonVenv(Installer):
             logger.error(exc.stdout)
             sys.exit(1)
 
-
-    def install_packages(self, packages: list):
-        for package in packages:
-            try:
-                p = subprocess.run(
-                    [
-                        str(self.venv_path / 'bin/pip'),
-                        'install',
-                        '--disable-pip-version-check',
-                        package
-                    ],
-                    check=True,
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.STDOUT,
-                )
-                if p.stdout:
-                    logger.debug(p.stdout.decode("utf-8"))
-                if p.stderr:
-                    logger.debug(p.stderr.decode("utf-8"))
-            except subprocess.CalledProcessError as exc:
-                logger.error("Error while installing python venv packages")
-                logger.error(exc.stdout)
-                sys.exit(1)
-
-    def install_requirements(self, requirements: Path):
-        logger.debug('Install requirements {}'.format(requirements))
+    def install_packages(self, packages: list, requirements: Optional[list] = None):
+        """Install packages and requirements files with one pip run"""
+        args = [str(package) for package in packages]
+        for path in requirements or []:
+            args += ['-r', str(path)]
+        if not args:
+            return
+        logger.debug('pip install {}'.format(' '.join(args)))
         try:
-            subprocess.run(
+            p = subprocess.run(
                 [
-                    '{}/bin/pip'.format(self.venv_path),
-                    '--disable-pip-version-check',
+                    str(self.venv_path / 'bin/pip'),
                     'install',
-                    '-r',
-                    requirements,
-                ],
+                    '--disable-pip-version-check',
+                    '--cache-dir',
+                    str(self._config.workdir.pip_cache),
+                ] + args,
                 check=True,
                 stdout=subprocess.PIPE,
                 stderr=subprocess.STDOUT,
             )
+            if p.stdout:
+                logger.debug(p.stdout.decode("utf-8"))
         except subprocess.CalledProcessError as exc:
-            logger.error(
-                "Error while install requirements",
-            )
+            logger.error("Error while installing python venv packages")
             logger.error(exc.stdout)
             sys.exit(1)
+
+    def install_requirements(self, requirements: Path):
+        logger.debug('Install requirements {}'.format(requirements))
+        self.install_packages([], [requirements])
@@ -1,5 +1,6 @@
-from common.config import get_config
+from common.config import Config, get_config
 from pathlib import Path
+from typing import Optional
 import subprocess
 import os
 from common.logger import logger
@@ -9,8 +10,8 @@ from installers.installer import Installer
 
 class SSH(Installer):
 
-    def __init__(self):
-        self._config = get_config()
+    def __init__(self, config: Optional[Config] = None):
+        self._config = config or get_config()
         self.enabled = self._config.ssh_enabled
         self.workdir = self._config.workdir.root
         self.dir = self.workdir / "ssh"
@@ -18,6 +19,8 @@ class SSH(Installer):
         self.load_keys_from_host = self._config.ssh_load_keys_from_host
         self.agent_socket = self.dir / "agent.socket"
         self.agent_pid_file = self.dir / "agent.pid"
+        self.hosts_index = self.dir / "hosts.index"
+        self.hosts_index_builder = self.dir / "hosts_index.sh"
         self.enable_autocomplete_from_ansible = self._config.ssh_enable_autocomplete_from_ansible
         self.additional_config = self._load_additional_config()
 
@@ -37,7 +40,10 @@ class SSH(Installer):
 
     def install(self):
         Path(self.dir).mkdir(exist_ok=True)
-        self._create_config()
+        with self._config.workdir.report.phase("config write"):
+            self._create_config()
+            if self.enable_autocomplete_from_ansible:
+                self._create_hosts_index_builder()
 
     def make_activate_replaces(self) -> dict:
         replaces = {}
@@ -60,15 +66,56 @@ class SSH(Installer):
         replaces["<SSH_AGENT_SOCK>"] = str(self.agent_socket)
         replaces["<SSH_LOAD_KEYS_FROM_HOST>"] = str(self.load_keys_from_host)
         replaces["<SSH_CONFIG>"] = str(self.config_path)
+        replaces["<SSH_HOSTS_INDEX>"] = str(self.hosts_index)
+        replaces["<SSH_HOSTS_INDEX_BUILDER>"] = str(self.hosts_index_builder)
         return replaces
 
-    def _create_config(self):
+    def make_lazy_shims(self) -> list:
+        if not self.enabled:
+            return []
+        return ['ssh']
+
+    def plan(self) -> list:
+        if not self.enabled:
+            return []
+        steps = self._plan_write(self.config_path, self._render_config(), "ssh config")
+        if self.enable_autocomplete_from_ansible:
+            steps += self._plan_write(
+                self.hosts_index_builder,
+                self._render_hosts_index_builder(),
+                "hosts index builder",
+            )
+        return steps
+
+    def _render_config(self) -> str:
         config = ""
         if self.additional_config:
             config = self.additional_config
+        return config
 
+    def _create_config(self):
         with open(self.config_path, "w") as f:
-            f.write(config)
+            f.write(self._render_config())
+
+    def _render_hosts_index_builder(self) -> str:
+        replaces = {
+            "<SSH_CONFIG>": str(self.config_path),
+            "<SSH_HOSTS_INDEX>": str(self.hosts_index),
+            "<ANSIBLE_PATH>": str(self._config.ansible_repo_path),
+            "<ANSIBLE_CONFIG>": str(self._config.ansible_cfg_path),
+            "<ANSIBLE_BINDIR>": str(self._config.workdir.bin / 'ansible'),
+        }
+        with open(self._config.templates_path / 'ssh_hosts_index.sh', 'r') as f:
+            script = f.read()
+        for repl_from, repl_to in replaces.items():
+            script = script.replace(repl_from, repl_to)
+        return script
+
+    def _create_hosts_index_builder(self):
+        """Index itself is built by activate, when it's missing or stale"""
+        with open(self.hosts_index_builder, "w") as f:
+            f.write(self._render_hosts_index_builder())
+        os.chmod(self.hosts_index_builder, 0o0755)
 
     def generate_run_agent_cmd(self) -> list:
         return ["ssh-agent", "-a", self.agent_socket]
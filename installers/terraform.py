@@ -1,16 +1,17 @@
 import subprocess
 import os
 import sys
+from typing import Optional
 from common.logger import logger
-from common.config import get_config
-from common.download_file import download_file
-from installers.installer import Installer
+from common.config import Config, get_config
+from common.extract import download_and_extract
+from installers.installer import BinaryInstaller
 
 
-class Terraform(Installer):
+class Terraform(BinaryInstaller):
 
-    def __init__(self):
-        self._config = get_config()
+    def __init__(self, config: Optional[Config] = None):
+        self._config = config or get_config()
         self.enabled = self._config.terraform_enabled
         self.workdir = self._config.workdir
         self.desired_platform = self._config.platform
@@ -21,11 +22,12 @@ class Terraform(Installer):
 
     def install(self):
         logger.info('Install terraform ...')
-        current_version = self._check_current_ver()
+        current_version = self._current_version()
         if current_version == self.desired_ver:
             logger.info('Terraform already installed')
             return
         self._download()
+        self._record_installed()
         logger.info("Terraform installed")
 
     def make_activate_replaces(self) -> dict:
@@ -47,6 +49,11 @@ class Terraform(Installer):
                 )
         return replaces
 
+    def make_lazy_shims(self) -> list:
+        if not self.enabled:
+            return []
+        return ['terraform']
+
     def _check_current_ver(self):
         if not os.path.exists(self.bin_path):
             return None
@@ -79,32 +86,6 @@ class Terraform(Installer):
             os=self.desired_platform,
             arch="amd64",
         )
-        zip_arch = self.workdir.tmp / 'terraform.zip'
-
-        logger.debug('Download terraform {} -> {}'.format(url, zip_arch))
-        if not download_file(url, zip_arch, self._config.proxies):
-            sys.exit(1)
-
-        # Unzip
-        logger.debug('Unzip terraform {}'.format(zip_arch))
-        try:
-            subprocess.run(
-                ['unzip', '-d', self.workdir.tmp / 'terraform', zip_arch],
-                check=True,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.STDOUT,
-            )
-        except subprocess.CalledProcessError as exc:
-            logger.error("Error while unzip terraform")
-            logger.error(exc.stdout)
-            sys.exit(1)
-
-        logger.debug('Move terraform bin to {}'.format(self.bin_path))
-        os.remove(zip_arch)
-        os.replace(
-            self.workdir.tmp / 'terraform/terraform',
-            self.bin_path,
-        )
-        os.rmdir(self.workdir.tmp / 'terraform')
-
+        logger.debug('Download terraform {} -> {}'.format(url, self.bin_path))
+        download_and_extract(url, {'terraform': self.bin_path}, self._config)
 
@@ -1,16 +1,17 @@
 import subprocess
 import sys
 import os
+from typing import Optional
 from common.logger import logger
-from common.config import get_config
-from common.download_file import download_file
-from installers.installer import Installer
+from common.config import Config, get_config
+from common.artifact_cache import download_artifact
+from installers.installer import BinaryInstaller
 
 
-class Terragrunt(Installer):
+class Terragrunt(BinaryInstaller):
 
-    def __init__(self):
-        self._config = get_config()
+    def __init__(self, config: Optional[Config] = None):
+        self._config = config or get_config()
         self.enabled = self._config.terragrunt_enabled
         self.workdir = self._config.workdir
         self.desired_platform = self._config.platform
@@ -21,11 +22,12 @@ class Terragrunt(Installer):
 
     def install(self):
         logger.info('Install terragrunt ...')
-        current_version = self._check_current_ver()
+        current_version = self._current_version()
         if current_version == self.desired_ver:
             logger.info('Terragrunt already installed')
             return
         self._download()
+        self._record_installed()
         logger.info("Terragrunt installed")
 
     def make_activate_replaces(self) -> dict:
@@ -47,6 +49,11 @@ class Terragrunt(Installer):
                 )
         return replaces
 
+    def make_lazy_shims(self) -> list:
+        if not self.enabled:
+            return []
+        return ['terragrunt']
+
     def _check_current_ver(self):
         if not os.path.exists(self.bin_path):
             return None
@@ -77,7 +84,7 @@ class Terragrunt(Installer):
             arch="amd64",
         )
         logger.debug('Download terragrunt {} -> {}'.format(url, self.bin_path))
-        if not download_file(url, self.bin_path, self._config.proxies):
+        if not download_artifact(url, self.bin_path, self._config):
             sys.exit(1)
         os.chmod(self.bin_path, 0o750)
 
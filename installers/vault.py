@@ -1,15 +1,19 @@
+import hashlib
+import json
+import shlex
 import subprocess
 import os
 import sys
+from typing import Optional
 from common.logger import logger
-from common.config import get_config
-from common.download_file import download_file
-from installers.installer import Installer
+from common.config import Config, get_config
+from common.extract import download_and_extract
+from installers.installer import BinaryInstaller
 
-class Vault(Installer):
+class Vault(BinaryInstaller):
 
-    def __init__(self):
-        self._config = get_config()
+    def __init__(self, config: Optional[Config] = None):
+        self._config = config or get_config()
         self.enabled = self._config.vault_enabled
         self.workdir = self._config.workdir
         self.desired_platform = self._config.platform
@@ -20,29 +24,44 @@ class Vault(Installer):
         self.addr = self._config.vault_addr
         self.login_method = self._config.vault_login_method
 
+        self.dir = self.workdir.root / 'vault'
+        self.env_loader_path = self.dir / 'load_env.sh'
+        self.env_cache_path = self.dir / 'env-{}.sh'.format(self._env_spec_hash())
+
     def install(self):
-        current_version = self._check_current_ver()
+        current_version = self._current_version()
         if current_version == self.desired_ver:
             logger.info('Vault already installed')
-            return
-        self._download()
-        logger.info("Vault installed")
+        else:
+            self._download()
+            self._record_installed()
+            logger.info("Vault installed")
+        with self.workdir.report.phase("config write"):
+            self._setup_env_loader()
+
+    def plan(self) -> list:
+        steps = super().plan()
+        if self.enabled and self.generate_env_load():
+            steps += self._plan_write(
+                self.env_loader_path, self._render_env_loader(), "vault env loader",
+            )
+        return steps
 
     def make_activate_replaces(self) -> dict:
         replaces = {
+            "<VAULT_ENABLED>": "true" if self.enabled else "",
             "<VAULT_ADDR>": str(self.addr),
             "<VAULT_LOGIN_METHOD>": str(self.login_method),
             "<VAULT_IS_LOAD_ENV_VARS>": "",
-            "<VAULT_LOAD_ENV_VARS>": "",
+            "<VAULT_ENV_CACHE>": "",
+            "<VAULT_ENV_LOADER>": "",
             "<VAULT_DEACTIVATE LOAD_ENV_VARS>": "",
         }
-        load_env_vars = self.generate_env_load()
-        deactivate_env_vars = self.generate_env_deactivate()
-        if load_env_vars:
-            load_env_vars = '\n'.join(load_env_vars)
-            deactivate_env_vars = '\n'.join(deactivate_env_vars)
+        if self.generate_env_load():
+            deactivate_env_vars = '\n'.join(self.generate_env_deactivate())
             replaces["<VAULT_IS_LOAD_ENV_VARS>"] = "TRUE"
-            replaces["<VAULT_LOAD_ENV_VARS>"] = load_env_vars
+            replaces["<VAULT_ENV_CACHE>"] = str(self.env_cache_path)
+            replaces["<VAULT_ENV_LOADER>"] = str(self.env_loader_path)
             replaces["<VAULT_DEACTIVATE LOAD_ENV_VARS>"] = deactivate_env_vars
         return replaces
 
@@ -75,33 +94,8 @@ class Vault(Installer):
             os=self.desired_platform,
             arch="amd64",
         )
-        zip_arch = self.workdir.tmp / 'vault.zip'
-
-        logger.debug('Download vault {} -> {}'.format(url, zip_arch))
-        if not download_file(url, zip_arch, self._config.proxies):
-            sys.exit(1)
-
-        # Unzip
-        logger.debug('Unzip vault {}'.format(zip_arch))
-        try:
-            subprocess.run(
-                ['unzip', '-d', self.workdir.tmp / 'vault', zip_arch],
-                check=True,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.STDOUT,
-            )
-        except subprocess.CalledProcessError as exc:
-            logger.error("Error while unzip vault")
-            logger.error(exc.stdout)
-            sys.exit(1)
-
-        logger.debug('Move vault bin to {}'.format(self.bin_path))
-        os.remove(zip_arch)
-        os.replace(
-            self.workdir.tmp / 'vault/vault',
-            self.bin_path,
-        )
-        os.rmdir(self.workdir.tmp / 'vault')
+        logger.debug('Download vault {} -> {}'.format(url, self.bin_path))
+        download_and_extract(url, {'vault': self.bin_path}, self._config)
 
     def generate_env_deactivate(self) -> list:
         load_env_vars = self._config.vault_load_env_vars
@@ -115,18 +109,59 @@ class Vault(Installer):
         return cmds
 
 
-    def generate_env_load(self) -> list:
+    def generate_env_load(self) -> dict:
+        """{vault path: {env var: item}}, every path is read once"""
         load_env_vars = self._config.vault_load_env_vars
-        cmds = []
+        paths = {}
         if not load_env_vars:
-            return []
+            return {}
         for env_var, vault_key in load_env_vars.items():
             if ";;" not in vault_key:
                 print("Error. load_env_vars key must contains ;; ({}: >> {})".format(env_var, vault_key))
                 continue
             vault_path, vault_item = [x.strip() for x in vault_key.split(";;")]
-            cmds.append(
-                "export {}=$(vault kv get -format=json {} | jq -r .data.data.{})".format(env_var, vault_path, vault_item)
-            )
-        return cmds
+            paths.setdefault(vault_path, {})[env_var] = vault_item
+        return paths
+
+    def _env_spec_hash(self) -> str:
+        # Other secrets or other vault -> other cache file
+        spec = json.dumps(
+            {'addr': self.addr, 'load_env_vars': self._config.vault_load_env_vars},
+            sort_keys=True,
+        )
+        return hashlib.sha256(spec.encode()).hexdigest()[:12]
+
+    def _render_env_loader(self) -> str:
+        paths = []
+        filters = []
+        for vault_path, env_vars in self.generate_env_load().items():
+            paths.append(shlex.quote(vault_path))
+            exports = [
+                '@sh "export {}=\\(.data.data[{}])"'.format(env_var, json.dumps(item))
+                for env_var, item in env_vars.items()
+            ]
+            filters.append(shlex.quote(', '.join(exports)))
+        replaces = {
+            "<VAULT_ENV_CACHE>": str(self.env_cache_path),
+            "<VAULT_ENV_CACHE_TTL>": str(self._config.vault_load_env_vars_ttl),
+            "<VAULT_ENV_PATHS>": ' '.join(paths),
+            "<VAULT_ENV_FILTERS>": ' '.join(filters),
+        }
+        with open(self._config.templates_path / 'vault_load_env.sh', 'r') as f:
+            script = f.read()
+        for repl_from, repl_to in replaces.items():
+            script = script.replace(repl_from, repl_to)
+        return script
+
+    def _setup_env_loader(self):
+        if not self.generate_env_load():
+            return
+        self.dir.mkdir(mode=0o700, exist_ok=True)
+        with open(self.env_loader_path, 'w') as f:
+            f.write(self._render_env_loader())
+        os.chmod(self.env_loader_path, 0o0700)
+        # Caches of the previous load_env_vars
+        for path in self.dir.glob('env-*.sh'):
+            if path != self.env_cache_path:
+                os.remove(path)
 
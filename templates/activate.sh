@@ -1,54 +1,94 @@
-# This file must be used with "source bin/activate" *from bash*
+# This file must be used with "source activate" *from bash or zsh*
 # you cannot run it directly
+#
+# Template of activate.bash and activate.zsh, compiled by install.py:
+# lines between "# @if NAME", "# @else" and "# @endif" are kept only when
+# placeholder NAME is not empty or NAME is the shell of the compiled script.
 
+# @if bash
 if [ "${BASH_SOURCE-}" = "$0" ]; then
     echo "You must source this script: \$ source $0" >&2
     exit 33
 fi
+# @endif
+# @if zsh
+zmodload -F zsh/datetime p:EPOCHSECONDS 2>/dev/null
+# @endif
 
 activate_env_files () {
-    local env_dir="${WORKDIR_ROOT}/env"
-    if [ -d "$env_dir" ]; then
-        for f in $(ls -1 "${env_dir}"); do
-            source "${env_dir}/${f}"
-        done
-    fi
+    local f
+    # @if bash
+    for f in "$WORKDIR_ROOT"/env/*; do
+    # @else
+    for f in "$WORKDIR_ROOT"/env/*(N); do
+    # @endif
+        if [ -f "$f" ]; then
+            source "$f"
+        fi
+    done
 }
 
 deactivate_env_files () {
-    local env_dir="${WORKDIR_ROOT}/env"
-    if [ -d "$env_dir" ]; then
-        for f in $(ls -1 "${env_dir}"); do
-            while read p; do
-               echo $p | unset $(sed "s%export \([^=]\+\).*$%\1%")
-            done < "${env_dir}${f}"
-        done
-    fi
+    local f line
+    # @if bash
+    for f in "$WORKDIR_ROOT"/env/*; do
+    # @else
+    for f in "$WORKDIR_ROOT"/env/*(N); do
+    # @endif
+        if [ ! -f "$f" ]; then
+            continue
+        fi
+        while read -r line; do
+            case "$line" in
+                "export "*=*)
+                    line="${line#export }"
+                    unset "${line%%=*}"
+                    ;;
+            esac
+        done < "$f"
+    done
 }
 
+# @if SSH_ENABLED
+# @if SSH_ENABLE_AUTOCOMPLETE_FROM_ANSIBLE
 ssh_ansible_autocomplete () {
-    SSH_CONFIG="<SSH_CONFIG>"
-    hosts=""
-    if [[ -r ~/.ssh/config ]]; then
-        hosts=($hosts $(awk 'match($0, /^Host \s*([^*]\w+)/, a) {s = s a[1] " "} END {print s}' ~/.ssh/config))
-    fi
-    if [[ -r $SSH_CONFIG ]]; then
-        hosts=($hosts $(awk 'match($0, /^Host \s*([^*]\w+)/, a) {s = s a[1] " "} END {print s}' $SSH_CONFIG))
-    fi
-    if [[ -r ~/.ssh/known_hosts ]]; then
-        hosts=($hosts $(awk 'match($0, /^([^|][a-z.0-9]+) /, a) {s = s a[0] " "} END {print s}' ~/.ssh/known_hosts))
-    fi
-    hosts=($hosts $(get_hosts_from_ansible))
-    current_shell=$(ps -o comm= -p $$)
-    if [ "$current_shell" = "zsh" ]; then
-        _ssh_autocomplete_zsh "${hosts}"
-    fi
-    if [ "$current_shell" = "bash" ]; then
-        _ssh_autocomplete_bash "${hosts[*]}"
-    fi
+    local SSH_HOSTS_INDEX="<SSH_HOSTS_INDEX>"
+    local SSH_HOSTS_INDEX_BUILDER="<SSH_HOSTS_INDEX_BUILDER>"
+    if _ssh_hosts_index_is_stale "$SSH_HOSTS_INDEX"; then
+        # Completion gets the new hosts on the next activation
+        ( "$SSH_HOSTS_INDEX_BUILDER" >/dev/null 2>&1 & )
+    fi
+    local hosts=""
+    # @if bash
+    if [ -r "$SSH_HOSTS_INDEX" ]; then
+        IFS= read -r -d '' hosts < "$SSH_HOSTS_INDEX"
+    fi
+    _ssh_autocomplete_bash "$hosts"
+    # @else
+    if [ -r "$SSH_HOSTS_INDEX" ]; then
+        hosts=$(<"$SSH_HOSTS_INDEX")
+    fi
+    _ssh_autocomplete_zsh "$hosts"
+    # @endif
+}
 
+# Index is stale if any file it was built from (ssh configs, known_hosts,
+# ansible.cfg and inventory) is newer than the index
+_ssh_hosts_index_is_stale () {
+    local index="$1"
+    if [ ! -r "$index" ] || [ ! -r "$index.sources" ]; then
+        return 0
+    fi
+    local src
+    while IFS= read -r src; do
+        if [ "$src" -nt "$index" ]; then
+            return 0
+        fi
+    done < "$index.sources"
+    return 1
 }
 
+# @if bash
 _ssh_autocomplete_bash() {
     _hosts="$1"
     _ssh() {
@@ -64,58 +104,181 @@ _ssh_autocomplete_bash() {
     complete -F _ssh ssh
 }
 
-
-get_hosts_from_ansible () {
-    ansible all --list-hosts | tail -n +2 | awk '{s = s $1 " "} END {print s}'
+_ssh_autocomplete_deactivate () {
+    complete -r ssh 2>/dev/null
+    unset _hosts
 }
-
+# @else
 _ssh_autocomplete_zsh () {
-    zstyle ':completion:*:(ssh|scp|sftp):*' hosts $(print "$1")
+    zstyle ':completion:*:(ssh|scp|sftp):*' hosts ${(f)1}
 }
 
-_ssh_autocomplete_zsh_deactivate () {
-    if [ "$current_shell" = "zsh" ]; then
-        zstyle ':completion:*:(ssh|scp|sftp):*' hosts
-    fi
-}
-
-_ssh_autocomplete_bash_deactivate () {
-    if [ "$current_shell" = "bash" ]; then
-        complete -r ssh
-    fi
+_ssh_autocomplete_deactivate () {
+    zstyle -d ':completion:*:(ssh|scp|sftp):*' hosts
 }
+# @endif
+# @endif
 
 run_ssh_agent () {
     local SSH_AGENT_PID_PATH="<SSH_AGENT_PID_PATH>"
-    local SSH_AGENT_CMD_RUN="<SSH_AGENT_CMD_RUN>"
     local SSH_AGENT_SOCK="<SSH_AGENT_SOCK>"
     local SSH_LOAD_KEYS_FROM_HOST="<SSH_LOAD_KEYS_FROM_HOST>"
-    if [ -f "$SSH_AGENT_PID_PATH" ]; then
-        pid=$(cat "$SSH_AGENT_PID_PATH")
-        echo $pid
-        if ps -p $pid > /dev/null; then
-            echo "SSH: ssh agent already running"
+    local pid="" out
+    if [ -r "$SSH_AGENT_PID_PATH" ]; then
+        read -r pid < "$SSH_AGENT_PID_PATH"
+        if [ -n "$pid" ] && kill -0 "$pid" 2>/dev/null; then
             return
         fi
     fi
     stop_ssh_agent
-    out=$(eval $SSH_AGENT_CMD_RUN)
-    local pid=$(echo $out | grep -oP "SSH_AGENT_PID=\K([[:digit:]]+)")
-    echo $pid > $SSH_AGENT_PID_PATH
+    out=$(<SSH_AGENT_CMD_RUN>)
+    # SSH_AUTH_SOCK=...; export SSH_AUTH_SOCK; SSH_AGENT_PID=123; export ...
+    pid="${out#*SSH_AGENT_PID=}"
+    pid="${pid%%;*}"
+    echo "$pid" > "$SSH_AGENT_PID_PATH"
     if [ "$SSH_LOAD_KEYS_FROM_HOST" ]; then
         SSH_AUTH_SOCK=$SSH_AGENT_SOCK /usr/bin/ssh -o 'ForwardAgent yes' $SSH_LOAD_KEYS_FROM_HOST "ssh-add 2>&1 > /dev/null" >/dev/null
     fi
 }
 
 stop_ssh_agent () {
-    local SSH_AGENT_CMD_RUN="<SSH_AGENT_CMD_RUN>"
     local SSH_AGENT_PID_PATH="<SSH_AGENT_PID_PATH>"
-    local SSH_AGENT_SOCK="<SSH_AGENT_SOCK>"
-    ps aux | grep "$SSH_AGENT_CMD_RUN" | grep -v grep | head -n -1 | awk '{print $2}' | xargs -I {} kill -9 {}
-    rm -f $SSH_AGENT_PID_PATH
-    rm -f $SSH_AGENT_SOCK
+    local pid=""
+    if [ -r "$SSH_AGENT_PID_PATH" ]; then
+        read -r pid < "$SSH_AGENT_PID_PATH"
+        if [ -n "$pid" ]; then
+            kill "$pid" 2>/dev/null
+        fi
+    fi
+    rm -f "$SSH_AGENT_PID_PATH" "<SSH_AGENT_SOCK>"
+}
+
+deactivate_ssh() {
+    if [ -n "${_OLD_SSH_ALIAS-}" ]; then
+        alias ssh="$_OLD_SSH_ALIAS"
+    elif [ ! "${1-}" = "nondestructive" ] ; then
+        unalias ssh 2>/dev/null
+    fi
+    unset _OLD_SSH_ALIAS
+    # Activation in a new shell reuses the running agent
+    if [ ! "${1-}" = "nondestructive" ] ; then
+        stop_ssh_agent
+    fi
+    # @if SSH_ENABLE_AUTOCOMPLETE_FROM_ANSIBLE
+    _ssh_autocomplete_deactivate
+    # @endif
+}
+
+_ssh_alias () {
+    _OLD_SSH_ALIAS="${<ALIASES>[ssh]-}"
+    alias <SSH_ALIAS>
+}
+
+activate_ssh () {
+    _ssh_alias
+    run_ssh_agent
+    # @if SSH_ENABLE_AUTOCOMPLETE_FROM_ANSIBLE
+    ssh_ansible_autocomplete
+    # @endif
+}
+# @endif
+
+# @if VAULT_ENABLED
+_vault_login () {
+    local json
+    if ! command -v jq >/dev/null 2>&1; then
+        # No jq, no token meta: validity is checked with vault token lookup
+        VAULT_TOKEN=$(vault login -method=<VAULT_LOGIN_METHOD> -token-only username=$1) || return 1
+        rm -f "$WORKDIR_ROOT/vault_token.meta"
+    else
+        json=$(vault login -method=<VAULT_LOGIN_METHOD> -format=json -no-store username=$1) || return 1
+        VAULT_TOKEN=$(printf '%s' "$json" | jq -r .auth.client_token)
+        _vault_token_save_meta "$json"
+    fi
+    (umask 077; echo -n "$VAULT_TOKEN" > "$WORKDIR_ROOT/vault_token")
+    rm -f "<VAULT_ENV_CACHE>"
+    # @if LAZY
+    rm -rf "<WORKDIR_TMP>/lazy"
+    # @endif
+    export VAULT_TOKEN
+}
+
+# vault_token.meta: "expires_at ttl renewable" (expires_at 0 - never expires),
+# written from the json of vault login, vault token renew or vault token lookup
+_vault_token_save_meta () {
+    local meta
+    meta=$(printf '%s' "$1" | jq -r '
+        (.auth // .data) as $a
+        | ($a.lease_duration // $a.ttl // 0) as $ttl
+        | "\(if $ttl == 0 then 0 else (now | floor) + $ttl end) \($ttl) \($a.renewable // false)"
+    ') || return 1
+    printf '%s\n' "$meta" > "$WORKDIR_ROOT/vault_token.meta"
 }
 
+# Valid for at least a minute more; vault is asked only when there is no meta
+_vault_token_is_valid () {
+    local meta="$WORKDIR_ROOT/vault_token.meta"
+    if [ -z "$VAULT_TOKEN" ]; then
+        return 1
+    fi
+    if [ ! -r "$meta" ]; then
+        local json
+        json=$(vault token lookup -format=json 2>/dev/null) || return 1
+        command -v jq >/dev/null 2>&1 && _vault_token_save_meta "$json"
+        return 0
+    fi
+    local expires ttl renewable
+    read -r expires ttl renewable < "$meta"
+    if [ "$expires" = 0 ]; then
+        return 0
+    fi
+    local now="${EPOCHSECONDS:-$(date +%s)}"
+    [ "$expires" -gt $(( now + 60 )) ] 2>/dev/null
+}
+
+# Renewable token in the last third of its ttl is renewed in the background
+_vault_token_renew_in_background () {
+    local meta="$WORKDIR_ROOT/vault_token.meta"
+    if [ -z "$VAULT_TOKEN" ] || [ ! -r "$meta" ]; then
+        return
+    fi
+    local expires ttl renewable
+    read -r expires ttl renewable < "$meta"
+    if [ "$renewable" != "true" ] || [ "$expires" = 0 ]; then
+        return
+    fi
+    local now="${EPOCHSECONDS:-$(date +%s)}"
+    if [ "$expires" -le "$now" ] || [ $(( expires - now )) -gt $(( ttl / 3 )) ]; then
+        return
+    fi
+    ( _vault_token_renew >/dev/null 2>&1 & )
+}
+
+_vault_token_renew () {
+    local lock="$WORKDIR_ROOT/vault_token.lock"
+    # A lock left by a killed renew is dropped after 10 minutes
+    find "$lock" -maxdepth 0 -mmin +10 -exec rmdir {} \; 2>/dev/null
+    mkdir "$lock" 2>/dev/null || return
+    local json
+    if json=$(vault token renew -format=json); then
+        _vault_token_save_meta "$json"
+    fi
+    rmdir "$lock"
+}
+
+# @if VAULT_IS_LOAD_ENV_VARS
+_vault_env_cache_is_fresh () {
+    local cache="$1" line
+    if [ ! -r "$cache" ]; then
+        return 1
+    fi
+    read -r line < "$cache"
+    local expires="${line#\# expires=}"
+    local now="${EPOCHSECONDS:-$(date +%s)}"
+    [ "$expires" -gt "$now" ] 2>/dev/null
+}
+# @endif
+
 deactivate_vault () {
     <VAULT_DEACTIVATE LOAD_ENV_VARS>
     if ! [ -z "${_OLD_VAULT_ADDR+_}" ] ; then
@@ -128,8 +291,68 @@ deactivate_vault () {
         export VAULT_TOKEN
         unset _OLD_VAULT_TOKEN
     fi
+    unset VAULT_ENV_CACHE
+    unalias vault-login vault-logout 2>/dev/null
+}
+
+_vault_set_env () {
+    _OLD_VAULT_ADDR="${VAULT_ADDR-}"
+    VAULT_ADDR="<VAULT_ADDR>"
+    VAULT_LOGIN_METHOD="<VAULT_LOGIN_METHOD>"
+
+    _OLD_VAULT_TOKEN="${VAULT_TOKEN-}"
+    VAULT_TOKEN=""
+    if [ -r "$WORKDIR_ROOT/vault_token" ]; then
+        # The token file has no trailing newline, read returns 1 on it
+        read -r VAULT_TOKEN < "$WORKDIR_ROOT/vault_token" || true
+    fi
+
+    export VAULT_ADDR
+    export VAULT_TOKEN
+    export VAULT_LOGIN_METHOD
+
+    VAULT_ENV_CACHE="<VAULT_ENV_CACHE>"
+}
+
+_vault_aliases () {
+    alias vault-login='_vault_login'
+
+    # @if LAZY
+    alias vault-logout='rm -rf <WORKDIR_ROOT>/vault_token <WORKDIR_ROOT>/vault_token.meta <VAULT_ENV_CACHE> <WORKDIR_TMP>/lazy; unset VAULT_TOKEN'
+    # @else
+    alias vault-logout='rm -f <WORKDIR_ROOT>/vault_token <WORKDIR_ROOT>/vault_token.meta <VAULT_ENV_CACHE>; unset VAULT_TOKEN'
+    # @endif
 }
 
+# With "noninteractive" (lazy shims) an expired token is reported instead of
+# asking for vault login: stdin belongs to the wrapped tool
+activate_vault () {
+    _vault_set_env
+    _vault_aliases
+    _vault_token_renew_in_background
+
+    # @if VAULT_IS_LOAD_ENV_VARS
+    # Secrets cached by the loader, no vault calls until the cache expires
+    if _vault_env_cache_is_fresh "$VAULT_ENV_CACHE"; then
+        source "$VAULT_ENV_CACHE"
+        return
+    fi
+    if ! _vault_token_is_valid; then
+        if [ "${1-}" = "noninteractive" ]; then
+            echo "Vault token is not valid, vault env vars are not loaded: run vault-login" >&2
+            return 1
+        fi
+        echo "Login into vault"
+        printf "Enter vault username: "
+        read _vault_user
+        _vault_login $_vault_user
+    fi
+    eval "$("<VAULT_ENV_LOADER>")"
+    # @endif
+}
+# @endif
+
+# @if ANSIBLE_ENABLED
 deactivate_ansible() {
     if ! [ -z "${_OLD_ANSIBLE_CONFIG+_}" ] ; then
         ANSIBLE_CONFIG="$_OLD_ANSIBLE_CONFIG"
@@ -139,6 +362,26 @@ deactivate_ansible() {
     unalias ans 2>/dev/null
 }
 
+activate_ansible () {
+    _OLD_ANSIBLE_CONFIG="${ANSIBLE_CONFIG-}"
+    ANSIBLE_CONFIG="<ANSIBLE_CONFIG>"
+    export ANSIBLE_CONFIG
+
+    ANSIBLE_PATH="<ANSIBLE_PATH>"
+    export ANSIBLE_PATH
+    ANSIBLE_PYTHON="<ANSIBLE_WORKDIR>/venv/bin/python"
+    export ANSIBLE_PYTHON
+
+    PATH="<ANSIBLE_BINDIR>:$PATH"
+
+    alias ans='cd $ANSIBLE_PATH'
+    # variable for use in cd, for exam. cd $ans/some_dir
+    ans='<ANSIBLE_PATH>'
+    export ans
+}
+# @endif
+
+# @if GCLOUD_ENABLED
 deactivate_gcloud () {
     if ! [ -z "${_OLD_CLOUDSDK_CONFIG+_}" ] ; then
         CLOUDSDK_CONFIG="$_OLD_CLOUDSDK_CONFIG"
@@ -152,6 +395,19 @@ deactivate_gcloud () {
     fi
 }
 
+activate_gcloud () {
+    _OLD_CLOUDSDK_CONFIG="${CLOUDSDK_CONFIG-}"
+
+    CLOUDSDK_CONFIG="<GCLOUD_CFG_PATH>"
+    export CLOUDSDK_CONFIG
+
+    _OLD_GOOGLE_APPLICATION_CREDENTIALS="${GOOGLE_APPLICATION_CREDENTIALS-}"
+    GOOGLE_APPLICATION_CREDENTIALS="$CLOUDSDK_CONFIG/application_default_credentials.json"
+    export GOOGLE_APPLICATION_CREDENTIALS
+}
+# @endif
+
+# @if KUBE_ENABLED
 deactivate_kubectl () {
     if ! [ -z "${_OLD_KUBECONFIG+_}" ] ; then
         KUBECONFIG="$_OLD_KUBECONFIG"
@@ -160,6 +416,14 @@ deactivate_kubectl () {
     fi
 }
 
+activate_kubectl () {
+    _OLD_KUBECONFIG="${KUBECONFIG-}"
+    KUBECONFIG="<KUBE_CONFIG_PATH>/config"
+    export KUBECONFIG
+}
+# @endif
+
+# @if PYTHON_VENV_ENABLED
 deactivate_python_venv () {
     if ! [ -z "${_OLD_VIRTUALENVWRAPPER_PYTHON+_}" ] ; then
         VIRTUALENVWRAPPER_PYTHON="$_OLD_VIRTUALENVWRAPPER_PYTHON"
@@ -168,49 +432,101 @@ deactivate_python_venv () {
     fi
 }
 
-deactivate_terra () {
-    if ! [ -z "${_OLD_TERRAFORM_ALIAS:+_}" ]; then
-        eval "alias $_OLD_TERRAFORM_ALIAS";
+activate_python_venv () {
+    _OLD_VIRTUALENVWRAPPER_PYTHON="${VIRTUALENVWRAPPER_PYTHON-}"
+    VIRTUALENVWRAPPER_PYTHON="<PYTHON_VENV>/bin/python3"
+    export VIRTUALENVWRAPPER_PYTHON
+    PATH="<PYTHON_VENV>/bin:$PATH"
+}
+# @endif
+
+# @if TERRAFORM_ENABLED
+deactivate_terraform () {
+    if [ -n "${_OLD_TERRAFORM_ALIAS-}" ]; then
+        alias terraform="$_OLD_TERRAFORM_ALIAS"
     elif [ ! "${1-}" = "nondestructive" ] ; then
         unalias terraform 2>/dev/null
     fi
     unset _OLD_TERRAFORM_ALIAS
+}
 
-    if ! [ -z "${_OLD_TERRAGRUNT_ALIAS:+_}" ]; then
-        eval "alias $_OLD_TERRAGRUNT_ALIAS";
+activate_terraform () {
+    _OLD_TERRAFORM_ALIAS="${<ALIASES>[terraform]-}"
+    alias <ALIAS_TERRAFORM>
+}
+# @endif
+
+# @if TERRAGRUNT_ENABLED
+deactivate_terragrunt () {
+    if [ -n "${_OLD_TERRAGRUNT_ALIAS-}" ]; then
+        alias terragrunt="$_OLD_TERRAGRUNT_ALIAS"
     elif [ ! "${1-}" = "nondestructive" ] ; then
         unalias terragrunt 2>/dev/null
     fi
     unset _OLD_TERRAGRUNT_ALIAS
+}
 
+activate_terragrunt () {
+    _OLD_TERRAGRUNT_ALIAS="${<ALIASES>[terragrunt]-}"
+    alias <ALIAS_TERRAGRUNT>
 }
+# @endif
 
+# @if ARGOCD_ENABLED
 deactivate_argocd () {
-    if ! [ -z "${_OLD_ARGOCD_ALIAS:+_}" ]; then
-        eval "alias $_OLD_ARGOCD_ALIAS";
+    if [ -n "${_OLD_ARGOCD_ALIAS-}" ]; then
+        alias argocd="$_OLD_ARGOCD_ALIAS"
     elif [ ! "${1-}" = "nondestructive" ] ; then
         unalias argocd 2>/dev/null
     fi
     unset _OLD_ARGOCD_ALIAS
 }
 
-
-deactivate_ssh() {
-    if ! [ -z "${_OLD_SSH_ALIAS:+_}" ]; then
-        eval "alias $_OLD_SSH_ALIAS";
-    elif [ ! "${1-}" = "nondestructive" ] ; then
-        unalias ssh 2>/dev/null
-    fi
-    unset _OLD_SSH_ALIAS
-    stop_ssh_agent
-    _ssh_autocomplete_zsh_deactivate
-    _ssh_autocomplete_bash_deactivate
+activate_argocd () {
+    _OLD_ARGOCD_ALIAS="${<ALIASES>[argocd]-}"
+    alias <ALIAS_ARGOCD>
 }
+# @endif
+
+# @if LAZY
+# @if bash
+# Called by a shim of templates/lazy_shim.sh with the name of the tool on its
+# first call in the session. The shim saves the env vars set here and reuses
+# them until _lazy_expires (0 - never, else the expiry of the vault env cache)
+_lazy_setup () {
+    _lazy_expires=0
+    # @if SSH_ENABLED
+    case "$1" in
+        ssh|ansible|ansible-*)
+            run_ssh_agent
+            ;;
+    esac
+    # @endif
+    # @if VAULT_ENABLED
+    case "$1" in
+        terraform|terragrunt|ansible|ansible-*)
+            activate_vault noninteractive || return
+            # @if VAULT_IS_LOAD_ENV_VARS
+            local line=""
+            read -r line < "$VAULT_ENV_CACHE" 2>/dev/null
+            _lazy_expires="${line#\# expires=}"
+            # @endif
+            ;;
+    esac
+    # @endif
+    return 0
+}
+# @endif
+# @endif
 
 deactivate_additional_aliases () {
     unalias admin-toolbox-info 2>/dev/null
 }
 
+activate_additional_aliases () {
+    alias admin-toolbox-info='cat $WORKDIR_ROOT/.info'
+}
+
 deactivate () {
     # reset old environment variables
     # ! [ -z ${VAR+_} ] returns true if VAR is declared at all
@@ -221,27 +537,49 @@ deactivate () {
         unset _OLD_VIRTUAL_PATH
     fi
 
-    deactivate_vault
-    deactivate_ansible
-    deactivate_gcloud
-    deactivate_kubectl
-    deactivate_python_venv
-    deactivate_terra
-    deactivate_argocd
-    deactivate_ssh
+    # @if VAULT_ENABLED
+    deactivate_vault "${1-}"
+    # @endif
+    # @if ANSIBLE_ENABLED
+    deactivate_ansible "${1-}"
+    # @endif
+    # @if GCLOUD_ENABLED
+    deactivate_gcloud "${1-}"
+    # @endif
+    # @if KUBE_ENABLED
+    deactivate_kubectl "${1-}"
+    # @endif
+    # @if PYTHON_VENV_ENABLED
+    deactivate_python_venv "${1-}"
+    # @endif
+    # @if TERRAFORM_ENABLED
+    deactivate_terraform "${1-}"
+    # @endif
+    # @if TERRAGRUNT_ENABLED
+    deactivate_terragrunt "${1-}"
+    # @endif
+    # @if ARGOCD_ENABLED
+    deactivate_argocd "${1-}"
+    # @endif
+    # @if SSH_ENABLED
+    deactivate_ssh "${1-}"
+    # @endif
     deactivate_additional_aliases
+    # @if LAZY
+    # Shims run activate.bash with "deactivate nondestructive", the session stays
+    if [ -n "${ADMIN_TOOLBOX_SESSION-}" ] && [ ! "${1-}" = "nondestructive" ] ; then
+        rm -rf "<WORKDIR_TMP>/lazy/$ADMIN_TOOLBOX_SESSION"
+        unset ADMIN_TOOLBOX_SESSION
+    fi
+    # @endif
 
     if [ ! "${1-}" = "nondestructive" ] ; then
     # Self destruct!
         unset -f deactivate
     fi
 
-    # This should detect bash and zsh, which have a hash command that must
-    # be called to get it to forget past commands.  Without forgetting
-    # past commands the $PATH changes we made may not be respected
-    if [ -n "${BASH-}" ] || [ -n "${ZSH_VERSION-}" ] ; then
-        hash -r 2>/dev/null
-    fi
+    # Forget past commands, the $PATH changes may not be respected otherwise
+    hash -r 2>/dev/null
 
     if ! [ -z "${_OLD_VIRTUAL_PS1+_}" ] ; then
         PS1="$_OLD_VIRTUAL_PS1"
@@ -251,143 +589,6 @@ deactivate () {
 
 }
 
-
-activate_python_venv () {
-    local PYTHON_VENV_ENABLED="<PYTHON_VENV_ENABLED>"
-    local PYTHON_VENV="<PYTHON_VENV>"
-
-    if [ "$PYTHON_VENV_ENABLED" ]; then
-        _OLD_PYTHON_WRAPPER="$VIRTUALENVWRAPPER_PYTHON"
-        VIRTUALENVWRAPPER_PYTHON="$PYTHON_VENV/bin/python3"
-        export VIRTUALENVWRAPPER_PYTHON
-        PATH="$PYTHON_VENV/bin:$PATH"
-    fi
-}
-
-activate_ansible () {
-    ANSIBLE_CONFIG="<ANSIBLE_CONFIG>"
-    ANSIBLE_PATH="<ANSIBLE_PATH>"
-    local ANSIBLE_ENABLED="<ANSIBLE_ENABLED>"
-    local ANSIBLE_WORKDIR="<ANSIBLE_WORKDIR>"
-    local ANSIBLE_BINDIR="<ANSIBLE_BINDIR>"
-
-    if [ "$ANSIBLE_ENABLED" ]; then
-        _OLD_ANSIBLE_CONFIG="$ANSIBLE_CONFIG"
-        export ANSIBLE_CONFIG
-
-        export ANSIBLE_PATH
-        ANSIBLE_PYTHON="$ANSIBLE_WORKDIR/venv/bin/python"
-        export ANSIBLE_PYTHON
-
-        PATH="<ANSIBLE_BINDIR>:$PATH"
-    fi
-
-    alias ans='cd $ANSIBLE_PATH'
-    # variable for use in cd, for exam. cd $ans/some_dir
-    ans='<ANSIBLE_PATH>'
-    export ans
-}
-
-activate_vault () {
-    _OLD_VAULT_ADDR="$VAULT_ADDR"
-    VAULT_ADDR="<VAULT_ADDR>"
-    local VAULT_IS_LOAD_ENV_VARS="<VAULT_IS_LOAD_ENV_VARS>"
-    VAULT_LOGIN_METHOD="<VAULT_LOGIN_METHOD>"
-
-    _OLD_VAULT_TOKEN="$VAULT_TOKEN"
-    VAULT_TOKEN=""
-    if [ -f "$WORKDIR_ROOT/vault_token" ]; then
-        VAULT_TOKEN="$(cat $WORKDIR_ROOT/vault_token)"
-    fi
-
-    export VAULT_ADDR
-    export VAULT_TOKEN
-    export VAULT_LOGIN_METHOD
-
-    vault_login='
-    f(){
-        VAULT_TOKEN=$(vault login -method=$VAULT_LOGIN_METHOD -token-only username=$1)
-        echo -n "$VAULT_TOKEN" > $WORKDIR_ROOT/vault_token;
-        export VAULT_TOKEN
-        unset -f f
-    };
-    f'
-    alias vault-login="$vault_login"
-
-    alias vault-logout='rm -f <WORKDIR_ROOT>/vault_token; unset VAULT_TOKEN'
-
-    if [ "$VAULT_IS_LOAD_ENV_VARS" ]; then
-        is_loggedin=$(vault token lookup >/dev/null 2>&1 ; echo $?)
-        if [ "$is_loggedin" != "0" ]; then
-            echo "Login into vault"
-            printf "Enter vault username: "
-            read _vault_user
-            eval $vault_login $_vault_user
-        fi
-    <VAULT_LOAD_ENV_VARS>
-    fi
-
-}
-
-activate_terra () {
-    _OLD_TERRAFORM_ALIAS=$(alias terraform 2>/dev/null)
-    _OLD_TERRAGRUNT_ALIAS=$(alias terragrunt 2>/dev/null)
-    local TERRAFORM_ENABLED="<TERRAFORM_ENABLED>"
-    local TERRAGRUNT_ENABLED="<TERRAGRUNT_ENABLED>"
-    if [ "$TERRAFORM_ENABLED" ]; then
-        alias <ALIAS_TERRAFORM>
-    fi
-    if [ "$TERRAGRUNT_ENABLED" ]; then
-        alias <ALIAS_TERRAGRUNT>
-    fi
-}
-
-activate_argocd () {
-    _OLD_ARGOCD_ALIAS=$(alias argocd 2>/dev/null)
-    alias <ALIAS_ARGOCD>
-}
-
-activate_ssh () {
-    _OLD_SSH_ALIAS=$(alias ssh 2>/dev/null)
-    local SSH_ENABLED="<SSH_ENABLED>"
-    local SSH_ENABLE_AUTOCOMPLETE_FROM_ANSIBLE="<SSH_ENABLE_AUTOCOMPLETE_FROM_ANSIBLE>"
-
-    if [ "$SSH_ENABLED" ]; then
-        alias <SSH_ALIAS>
-    fi
-    run_ssh_agent
-
-    if [ "$SSH_ENABLE_AUTOCOMPLETE_FROM_ANSIBLE" ]; then
-        ssh_ansible_autocomplete
-    fi
-}
-
-activate_gcloud () {
-    local GCLOUD_ENABLED="<GCLOUD_ENABLED>"
-    if [ -z "$GCLOUD_ENABLED"]; then
-        return
-    fi
-
-    _OLD_CLOUDSDK_CONFIG="$CLOUDSDK_CONFIG"
-
-    CLOUDSDK_CONFIG="<GCLOUD_CFG_PATH>"
-    export CLOUDSDK_CONFIG
-
-    _OLD_GOOGLE_APPLICATION_CREDENTIALS="$GOOGLE_APPLICATION_CREDENTIALS"
-    GOOGLE_APPLICATION_CREDENTIALS="$CLOUDSDK_CONFIG/application_default_credentials.json"
-    export GOOGLE_APPLICATION_CREDENTIALS
-}
-
-activate_kubectl () {
-    _OLD_KUBECONFIG="$KUBECONFIG"
-    KUBECONFIG="<KUBE_CONFIG_PATH>/config"
-    export KUBECONFIG
-}
-
-activate_additional_aliases () {
-    alias admin-toolbox-info='cat $WORKDIR_ROOT/.info'
-}
-
 # unset irrelevant variables
 deactivate nondestructive
 
@@ -399,14 +600,72 @@ _OLD_VIRTUAL_PATH="$PATH"
 PATH="$WORKDIR_BIN:$PATH"
 
 activate_env_files
+# @if LAZY
+# Only exports and aliases: vault env vars and ssh-agent are set up by the
+# shims of the tools which need them on the first call in the session,
+# see _lazy_setup and templates/lazy_shim.sh
+# @if VAULT_ENABLED
+_vault_set_env
+_vault_aliases
+# @endif
+# @if PYTHON_VENV_ENABLED
+activate_python_venv
+# @endif
+# @if ANSIBLE_ENABLED
+activate_ansible
+# @endif
+# @if TERRAFORM_ENABLED
+activate_terraform
+# @endif
+# @if TERRAGRUNT_ENABLED
+activate_terragrunt
+# @endif
+# @if ARGOCD_ENABLED
+activate_argocd
+# @endif
+# @if SSH_ENABLED
+_ssh_alias
+# @endif
+# @if GCLOUD_ENABLED
+activate_gcloud
+# @endif
+# @if KUBE_ENABLED
+activate_kubectl
+# @endif
+if [ -z "${ADMIN_TOOLBOX_SESSION-}" ]; then
+    ADMIN_TOOLBOX_SESSION="$$.${EPOCHSECONDS:-$(date +%s)}"
+    export ADMIN_TOOLBOX_SESSION
+fi
+PATH="<LAZY_SHIMS_DIR>:$PATH"
+# @else
+# @if VAULT_ENABLED
 activate_vault
+# @endif
+# @if PYTHON_VENV_ENABLED
 activate_python_venv
+# @endif
+# @if ANSIBLE_ENABLED
 activate_ansible
-activate_terra
+# @endif
+# @if TERRAFORM_ENABLED
+activate_terraform
+# @endif
+# @if TERRAGRUNT_ENABLED
+activate_terragrunt
+# @endif
+# @if ARGOCD_ENABLED
 activate_argocd
+# @endif
+# @if SSH_ENABLED
 activate_ssh
+# @endif
+# @if GCLOUD_ENABLED
 activate_gcloud
+# @endif
+# @if KUBE_ENABLED
 activate_kubectl
+# @endif
+# @endif
 activate_additional_aliases
 
 export PATH
@@ -414,18 +673,9 @@ export PATH
 
 if [ -z "${ADMIN_TOOLBOX_DISABLE_PROMPT-}" ] ; then
     _OLD_VIRTUAL_PS1="${PS1-}"
-    if [ "x" != x ] ; then
-        PS1="${PS1-}"
-    else
-        PS1="(`basename \"$TOOLBOX_NAME\"`) ${PS1-}"
-    fi
+    PS1="(<TOOLBOX_PROMPT>) ${PS1-}"
     export PS1
 fi
 
-# This should detect bash and zsh, which have a hash command that must
-# be called to get it to forget past commands.  Without forgetting
-# past commands the $PATH changes we made may not be respected
-if [ -n "${BASH-}" ] || [ -n "${ZSH_VERSION-}" ] ; then
-    hash -r 2>/dev/null
-fi
-
+# Forget past commands, the $PATH changes may not be respected otherwise
+hash -r 2>/dev/null
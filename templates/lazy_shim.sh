@@ -0,0 +1,61 @@
+#!/usr/bin/env bash
+# Shim of the lazy activate mode, linked as <LAZY_SHIMS_DIR>/<tool>.
+# The first call in an activated shell sets up the tool (vault env vars,
+# ssh-agent) with _lazy_setup of activate.bash and saves the env vars it set
+# to <WORKDIR_TMP>/lazy/<session>/<tool>; later calls of the session load
+# them and run the tool without activate.bash
+
+SHIMS="<LAZY_SHIMS_DIR>"
+LAZY_DIR="<WORKDIR_TMP>/lazy"
+name="${0##*/}"
+cache="$LAZY_DIR/${ADMIN_TOOLBOX_SESSION-}/$name"
+
+_cache_is_fresh () {
+    local line
+    if [ -z "${ADMIN_TOOLBOX_SESSION-}" ] || [ ! -r "$cache" ]; then
+        return 1
+    fi
+    read -r line < "$cache"
+    local expires="${line#\# expires=}"
+    local now="${EPOCHSECONDS:-$(date +%s)}"
+    [ "$expires" = 0 ] || [ "$expires" -gt "$now" ] 2>/dev/null
+}
+
+# Exported vars which _lazy_setup added or changed; PATH and PS1 are the
+# ones of the shell
+_save_cache () {
+    local var tmp
+    # Sessions of closed shells
+    find "$LAZY_DIR" -mindepth 1 -maxdepth 1 -mmin +1440 -exec rm -rf {} + 2>/dev/null
+    mkdir -p -m 700 "${cache%/*}" || return
+    tmp=$(mktemp "$cache.XXXXXX") || return
+    {
+        printf '# expires=%s\n' "$_lazy_expires"
+        for var in $(compgen -e); do
+            case "$var" in
+                PATH|PS1)
+                    continue
+                    ;;
+            esac
+            if [ -z "${before[$var]+_}" ] || [ "${before[$var]}" != "${!var}" ]; then
+                declare -p "$var"
+            fi
+        done
+    } > "$tmp" && mv -f "$tmp" "$cache"
+}
+
+if _cache_is_fresh; then
+    source "$cache"
+else
+    declare -A before
+    for var in $(compgen -e); do
+        before[$var]="${!var}"
+    done
+    source "<WORKDIR_ROOT>/activate.bash"
+    if _lazy_setup "$name" && [ -n "${ADMIN_TOOLBOX_SESSION-}" ]; then
+        _save_cache
+    fi
+fi
+# Aliases of the tools are set in the shell and have already been applied
+PATH="${PATH//"$SHIMS:"/}"
+exec "$name" "$@"
@@ -0,0 +1,61 @@
+#!/usr/bin/env bash
+# Builds the ssh host completion index, started by activate in the background
+# when the index is older than one of the files listed in <index>.sources
+
+SSH_CONFIG="<SSH_CONFIG>"
+INDEX="<SSH_HOSTS_INDEX>"
+ANSIBLE_PATH="<ANSIBLE_PATH>"
+ANSIBLE_CONFIG="<ANSIBLE_CONFIG>"
+ANSIBLE_BIN="<ANSIBLE_BINDIR>/ansible"
+
+# One build at a time; the lock dir mtime is the build start time.
+# A lock left by a killed build is dropped after 10 minutes
+find "$INDEX.lock" -maxdepth 0 -mmin +10 -exec rmdir {} \; 2>/dev/null
+mkdir "$INDEX.lock" 2>/dev/null || exit 0
+trap 'rm -f "$INDEX.tmp" "$INDEX.sources.tmp"; rmdir "$INDEX.lock"' EXIT
+
+sources=("$HOME/.ssh/config" "$SSH_CONFIG" "$HOME/.ssh/known_hosts" "$ANSIBLE_CONFIG")
+if [ -r "$ANSIBLE_CONFIG" ]; then
+    # inventory = $ANSIBLE_PATH/inventory,<workdir>/ansible/inventory.ini
+    inventory=$(awk -F= '$1 ~ /^[ \t]*inventory[ \t]*$/ {print $2; exit}' "$ANSIBLE_CONFIG")
+    IFS=',' read -ra paths <<< "$inventory"
+    for path in "${paths[@]}"; do
+        path="${path//[[:space:]]/}"
+        path="${path//\$ANSIBLE_PATH/$ANSIBLE_PATH}"
+        path="${path/#\~/$HOME}"
+        [ -z "$path" ] && continue
+        sources+=("$path")
+        if [ -d "$path" ]; then
+            while IFS= read -r f; do
+                sources+=("$f")
+            done < <(find "$path" -type f -not -path '*/.git/*')
+        fi
+    done
+fi
+
+if [ ! -x "$ANSIBLE_BIN" ]; then
+    ANSIBLE_BIN=$(command -v ansible)
+fi
+
+{
+    for config in "$HOME/.ssh/config" "$SSH_CONFIG"; do
+        if [ -r "$config" ]; then
+            awk '$1 == "Host" {for (i = 2; i <= NF; i++) if ($i !~ /[*?!]/) print $i}' "$config"
+        fi
+    done
+    if [ -r "$HOME/.ssh/known_hosts" ]; then
+        # hashed (|1|...), @marker and [host]:port entries are skipped
+        awk '$1 !~ /^[|@#\[]/ {n = split($1, h, ","); for (i = 1; i <= n; i++) print h[i]}' \
+            "$HOME/.ssh/known_hosts"
+    fi
+    if [ -n "$ANSIBLE_BIN" ] && [ -r "$ANSIBLE_CONFIG" ]; then
+        ANSIBLE_CONFIG="$ANSIBLE_CONFIG" ANSIBLE_PATH="$ANSIBLE_PATH" \
+            "$ANSIBLE_BIN" all --list-hosts 2>/dev/null | tail -n +2 | awk '{print $1}'
+    fi
+} | sort -u > "$INDEX.tmp"
+
+printf '%s\n' "${sources[@]}" > "$INDEX.sources.tmp"
+# Files changed while the index was built make it stale again
+touch -r "$INDEX.lock" "$INDEX.tmp"
+mv -f "$INDEX.sources.tmp" "$INDEX.sources"
+mv -f "$INDEX.tmp" "$INDEX"
@@ -0,0 +1,40 @@
+#!/usr/bin/env bash
+# Reads vault secrets for activate (vault.load_env_vars) and prints them as
+# export lines. Every KV path is read once, all paths at the same time.
+# When all paths are read, the exports are cached for TTL seconds.
+
+CACHE="<VAULT_ENV_CACHE>"
+TTL=<VAULT_ENV_CACHE_TTL>
+PATHS=(<VAULT_ENV_PATHS>)
+# jq filter for every path, prints the exports of its variables
+FILTERS=(<VAULT_ENV_FILTERS>)
+
+umask 077
+tmp=$(mktemp -d) || exit 1
+trap 'rm -rf "$tmp"' EXIT
+
+pids=()
+for i in "${!PATHS[@]}"; do
+    vault kv get -format=json "${PATHS[$i]}" > "$tmp/$i.json" 2> "$tmp/$i.err" &
+    pids+=($!)
+done
+
+failed=0
+: > "$tmp/env.sh"
+for i in "${!PATHS[@]}"; do
+    if wait "${pids[$i]}" && jq -r "${FILTERS[$i]}" "$tmp/$i.json" >> "$tmp/env.sh"; then
+        continue
+    fi
+    echo "Vault: can't read ${PATHS[$i]}: $(cat "$tmp/$i.err")" >&2
+    failed=1
+done
+
+if [ "$failed" = 0 ] && [ "$TTL" -gt 0 ]; then
+    {
+        echo "# expires=$(( $(date +%s) + TTL ))"
+        cat "$tmp/env.sh"
+    } > "$CACHE.tmp"
+    mv -f "$CACHE.tmp" "$CACHE"
+fi
+cat "$tmp/env.sh"
+exit $failed